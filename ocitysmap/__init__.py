@@ -66,6 +66,9 @@ list of output formats. For now, the following formats are supported:
     * SVG
     * SVGZ (gzipped-SVG)
     * PS
+    * DZI (DeepZoom tile pyramid, at the PNG resolution)
+    * CSV and JSON index data
+    * Parquet and Arrow index tables (requires pyarrow)
 
 The prefix is the filename prefix for all the rendered files. This is usually a
 path to the destination's directory, eventually followed by some unique, yet
@@ -77,7 +80,6 @@ __version__ = '0.2'
 
 import cairo
 import configparser
-import gzip
 import logging
 import os
 import shutil
@@ -93,10 +95,15 @@ import gettext
 
 from . import coords
 from . import i18n
+from . import statements
+from . import dbpool
 from .indexlib.commons import IndexDoesNotFitError, IndexEmptyError
 from .layoutlib import renderers
 from .layoutlib import commons
+from .layoutlib import atlas_writer, tile_pyramid
+from . import output_writer
 from .indexlib import indexers
+from .indexlib import export as index_export
 from .stylelib import Stylesheet
 
 LOG = logging.getLogger('ocitysmap')
@@ -178,6 +185,14 @@ class RenderingConfiguration:
 
         # Setup by OCitySMap::render() from osmid and bounding_box fields:
         self.polygon_wkt     = None # str (WKT of interest)
+        self.area_geometry   = None # maplib.area.AreaGeometry of polygon_wkt
+
+        # Setup by the renderers, index shared by all output formats
+        self.job_index       = None # indexlib.commons.JobIndex
+
+        # Setup by the renderers, results of the render plugins prepare()
+        # phase, shared by all output formats
+        self.plugin_data     = {} # plugin name => concurrent.futures.Future
 
         # Setup by OCitySMap::render() from language field:
         self.i18n            = None # i18n object
@@ -196,6 +211,10 @@ class RenderingConfiguration:
         # custom QRcode text
         self.qrcode_text     = None
 
+        # Resolution to rasterize map layers at in vector output formats,
+        # None to keep them as vector data
+        self.map_raster_dpi  = None # int
+
 class OCitySMap:
     """
     This is the main entry point of the OCitySMap map rendering engine. Read
@@ -204,8 +223,20 @@ class OCitySMap:
 
     DEFAULT_REQUEST_TIMEOUT_MIN = 15 # TODO make this a config file setting
 
+    DEFAULT_MAX_DB_CONNECTIONS = 4
+
     DEFAULT_RENDERING_PNG_DPI = 300 # TODO make this a config file setting
 
+    DEFAULT_COMPRESSION_LEVEL = 6
+
+    # Draw PNG output directly into an ImageSurface instead of a
+    # temporary PDF surface, unless set with the direct_png_rendering option
+    DIRECT_PNG_RENDERING = True
+
+    # Number of tiles drawn at the same time for tile pyramid output,
+    # unless set with the tile_render_threads option
+    TILE_RENDER_THREADS = min(4, os.cpu_count() or 1)
+
     STYLESHEET_REGISTRY = []
 
     OVERLAY_REGISTRY = []
@@ -327,8 +358,9 @@ class OCitySMap:
 
         Returns
         -------
-        psycopg2.connection
-            Database connection for the given name.
+        dbpool.ConnectionPool
+            Database connection pool for the given name, usable just
+            like a single psycopg2 connection.
         """
 
         # check db chache for already opened connection for this name
@@ -350,22 +382,32 @@ class OCitySMap:
                  (datasource['dbname'], datasource['host'], datasource['port'],
                   datasource['user']))
 
-        db = psycopg2.connect(user=datasource['user'],
-                              password=datasource['password'],
-                              host=datasource['host'],
-                              database=datasource['dbname'],
-                              port=datasource['port'])
-
-        # Force everything to be unicode-encoded, in case we run along Django
-        # (which loads the unicode extensions for psycopg2)
-        db.set_client_encoding('utf8')
-
         # set request timeout from configuration, or static default if not configured
         try:
             timeout = int(self._parser.get('datasource', 'request_timeout'))
         except (configparser.NoOptionError, ValueError):
             timeout = OCitySMap.DEFAULT_REQUEST_TIMEOUT_MIN
-        self._set_request_timeout(db, timeout)
+
+        try:
+            max_connections = int(datasource['max_connections'])
+        except (KeyError, ValueError):
+            max_connections = OCitySMap.DEFAULT_MAX_DB_CONNECTIONS
+
+        def connect():
+            db = psycopg2.connect(user=datasource['user'],
+                                  password=datasource['password'],
+                                  host=datasource['host'],
+                                  database=datasource['dbname'],
+                                  port=datasource['port'])
+
+            # Force everything to be unicode-encoded, in case we run along Django
+            # (which loads the unicode extensions for psycopg2)
+            db.set_client_encoding('utf8')
+
+            self._set_request_timeout(db, timeout)
+            return db
+
+        db = dbpool.ConnectionPool(connect, max_connections)
 
         # cache result
         self.__dbs[name] = db
@@ -394,6 +436,9 @@ class OCitySMap:
         cursor.execute('show statement_timeout;')
         LOG.debug('Configured statement timeout: %s.' %
                   cursor.fetchall()[0][0])
+        # a rollback, as done when a pooled connection is given back,
+        # would undo an uncommitted SET
+        db.commit()
 
     def _cleanup_tempdir(self, tmpdir):
         """ Remove a temporary directory including all contents
@@ -773,12 +818,20 @@ class OCitySMap:
 
         osm_date = self.get_osm_database_last_update()
 
+        # the index and the plugin data are built by the first
+        # renderer of this job
+        config.job_index = None
+        config.plugin_data = {}
+
         # Create a temporary directory for all our temporary helper files
         tmpdir = tempfile.mkdtemp(prefix='ocitysmap')
 
         # count successfully created output files
         output_count = 0
 
+        # compresses and writes finished output files in the background
+        writer = self._get_output_writer()
+
         try:
             LOG.debug('Rendering in temporary directory %s' % tmpdir)
 
@@ -791,7 +844,7 @@ class OCitySMap:
                 try:
                     self._render_one(config, tmpdir, renderer_cls,
                                      output_format, output_filename, osm_date,
-                                     file_prefix)
+                                     file_prefix, writer)
                 except IndexDoesNotFitError:
                     LOG.exception("The actual font metrics probably don't "
                                   "match those pre-computed by the renderer's"
@@ -802,13 +855,63 @@ class OCitySMap:
                     raise
 
                 output_count = output_count + 1
+
+            writer.wait()
         finally:
+            # temporary files may still be in use by the writer
+            writer.shutdown()
             self._cleanup_tempdir(tmpdir)
 
+        statements.log_statistics()
+
         return output_count
 
+    def _get_pdf_metadata(self, config, renderer):
+        """ PDF document information for a rendering
+
+        Parameters
+        ----------
+        config : RenderingConfiguration
+            The renderer / request settings.
+        renderer : Renderer
+            The renderer used for the job.
+
+        Returns
+        -------
+        dict of str => str
+            Document information entries by name, e.g. 'Title'
+        """
+        return {
+            'Creator':  'MyOSMatic <https://print.get-map.org/>',
+            'Title':    config.title,
+            'Author':   "Copyright © 2018 MapOSMatic/OCitySMap developers. \n" +
+                        "Map data © 2018 OpenStreetMap contributors (see http://osm.org/copyright)",
+            'Subject':  renderer.description, # TODO add style annotations here
+            'Keywords': "OpenStreetMap, MapOSMatic, OCitysMap",
+        }
+
+    def _get_output_writer(self):
+        """ Create the background writer for the output files of a job
+
+        Returns
+        -------
+        output_writer.OutputWriter
+        """
+        try:
+            level = int(self._parser.get('rendering', 'compression_level'))
+        except configparser.NoOptionError:
+            level = OCitySMap.DEFAULT_COMPRESSION_LEVEL
+
+        try:
+            threads = int(self._parser.get('rendering', 'compression_threads'))
+        except configparser.NoOptionError:
+            threads = 1
+
+        return output_writer.OutputWriter(level, threads)
+
     def _render_one(self, config, tmpdir, renderer_cls,
-                    output_format, output_filename, osm_date, file_prefix):
+                    output_format, output_filename, osm_date, file_prefix,
+                    writer):
         """ Render one output format
 
         Parameters
@@ -819,9 +922,12 @@ class OCitySMap:
             Path to temporary directory to use for this job
         renderer_cls :
         output_format : str
-            One of `pdf`, `ps`, `ps.gz`, `svg`, `svgz`, `csv`
+            One of `pdf`, `ps`, `ps.gz`, `svg`, `svgz`, `png`, `dzi`, `csv`,
+            `json`, `parquet`, `arrow`
         osm_date :
         file_prefix : str
+        writer : output_writer.OutputWriter
+            Background writer for PNG and compressed output files
 
         Returns
         -------
@@ -833,18 +939,49 @@ class OCitySMap:
 
         config.output_format = output_format
 
+        if output_format in index_export.get_available_formats():
+            # only the index and its grid are needed, no map at all
+            if not hasattr(renderer_cls, 'export_index'):
+                LOG.warning("%s renderer can't export its index"
+                            % renderer_cls.name)
+                return
+            renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix,
+                                    index_only=True)
+            renderer.export_index(output_format, output_filename)
+            return
+
+        # compressed formats are written uncompressed first, and
+        # compressed in the background once complete
+        uncompressed_filename = os.path.join(
+            tmpdir, os.path.basename(output_filename) + '.uncompressed')
+
         renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
 
-        if output_format == 'png':
+        # the server wide default applies to this renderer only, so
+        # that the caller's configuration is left untouched
+        if renderer.map_raster_dpi is None:
+            try:
+                renderer.map_raster_dpi = int(self._parser.get('rendering', 'map_raster_dpi'))
+            except configparser.NoOptionError:
+                pass
+
+        if output_format in ['png', 'dzi']:
             try:
                 dpi = int(self._parser.get('rendering', 'png_dpi'))
             except configparser.NoOptionError:
                 dpi = OCitySMap.DEFAULT_RENDERING_PNG_DPI
 
+            try:
+                direct_png_rendering = self._parser.getboolean('rendering', 'direct_png_rendering')
+            except configparser.NoOptionError:
+                direct_png_rendering = OCitySMap.DIRECT_PNG_RENDERING
+
             w_px = int(layoutlib.commons.convert_mm_to_dots(config.paper_width_mm, dpi))
             h_px = int(layoutlib.commons.convert_mm_to_dots(config.paper_height_mm, dpi))
 
-            if w_px > 25000 or h_px > 25000:
+            # tile pyramids are never rasterized as a whole, so only
+            # single PNG images need to be limited in size
+            if output_format == 'png' and (w_px > 25000 or h_px > 25000):
                 dpi = layoutlib.commons.PT_PER_INCH
                 w_px = int(layoutlib.commons.convert_pt_to_dots(renderer.paper_width_pt, dpi))
                 h_px = int(layoutlib.commons.convert_pt_to_dots(renderer.paper_height_pt, dpi))
@@ -856,45 +993,54 @@ class OCitySMap:
             # as the dpi value may have changed we need to re-create the renderer
             renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
 
-            # As strange as it may seem, we HAVE to use a vector
-            # device here and not a raster device such as
-            # ImageSurface. Because, for some reason, with
-            # ImageSurface, the font metrics would NOT match those
-            # pre-computed by renderer_cls.__init__() and used to
-            # layout the whole page
-            LOG.debug("Rendering PNG into %dpx x %dpx area at %ddpi ..."
-                      % (w_px, h_px, dpi))
-            surface = cairo.PDFSurface(None, w_px, h_px)
+            LOG.debug("Rendering %s into %dpx x %dpx area at %ddpi ..."
+                      % (output_format.upper(), w_px, h_px, dpi))
+            if output_format == 'dzi':
+                # recorded first, and rasterized tile by tile afterwards
+                surface = cairo.RecordingSurface(cairo.Content.COLOR_ALPHA,
+                                                 cairo.Rectangle(0, 0, w_px, h_px))
+            elif direct_png_rendering:
+                # font metrics are pinned by draw_utils, so the text
+                # extents computed when laying out the page on a vector
+                # surface are also valid on a raster one
+                surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w_px, h_px)
+            else:
+                # going through a vector device, as font metrics on
+                # ImageSurface used to not match those pre-computed by
+                # renderer_cls.__init__() and used to layout the page
+                surface = cairo.PDFSurface(None, w_px, h_px)
 
         elif output_format == 'svg':
             surface = cairo.SVGSurface(output_filename,
                                        renderer.paper_width_pt, renderer.paper_height_pt)
             surface.restrict_to_version(cairo.SVGVersion.VERSION_1_2);
         elif output_format == 'svgz':
-            surface = cairo.SVGSurface(gzip.GzipFile(output_filename, 'wb'),
+            surface = cairo.SVGSurface(uncompressed_filename,
                                        renderer.paper_width_pt, renderer.paper_height_pt)
             surface.restrict_to_version(cairo.SVGVersion.VERSION_1_2);
         elif output_format == 'pdf':
+            metadata = self._get_pdf_metadata(config, renderer)
+
+            if hasattr(renderer, 'render_pdf_file') \
+               and atlas_writer.is_available():
+                # multi-page renderers stream their pages into the
+                # output file part by part themselves
+                try:
+                    threads = int(self._parser.get('rendering', 'atlas_render_threads'))
+                except configparser.NoOptionError:
+                    threads = None
+                renderer.render_pdf_file(output_filename, dpi, osm_date,
+                                         metadata, threads)
+                return
+
             surface = cairo.PDFSurface(output_filename,
                                        renderer.paper_width_pt, renderer.paper_height_pt)
             surface.restrict_to_version(cairo.PDFVersion.VERSION_1_5);
 
             try:
-                surface.set_metadata(cairo.PDFMetadata.CREATOR,
-                                     'MyOSMatic <https://print.get-map.org/>')
-
-                surface.set_metadata(cairo.PDFMetadata.TITLE,
-                                     config.title)
-
-                surface.set_metadata(cairo.PDFMetadata.AUTHOR,
-                                     "Copyright © 2018 MapOSMatic/OCitySMap developers. \n" +
-                                     "Map data © 2018 OpenStreetMap contributors (see http://osm.org/copyright)")
-
-                surface.set_metadata(cairo.PDFMetadata.SUBJECT,
-                                     renderer.description) # TODO add style annotations here
-
-                surface.set_metadata(cairo.PDFMetadata.KEYWORDS,
-                                     "OpenStreetMap, MapOSMatic, OCitysMap")
+                for key, value in metadata.items():
+                    surface.set_metadata(getattr(cairo.PDFMetadata, key.upper()),
+                                         value)
             except:
               LOG.warning("Installed Cairo version does not support PDF annotations yet")
 
@@ -902,11 +1048,8 @@ class OCitySMap:
             surface = cairo.PSSurface(output_filename,
                                       renderer.paper_width_pt, renderer.paper_height_pt)
         elif output_format == 'ps.gz':
-            surface = cairo.PSSurface(gzip.GzipFile(output_filename, 'wb'),
+            surface = cairo.PSSurface(uncompressed_filename,
                                       renderer.paper_width_pt, renderer.paper_height_pt)
-        elif output_format == 'csv':
-            # We don't render maps into CSV.
-            return
         else:
             raise ValueError( \
                 'Unsupported output format: %s!' % output_format.upper())
@@ -916,10 +1059,21 @@ class OCitySMap:
         LOG.debug('Writing %s...' % output_filename)
 
         if output_format == 'png':
-            surface.write_to_png(output_filename)
+            writer.write_png(surface, output_filename)
+            return
+        elif output_format == 'dzi':
+            try:
+                threads = int(self._parser.get('rendering', 'tile_render_threads'))
+            except configparser.NoOptionError:
+                threads = OCitySMap.TILE_RENDER_THREADS
+            pyramid = tile_pyramid.TilePyramid(surface, w_px, h_px, threads)
+            pyramid.write(output_filename)
 
         surface.finish()
 
+        if output_format in ['svgz', 'ps.gz']:
+            writer.compress(uncompressed_filename, output_filename)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Process wide cache for SVG symbols, markers and logos.
+
+SVG files are parsed into Rsvg handles only once, and drawn once per
+(path, colour) into cairo recording surfaces that can then be painted as
+often as needed. Both caches are bounded and evict the least recently
+used entries.
+
+Symbols are recorded at their natural size and scaled when painted, so
+that all copies of a symbol on a page, whatever their size, are painted
+from the same surface. Vector backends then write the symbol only once,
+as a PDF form XObject or an SVG element referenced with <use>, instead
+of repeating its paths for every copy.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+
+import cairo
+import gi
+gi.require_version('Rsvg', '2.0')
+from gi.repository import Rsvg
+from colour import Color
+
+LOG = logging.getLogger('ocitysmap')
+
+# Color placeholder in SVG symbol files that can be colored
+SVG_PLACEHOLDER_COLOR = '#000000'
+
+MAX_SVG_HANDLES  = 128
+MAX_SVG_SURFACES = 512
+
+
+class LRUCache:
+    """
+    A thread safe dictionary holding at most max_size entries, dropping
+    the least recently used ones when full.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries  = OrderedDict()
+        self._lock     = threading.RLock()
+
+    def get(self, key, create):
+        """Return the entry for key, creating it with create() if needed.
+
+        Parameters
+        ----------
+        key : hashable
+            Cache key.
+        create : callable
+            Called without arguments to create a missing entry.
+
+        Returns
+        -------
+        The cached entry.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                value = create()
+            self._entries[key] = value
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_svg_handles  = LRUCache(MAX_SVG_HANDLES)
+_svg_surfaces = LRUCache(MAX_SVG_SURFACES)
+
+
+def _normalize_color(color):
+    if color is None or color[0] == '#':
+        return color
+    return Color(color).hex_l
+
+
+def get_svg_handle(path, color=None):
+    """Get the parsed Rsvg handle for an SVG file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SVG file.
+    color : str, optional
+        Color replacing the SVG_PLACEHOLDER_COLOR in the file, either
+        as '#rrggbb' or as a color name.
+
+    Returns
+    -------
+    Rsvg.Handle
+        Shared handle, not to be modified.
+    """
+    color = _normalize_color(color)
+
+    def create():
+        LOG.debug("Loading SVG %s (color: %s)" % (path, color))
+        with open(path, 'r') as fp:
+            data = fp.read()
+        if color:
+            data = data.replace(SVG_PLACEHOLDER_COLOR, color)
+        return Rsvg.Handle.new_from_data(data.encode())
+
+    return _svg_handles.get((path, color), create)
+
+
+def get_svg_surface(path, color=None, scale=1.0):
+    """Get an SVG file pre-rendered into a cairo recording surface.
+
+    Prefer paint_svg() or get_svg_pattern() to paint symbols at other
+    sizes than their natural one, they share a single surface for all
+    sizes.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SVG file.
+    color : str, optional
+        See get_svg_handle().
+    scale : float, optional
+        Scale factor applied to the SVG's own size.
+
+    Returns
+    -------
+    tuple of (cairo.RecordingSurface, float, float)
+        The recording surface with the symbol drawn at (0, 0), and its
+        scaled width and height.
+    """
+    color = _normalize_color(color)
+    scale = round(scale, 6)
+
+    def create():
+        svg = get_svg_handle(path, color)
+        width  = svg.props.width * scale
+        height = svg.props.height * scale
+        surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                                         cairo.Rectangle(0, 0, width, height))
+        ctx = cairo.Context(surface)
+        ctx.scale(scale, scale)
+        svg.render_cairo(ctx)
+        return (surface, width, height)
+
+    return _svg_surfaces.get((path, color, scale), create)
+
+
+def paint_svg(ctx, path, x, y, color=None, scale=1.0):
+    """Paint a cached SVG symbol with its top left corner at (x, y).
+
+    Parameters
+    ----------
+    ctx : cairo.Context
+        The context to draw on.
+    path : str
+        Path to the SVG file.
+    x : float
+        Horizontal position, in current user space units.
+    y : float
+        Vertical position, in current user space units.
+    color : str, optional
+        See get_svg_handle().
+    scale : float, optional
+        Scale factor applied to the SVG's own size.
+
+    Returns
+    -------
+    tuple of (float, float)
+        Width and height of the painted symbol.
+    """
+    (surface, width, height) = get_svg_surface(path, color)
+    ctx.save()
+    ctx.translate(x, y)
+    ctx.scale(scale, scale)
+    ctx.set_source_surface(surface, 0, 0)
+    ctx.paint()
+    ctx.restore()
+    return (width * scale, height * scale)
+
+
+def get_svg_pattern(path, color=None, scale=1.0):
+    """Get a pattern painting a cached SVG symbol at (0, 0).
+
+    Parameters
+    ----------
+    path : str
+        Path to the SVG file.
+    color : str, optional
+        See get_svg_handle().
+    scale : float, optional
+        Scale factor applied to the SVG's own size.
+
+    Returns
+    -------
+    tuple of (cairo.SurfacePattern, float, float)
+        The pattern, and the scaled width and height of the symbol.
+    """
+    (surface, width, height) = get_svg_surface(path, color)
+    pattern = cairo.SurfacePattern(surface)
+    pattern.set_matrix(cairo.Matrix(xx=1.0 / scale, yy=1.0 / scale))
+    return (pattern, width * scale, height * scale)
+
+
+def clear():
+    """Drop all cached assets."""
+    _svg_handles.clear()
+    _svg_surfaces.clear()
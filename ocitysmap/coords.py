@@ -23,7 +23,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
+import threading
 
+import numpy
 import shapely.wkt
 
 import xml.sax
@@ -40,6 +42,10 @@ _MAPNIK_PROJECTION = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 " \
 
 EARTH_RADIUS = 6370986 # meters
 
+# Sphere radius used by the spherical mercator projection (EPSG:3857),
+# same as +a/+b in _MAPNIK_PROJECTION
+MERCATOR_RADIUS = 6378137 # meters
+
 def dd2dms(value):
     abs_value = abs(value)
     degrees  = int(abs_value)
@@ -289,13 +295,9 @@ class BoundingBox:
         list of float
             Mercator coordinates for bottom left, bottom right, top left, top right
         """
-        envelope = mapnik.Box2d(self.get_top_left()[1],
-                                self.get_top_left()[0],
-                                self.get_bottom_right()[1],
-                                self.get_bottom_right()[0])
-        _proj = mapnik.Projection(_MAPNIK_PROJECTION)
-        bottom_left = _proj.forward(mapnik.Coord(envelope.minx, envelope.miny))
-        top_right = _proj.forward(mapnik.Coord(envelope.maxx, envelope.maxy))
+        envelope = get_projection().project_bbox(self)
+        bottom_left = mapnik.Coord(envelope.minx, envelope.miny)
+        top_right = mapnik.Coord(envelope.maxx, envelope.maxy)
         top_left = mapnik.Coord(bottom_left.x, top_right.y)
         bottom_right = mapnik.Coord(top_right.x, bottom_left.y)
         return (bottom_right, bottom_left, top_left, top_right)
@@ -319,6 +321,138 @@ class BoundingBox:
         return [[self._lat1, self._long1],
                 [self._lat2, self._long2]]
 
+
+class MercatorProjection:
+    """
+    Conversions between WGS84 lat/lon (EPSG:4326) and spherical mercator
+    (EPSG:3857) coordinates, the projection all maps are rendered in.
+
+    This implements the same spherical formulas as _MAPNIK_PROJECTION,
+    but works on whole numpy arrays of coordinates at once and doesn't
+    need a mapnik.Projection object. Use get_projection() to get the
+    shared instance.
+    """
+
+    def __init__(self, radius=MERCATOR_RADIUS):
+        self._radius = float(radius)
+
+    def forward(self, lons, lats):
+        """Project geographic coordinates to mercator meters.
+
+        Parameters
+        ----------
+        lons : float or sequence of float
+            Longitudes, in degrees.
+        lats : float or sequence of float
+            Latitudes, in degrees.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            Mercator x and y coordinates, in meters.
+        """
+        lons = numpy.asarray(lons, dtype=float)
+        lats = numpy.asarray(lats, dtype=float)
+        xs = self._radius * numpy.radians(lons)
+        ys = self._radius * numpy.log(numpy.tan(numpy.pi/4
+                                                + numpy.radians(lats)/2))
+        return (xs, ys)
+
+    def inverse(self, xs, ys):
+        """Convert mercator meters back to geographic coordinates.
+
+        Parameters
+        ----------
+        xs : float or sequence of float
+            Mercator x coordinates, in meters.
+        ys : float or sequence of float
+            Mercator y coordinates, in meters.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            Longitudes and latitudes, in degrees.
+        """
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        lons = numpy.degrees(xs / self._radius)
+        lats = numpy.degrees(2 * numpy.arctan(numpy.exp(ys / self._radius))
+                             - numpy.pi/2)
+        return (lons, lats)
+
+    def project_bbox(self, bbox):
+        """Project a bounding box into the rendering projection.
+
+        Parameters
+        ----------
+        bbox : BoundingBox
+            Bounding box in WGS84 lat/lon coordinates.
+
+        Returns
+        -------
+        mapnik.Box2d
+            Envelope in mercator meters.
+        """
+        (xs, ys) = self.forward([bbox.get_left(), bbox.get_right()],
+                                [bbox.get_bottom(), bbox.get_top()])
+        return mapnik.Box2d(xs[0], ys[0], xs[1], ys[1])
+
+    def inverse_envelopes(self, envelopes):
+        """Convert mercator envelopes back to bounding boxes.
+
+        Parameters
+        ----------
+        envelopes : list of mapnik.Box2d
+            Envelopes in mercator meters.
+
+        Returns
+        -------
+        list of BoundingBox
+            Bounding boxes in WGS84 lat/lon coordinates, in the
+            same order as the envelopes.
+        """
+        if not envelopes:
+            return []
+
+        xs = [coord for e in envelopes for coord in (e.minx, e.maxx)]
+        ys = [coord for e in envelopes for coord in (e.miny, e.maxy)]
+        (lons, lats) = self.inverse(xs, ys)
+        return [BoundingBox(lats[i], lons[i], lats[i+1], lons[i+1])
+                for i in range(0, len(lons), 2)]
+
+    def inverse_envelope(self, envelope):
+        """Convert a mercator envelope back to a bounding box.
+
+        Parameters
+        ----------
+        envelope : mapnik.Box2d
+            Envelope in mercator meters.
+
+        Returns
+        -------
+        BoundingBox
+            Bounding box in WGS84 lat/lon coordinates.
+        """
+        return self.inverse_envelopes([envelope])[0]
+
+
+_projection = None
+_projection_lock = threading.Lock()
+
+def get_projection():
+    """Get the shared MercatorProjection instance.
+
+    Returns
+    -------
+    MercatorProjection
+    """
+    global _projection
+    with _projection_lock:
+        if _projection is None:
+            _projection = MercatorProjection()
+        return _projection
+
+
 if __name__ == "__main__":
     wkt = 'POINT(2.0333 48.7062132250362)'
     pt = Point.parse_wkt(wkt)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Small pool of database connections.
+
+A ConnectionPool can be used just like the single psycopg2 connection
+that was used before: cursor(), rollback() and everything else are
+forwarded to its primary connection. Code that wants to run queries at
+the same time borrows additional connections with connection().
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class ConnectionPool:
+    """
+    A primary database connection plus up to max_connections - 1
+    additional ones, and at least one, opened on demand.
+
+    Borrowed connections are never the primary one, which may be in use
+    by another thread at the same time. So even with max_connections
+    set to 1 a second connection is opened when one is borrowed, and
+    borrowers take turns using it.
+    """
+
+    def __init__(self, connect, max_connections=1):
+        """
+        Parameters
+        ----------
+           connect : callable
+               Called without arguments to open a new, fully set up
+               psycopg2 connection.
+           max_connections : int
+               Number of borrowable connections plus the primary one,
+               at least two connections are opened whatever the value.
+               Callers running queries at the same time should not use
+               more threads than this.
+        """
+        self._connect = connect
+        self._max_connections = max(1, max_connections)
+        # the primary connection plus at least one to borrow
+        self._max_open = max(2, self._max_connections)
+        self._primary = connect()
+        self._idle = []
+        self._open = 1
+        self._cond = threading.Condition()
+
+    def __getattr__(self, name):
+        # Everything not defined here is served by the primary connection
+        return getattr(self._primary, name)
+
+    @property
+    def max_connections(self):
+        return self._max_connections
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection of its own for the current thread.
+
+        Waits for a connection to become available if the maximum number
+        of connections is already open, see the class documentation.
+        Any transaction left open is rolled back when the connection is
+        given back.
+
+        Yields
+        ------
+        psycopg2.connection
+        """
+        with self._cond:
+            while not self._idle and self._open >= self._max_open:
+                self._cond.wait()
+            if self._idle:
+                db = self._idle.pop()
+            else:
+                self._open += 1
+                db = None
+
+        if db is None:
+            try:
+                db = self._connect()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+            LOG.debug("Opened database connection %d of %d"
+                      % (self._open, self._max_open))
+
+        try:
+            yield db
+        finally:
+            try:
+                db.rollback()
+            except Exception:
+                # don't give broken connections back to the pool
+                LOG.exception("Dropping broken database connection")
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+            else:
+                with self._cond:
+                    self._idle.append(db)
+                    self._cond.notify()
+
+    def close(self):
+        """Close all connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            db.close()
+        self._primary.close()
@@ -34,6 +34,62 @@ import layoutlib.commons as commons
 LEFT_SIDE = 1
 RIGHT_SIDE = 2
 
+# Text is laid out once, often on a throw-away PDF surface, and drawn
+# later on whatever surface the output format needs. By default Cairo
+# hints font metrics on raster surfaces but not on vector ones, so the
+# same text would get different extents on an ImageSurface. Pinning the
+# font options and the Pango resolution makes them the same everywhere.
+PANGO_RESOLUTION = 96.0
+
+def get_font_options():
+    """ Font options used for all text layout and drawing
+
+    Returns
+    -------
+    cairo.FontOptions
+    """
+    font_options = cairo.FontOptions()
+    font_options.set_hint_metrics(cairo.HintMetrics.OFF)
+    font_options.set_hint_style(cairo.HintStyle.NONE)
+    return font_options
+
+def create_pango_context(ctx):
+    """ Create a Pango context with surface independent font metrics
+
+    Also sets the font options of the given Cairo context.
+
+    Parameters
+    ----------
+    ctx : cairo.Context
+        The Cairo context to use
+
+    Returns
+    -------
+    Pango.Context
+    """
+    font_options = get_font_options()
+    ctx.set_font_options(font_options)
+    pc = PangoCairo.create_context(ctx)
+    PangoCairo.context_set_font_options(pc, font_options)
+    PangoCairo.context_set_resolution(pc, PANGO_RESOLUTION)
+    return pc
+
+def create_layout(ctx):
+    """ Create a Pango layout with surface independent font metrics
+
+    To be used instead of PangoCairo.create_layout()
+
+    Parameters
+    ----------
+    ctx : cairo.Context
+        The Cairo context to use
+
+    Returns
+    -------
+    Pango.Layout
+    """
+    return Pango.Layout.new(create_pango_context(ctx))
+
 def create_layout_with_font(ctx, font_desc):
     """ Create a Pango layout from given font destription
 
@@ -57,7 +113,7 @@ def create_layout_with_font(ctx, font_desc):
 
     if isinstance(font_desc, str):
         font_desc = Pango.FontDescription(font_desc)
-    layout = PangoCairo.create_layout(ctx)
+    layout = create_layout(ctx)
     layout.set_font_description(font_desc)
     font = layout.get_context().load_font(font_desc)
     font_metric = font.get_metrics()
@@ -359,8 +415,7 @@ def draw_text_adjusted(ctx, text, x, y, width, height, max_char_number=None,
            write into (cairo units).
        max_char_number (number): If set a maximum character number.
     """
-    pc = PangoCairo.create_context(ctx)
-    layout = PangoCairo.create_layout(ctx)
+    layout = create_layout(ctx)
     layout.set_width(int(width_adjust * width * Pango.SCALE))
     layout.set_alignment(align)
     fd = Pango.FontDescription("Georgia Bold")
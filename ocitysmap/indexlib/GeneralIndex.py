@@ -19,11 +19,11 @@
 import locale
 from natsort import natsorted, natsort_keygen, ns
 from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
-import csv
-import datetime
 import math
 import psycopg2
+import shapely.wkt
 from sys import maxsize
 from gettext import gettext
 
@@ -38,18 +38,156 @@ from ocitysmap.layoutlib.abstract_renderer import Renderer
 
 from .commons import IndexCategory, IndexItem, IndexDoesNotFitError
 import ocitysmap.layoutlib.commons as UTILS
-from ocitysmap.coords import Point
+from ocitysmap.coords import Point, MERCATOR_RADIUS
 from .renderer import IndexRenderingArea
+from ocitysmap import statements
+from . import export
 import logging
 LOG = logging.getLogger('ocitysmap')
 
 # TODO: define in single place, not in multiple files
 PAGE_NUMBER_MARGIN_PT  = UTILS.convert_mm_to_pt(10)
 
+# SQL expressions computing the extent of an index entry from its
+# 'contour' geometry, as a line between its two most distant points.
+# The grid squares an entry is listed in are derived from this line.
+EXTENT_EXPRESSIONS = {
+    # exact, but quadratic in the number of vertices
+    'longest': "ST_LONGESTLINE(contour, contour)",
+    # same result, as the most distant points are always hull
+    # vertices. Only the convex hull is computed in the database, its
+    # diameter is found in linear time by _hull_diameter_linestring()
+    'hull': "ST_CONVEXHULL(contour)",
+    # bounding box diagonal, may cover a few more grid squares
+    'bbox': "ST_SETSRID(ST_MAKELINE(ST_MAKEPOINT(ST_XMIN(contour), ST_YMIN(contour)),"
+            " ST_MAKEPOINT(ST_XMAX(contour), ST_YMAX(contour))), 3857)",
+    # first and last point of simple lines, longest line between hull
+    # vertices (quadratic in their number) for everything else
+    'endpoints': "COALESCE(ST_MAKELINE(ST_STARTPOINT(contour), ST_ENDPOINT(contour)),"
+                 " ST_LONGESTLINE(ST_CONVEXHULL(contour), ST_CONVEXHULL(contour)))",
+}
+
+def _hull_diameter(points):
+    """
+    Find the two most distant vertices of a convex polygon.
+
+    Uses rotating calipers: for each hull edge the vertex farthest
+    from it is found by moving on from the one of the previous edge,
+    so that all antipodal vertex pairs are visited in linear time.
+
+    Parameters
+    ----------
+    points : list of tuple of float
+        The polygon vertices in order, either orientation, without
+        repeating the first vertex at the end.
+
+    Returns
+    -------
+    tuple of tuple of float
+        The two most distant vertices.
+    """
+    n = len(points)
+    if n < 3:
+        return (points[0], points[-1])
+
+    def area2(a, b, c):
+        return abs((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0]))
+
+    def dist2(a, b):
+        return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2
+
+    best = (-1, None, None)
+    j = 1
+    for i in range(n):
+        a, b = points[i], points[(i + 1) % n]
+        while area2(a, b, points[(j + 1) % n]) > area2(a, b, points[j]):
+            j = (j + 1) % n
+        for p in (a, b):
+            d = dist2(p, points[j])
+            if d > best[0]:
+                best = (d, p, points[j])
+
+    return best[1:]
+
+def _hull_diameter_linestring(hull_wkt):
+    """
+    Extent line of an index entry from its convex hull.
+
+    Parameters
+    ----------
+    hull_wkt : str
+        Convex hull WKT, in spherical mercator coordinates (EPSG:3857).
+
+    Returns
+    -------
+    str
+        WKT linestring between the two most distant hull vertices, in
+        WGS84 lat/lon coordinates (EPSG:4326), like ST_ASTEXT() returns
+        it, or None for empty hulls.
+    """
+    if hull_wkt is None:
+        return None
+    hull = shapely.wkt.loads(hull_wkt)
+    if hull.is_empty:
+        return None
+    if hull.geom_type == 'Polygon':
+        points = list(hull.exterior.coords)[:-1]
+    else:
+        # degenerated hulls of a single point or collinear points
+        points = list(hull.coords)
+
+    def to_lon_lat(point):
+        return (math.degrees(point[0] / MERCATOR_RADIUS),
+                math.degrees(2 * math.atan(math.exp(point[1] / MERCATOR_RADIUS))
+                             - math.pi / 2))
+
+    (p1, p2) = _hull_diameter(points)
+    return "LINESTRING(%r %r,%r %r)" % (to_lon_lat(p1) + to_lon_lat(p2))
+
+# Strategies whose SQL expression is not the extent line itself, but
+# a geometry in EPSG:3857 that is turned into the extent line by a
+# function applied to each result row
+EXTENT_CONVERSIONS = {
+    'hull': _hull_diameter_linestring,
+}
+
+class _ExtentLinestring(str):
+    """
+    Extent WKT of an index entry, carrying the exact longest line of
+    the entry as well when CHECK_EXTENT_STRATEGY is set.
+    """
+    reference = None
+
+def _polygon_parameter(polygon):
+    """
+    Statement parameter for a polygon given as WKT or as shapely geometry.
+
+    Geometries are passed as WKB, which PostGIS reads much faster than
+    WKT and which doesn't need to be serialized to text with full float
+    precision first.
+
+    Returns a tuple of the SQL expression reading the polygon from
+    parameter $1, the parameter value and its SQL type.
+    """
+    if isinstance(polygon, str):
+        return ("ST_GEOMFROMTEXT($1, 4326)", polygon, 'text')
+    return ("ST_GEOMFROMWKB($1, 4326)", psycopg2.Binary(polygon.wkb), 'bytea')
+
 class GeneralIndex:
     name = "Genaral"
     description = gettext(u"(* General Index *)")
 
+    # How to compute the extent of index entries, see EXTENT_EXPRESSIONS
+    EXTENT_STRATEGY = 'hull'
+
+    # Also query the exact longest line of all entries, and report the
+    # ones that end up in different grid squares with EXTENT_STRATEGY
+    CHECK_EXTENT_STRATEGY = False
+
+    # Maximum number of independent sub-queries to run at the same time,
+    # each on a database connection of its own
+    MAX_CONCURRENT_QUERIES = 4
+
     def __init__(self, db, renderer, bounding_box, polygon_wkt, i18n, page_number=None):
         """
         Prepare the index of the items inside the given WKT. This
@@ -63,8 +201,9 @@ class GeneralIndex:
             The renderer that called us
         bounding_box : ocitysmap.BoundingBox
             The bounding box of the map area
-        polygon_wkt : str
-            The WKT of the surrounding polygon of interest
+        polygon_wkt : str or shapely.geometry
+            The WKT of the surrounding polygon of interest, or the
+            polygon itself, which is passed on to the database as WKB
         i18n : i18n.i18n
             Internationalization configuration
         page_number : int, optional
@@ -73,9 +212,13 @@ class GeneralIndex:
         self._renderer = renderer
         self._bounding_box = bounding_box
         self._polygon_wkt = polygon_wkt
+        (self._polygon_sql, self._polygon_param, self._polygon_type) \
+            = _polygon_parameter(polygon_wkt)
         self._i18n = i18n
         self._page_number = page_number
         self._categories = []
+        self._repair_geometries = False
+        self._checked_items = []
 
     @property
     def categories(self):
@@ -120,7 +263,8 @@ class GeneralIndex:
         Returns
         -------
         str
-            SQL Query string ready to be executed
+            SQL Query string ready to be executed with _run_query(),
+            reading the polygon of interest from parameter $1
         """
 
 
@@ -138,10 +282,11 @@ class GeneralIndex:
         # template string and iterating over the table names
         subquery_template = """
 SELECT %(columns)s,
-       ST_INTERSECTION(%(wkb_limits)s, %(aggregate)stab1.%%(way)s%(aggreg_end)s) AS contour
+       ST_INTERSECTION(%(wkb_limits)s, %(aggregate)s%%(way)s%(aggreg_end)s) AS contour
            FROM planet_osm_%(table)s tab1
            %(join)s
           WHERE %(where)s
+            AND tab1.way && %(wkb_limits)s
             AND ST_INTERSECTS(%%(way)s, %(wkb_limits)s)
           %(order_group)s
 """
@@ -153,8 +298,8 @@ SELECT %(columns)s,
                     'table': table,
                     'columns': ",".join(column_expressions),
                     'where': where,
-                    'wkb_limits': ("ST_TRANSFORM(ST_GEOMFROMTEXT('%s' , 4326), 3857)"
-                                   % (self._polygon_wkt,)),
+                    'wkb_limits': ("ST_TRANSFORM(%s, 3857)"
+                                   % (self._polygon_sql,)),
                     'aggregate': "ST_LINEMERGE(ST_COLLECT(" if group else "",
                     'aggreg_end': "))" if group else "",
                     'order_group': ("GROUP BY %s" % (",".join(column_aliases))) if group else "",
@@ -166,24 +311,43 @@ SELECT %(columns)s,
         # and wrap them by the outer query returning the actual result
         subquery = ' UNION ' . join(subquery_parts)
 
+        try:
+            extent = EXTENT_EXPRESSIONS[self.EXTENT_STRATEGY]
+        except KeyError:
+            LOG.warning("Unknown extent strategy '%s', using 'longest'"
+                        % self.EXTENT_STRATEGY)
+            extent = EXTENT_EXPRESSIONS['longest']
+
+        if self.EXTENT_STRATEGY in EXTENT_CONVERSIONS:
+            # converted to the extent line in lat/lon by _fetch_rows()
+            extent_column = "ST_ASTEXT(%s)" % extent
+        else:
+            extent_column = "ST_ASTEXT(ST_TRANSFORM(%s, 4326))" % extent
+
+        reference = ""
+        if self.CHECK_EXTENT_STRATEGY:
+            reference = (",\n       ST_ASTEXT(ST_TRANSFORM(%s, 4326)) AS reference_linestring"
+                         % EXTENT_EXPRESSIONS['longest'])
+
         query = """
 SELECT %(columns)s,
-       ST_ASTEXT(ST_TRANSFORM(ST_LONGESTLINE(contour,contour),
-                              4326)) AS longest_linestring
+       %(extent)s AS longest_linestring%(reference)s
   FROM ( %(subquery)s
      ) AS foo
  ORDER BY %(columns)s
- """ % {'columns': (",".join(column_aliases)), 'subquery': subquery}
+ """ % {'columns': (",".join(column_aliases)), 'subquery': subquery,
+        'extent': extent_column, 'reference': reference}
 
         return query
 
-    @staticmethod
-    def _run_query(cursor, query, debug=False):
+    def _run_query(self, cursor, query, debug=False):
         """
         Simple helper to execute a SQL query on the osm2pgsql tables
 
-        First tries fast, but fragile way, falls back to stable but slower
-        alternative in case of problems
+        First tries the fast way, using the geometries as they are. If
+        this fails because of invalid geometries the query is run again
+        with only the invalid ones repaired, and all further queries of
+        this index repair them right away.
 
         Parameters
         ----------
@@ -197,17 +361,119 @@ SELECT %(columns)s,
         -------
         void
         """
-        try:
-            if debug:
-                LOG.warning(query % {'way':'way'})
-            cursor.execute(query % {'way':'way'})
-        except psycopg2.InternalError:
-            # This exception generaly occurs when inappropriate ways have
-            # to be cleaned. Using a buffer of 0 generaly helps to clean
-            # them. This operation is not applied by default for
-            # performance reasons.
-            db.rollback()
-            cursor.execute(query % {'way':'st_buffer(way, 0)'})
+        if not self._repair_geometries:
+            try:
+                self._execute_query(cursor, query % {'way': 'tab1.way'}, debug)
+                return
+            except psycopg2.InternalError as e:
+                # This exception generaly occurs when invalid ways make
+                # GEOS operations fail. Checking every geometry for
+                # validity is not done by default for performance reasons.
+                LOG.warning("Index query failed, repairing invalid geometries: %s"
+                            % str(e).strip())
+                cursor.connection.rollback()
+                self._repair_geometries = True
+
+        repaired_way = ("CASE WHEN ST_ISVALID(tab1.way) THEN tab1.way"
+                        " ELSE ST_MAKEVALID(tab1.way) END")
+        self._execute_query(cursor, query % {'way': repaired_way}, debug)
+
+    def _execute_query(self, cursor, sql, debug=False):
+        """
+        Execute an index query as prepared statement, with the polygon
+        of interest as parameter.
+        """
+        if debug:
+            LOG.warning(sql)
+        statements.execute(cursor, type(self).__name__, sql,
+                           [self._polygon_param], [self._polygon_type])
+
+    def _run_concurrently(self, db, list_functions):
+        """
+        Run independent index sub-queries at the same time
+
+        Each function is run in a thread of its own, with a database
+        connection borrowed from the pool. Without a connection pool,
+        or if only one connection may be used, they are run one after
+        the other on the given connection.
+
+        Parameters
+        ----------
+        db : dbpool.ConnectionPool or psycopg2 connection
+            The GIS database
+        list_functions : list of callable
+            Functions taking a database connection and returning a list
+            of IndexCategory objects, like _list_amenities()
+
+        Returns
+        -------
+        list of IndexCategory
+            The categories returned by all functions, in the order the
+            functions were given, whatever order they finished in.
+        """
+        max_workers = min(len(list_functions), self.MAX_CONCURRENT_QUERIES,
+                          getattr(db, 'max_connections', 1))
+
+        if max_workers < 2:
+            results = [list_function(db) for list_function in list_functions]
+        else:
+            def run(list_function):
+                with db.connection() as connection:
+                    return list_function(connection)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(run, list_functions))
+
+        return [category for result in results for category in result]
+
+    def _fetch_rows(self, cursor):
+        """
+        Fetch the results of a query built by _build_query()
+
+        Extent geometries of strategies listed in EXTENT_CONVERSIONS are
+        turned into extent lines. When CHECK_EXTENT_STRATEGY is set the
+        reference extent column is removed from the rows, and attached
+        to the extent line for _check_extent().
+
+        Parameters
+        ----------
+        cursor: psycopg2 database cursor
+            Cursor the query has been executed with
+
+        Returns
+        -------
+        list of tuple
+            Result rows, the extent linestring being the last column
+        """
+        rows = cursor.fetchall()
+        convert = EXTENT_CONVERSIONS.get(self.EXTENT_STRATEGY)
+        if not self.CHECK_EXTENT_STRATEGY and convert is None:
+            return rows
+
+        result = []
+        for row in rows:
+            reference = None
+            if self.CHECK_EXTENT_STRATEGY:
+                (row, reference) = (row[:-1], row[-1])
+
+            extent = row[-1]
+            if convert is not None:
+                extent = convert(extent)
+            if extent is not None and reference is not None:
+                extent = _ExtentLinestring(extent)
+                extent.reference = reference
+
+            result.append(tuple(row[:-1]) + (extent,))
+        return result
+
+    def _check_extent(self, item, linestring):
+        """
+        Remember an index item for comparison with its reference extent
+        once the grid is applied, see CHECK_EXTENT_STRATEGY.
+        """
+        reference = getattr(linestring, 'reference', None)
+        if reference is not None:
+            self._checked_items.append((item, reference))
 
     def get_index_entries(self, db, tables, columns, where, group=False, category_mapping=None, max_category_items=maxsize, join=None, debug=False):
         """
@@ -245,7 +511,7 @@ SELECT %(columns)s,
 
         self._run_query(cursor, query, debug)
 
-        for amenity_type, amenity_name, linestring in cursor.fetchall():
+        for amenity_type, amenity_name, linestring in self._fetch_rows(cursor):
             # Parse the WKT from the largest linestring in shape
             try:
                 s_endpoint1, s_endpoint2 = map(lambda s: s.split(),
@@ -266,10 +532,10 @@ SELECT %(columns)s,
             if not catname in result:
                 result[catname] = GeneralIndexCategory(catname, is_street=False)
 
-            result[catname].items.append(GeneralIndexItem(amenity_name,
-                                                          endpoint1,
-                                                          endpoint2,
-                                                          self._page_number))
+            item = GeneralIndexItem(amenity_name, endpoint1, endpoint2,
+                                    self._page_number)
+            result[catname].items.append(item)
+            self._check_extent(item, linestring)
 
         return [category for catname, category in sorted(result.items()) if (category.items and len(category.items) <= max_category_items)]
 
@@ -291,8 +557,45 @@ SELECT %(columns)s,
         for category in self._categories:
             for item in category.items:
                 item.update_location_str(grid)
+        self._compare_reference_extents(grid)
         self._group_identical_grid_locations()
 
+    def _compare_reference_extents(self, grid):
+        """
+        Report index items located differently by EXTENT_STRATEGY than
+        by the exact longest line, see CHECK_EXTENT_STRATEGY.
+
+        Parameters
+        ----------
+            grid : ocitysmap.Grid
+               The Grid object the items have been mapped onto
+
+        Returns
+        -------
+            void
+        """
+        mismatches = 0
+        for item, linestring in self._checked_items:
+            try:
+                s_endpoint1, s_endpoint2 = map(lambda s: s.split(),
+                                               linestring[11:-1].split(','))
+            except (ValueError, TypeError):
+                continue
+            reference = GeneralIndexItem(item.label,
+                                         Point(s_endpoint1[1], s_endpoint1[0]),
+                                         Point(s_endpoint2[1], s_endpoint2[0]))
+            reference.update_location_str(grid)
+            if reference.location_str != item.location_str:
+                mismatches += 1
+                LOG.debug("Extent strategy '%s' puts %s in %s instead of %s"
+                          % (self.EXTENT_STRATEGY, item.label,
+                             item.location_str, reference.location_str))
+
+        if self._checked_items:
+            LOG.info("Extent strategy '%s': %d of %d items in different squares"
+                     % (self.EXTENT_STRATEGY, mismatches,
+                        len(self._checked_items)))
+
     def _group_identical_grid_locations(self):
         """
         Group locations whith the same name and the same position on the grid.
@@ -316,7 +619,7 @@ SELECT %(columns)s,
 
     def write_to_csv(self, title, output_filename):
         """
-        Write out index data in CSV format
+        Write out index data in CSV format, see export.write_csv()
 
         Parameters
         ----------
@@ -329,39 +632,58 @@ SELECT %(columns)s,
         -------
             void
         """
-        # TODO: implement writing the index to CSV
-        try:
-            fd = open(output_filename, 'w', encoding='utf-8')
-        except Exception as ex:
-            LOG.warning('error while opening destination file %s: %s'
-                      % (output_filename, ex))
-            return
+        export.write_csv(self._categories, title, output_filename)
 
-        LOG.debug("Creating CSV file %s..." % output_filename)
-        writer = csv.writer(fd)
-
-        # Try to treat indifferently unicode and str in CSV rows
-        def csv_writerow(row):
-            _r = []
-            for e in row:
-                _r.append(e)
-            return writer.writerow(_r)
-
-        copyright_notice = (u'© %(year)d MapOSMatic/ocitysmap authors. '
-                            u'Map data © %(year)d OpenStreetMap.org '
-                            u'and contributors (CC-BY-SA)' %
-                            {'year': datetime.date.today().year})
-        if title is not None:
-            csv_writerow(['# (UTF-8)', title, copyright_notice])
-        else:
-            csv_writerow(['# (UTF-8)', '', copyright_notice])
+    def write_to_json(self, title, output_filename):
+        """
+        Write out index data as a JSON document, see export.write_json()
 
-        for category in self._categories:
-            csv_writerow(['%s' % category.name])
-            for item in category.items:
-                csv_writerow(['', item.label, item.location_str or '???'])
+        Parameters
+        ----------
+        title: str
+            Map title
+        output_filename: str
+            Path of the file to write to
+
+        Returns
+        -------
+            void
+        """
+        export.write_json(self._categories, title, output_filename)
+
+    def write_to_parquet(self, title, output_filename):
+        """
+        Write out index data as a Parquet table, see export.write_table()
 
-        fd.close()
+        Parameters
+        ----------
+        title: str
+            Map title
+        output_filename: str
+            Path of the file to write to
+
+        Returns
+        -------
+            void
+        """
+        export.write_table(self._categories, title, output_filename, 'parquet')
+
+    def write_to_arrow(self, title, output_filename):
+        """
+        Write out index data as an Arrow IPC file, see export.write_table()
+
+        Parameters
+        ----------
+        title: str
+            Map title
+        output_filename: str
+            Path of the file to write to
+
+        Returns
+        -------
+            void
+        """
+        export.write_table(self._categories, title, output_filename, 'arrow')
 
 class GeneralIndexCategory(IndexCategory):
     def __init__(self, name, items=None, is_street=False):
@@ -418,6 +740,25 @@ class GeneralIndexCategory(IndexCategory):
         # return total document height used
         return height
 
+    def drawing_height(self, layout):
+        """
+        Category header height
+
+        Parameters
+        ----------
+           layout: pango.layout
+               Layout to use to render category headers
+
+        Returns
+        -------
+        float
+            Category header height, as used by draw()
+        """
+        layout.set_auto_dir(False)
+        layout.set_alignment(Pango.Alignment.CENTER)
+        layout.set_text(self.name, -1)
+        return float(layout.get_size()[1]) / Pango.SCALE
+
 class GeneralIndexItem(IndexItem):
     """
     An IndexItem represents one item in the index (a street or a POI). It
@@ -542,6 +883,167 @@ class GeneralIndexItem(IndexItem):
 
 
 
+class IndexItemBatch:
+    """
+    Draws runs of consecutive index items of one column at once.
+
+    Instead of drawing label, location and dotted line of each item
+    separately, all items of a run are laid out as lines of a single
+    Pango layout, with the locations aligned by a right tab stop, and
+    all dotted lines are drawn with a single stroke. Runs that can't be
+    laid out this way, e.g. because a label wraps over several lines,
+    are drawn item by item with GeneralIndexItem.draw().
+
+    Right-to-left indexes are always drawn item by item, as bidi
+    reordering around the tab could move labels and dots away from
+    where GeneralIndexItem.draw() puts them.
+    """
+
+    # Right aligned tab stops need Pango 1.50 or later
+    ENABLED = hasattr(Pango.TabAlign, 'RIGHT')
+
+    def __init__(self, rtl, ctx, pc, column_layout, fascent, fheight,
+                 label_layout=None, location_width=0):
+        """
+        Parameters
+        ----------
+           rtl : boolean
+               Whether to draw right-to-left or not.
+           ctx, pc, column_layout, fascent, fheight,
+           label_layout, location_width :
+               See GeneralIndexItem.draw()
+        """
+        self._rtl            = rtl
+        self._ctx            = ctx
+        self._pc             = pc
+        self._column_layout  = column_layout
+        self._fascent        = fascent
+        self._fheight        = fheight
+        self._label_layout   = label_layout or column_layout
+        self._location_width = location_width
+        self._layout         = None
+        self._rows           = []
+
+    def add(self, item, baseline_x, baseline_y, label_height=0):
+        """Queue an index item for drawing.
+
+        Parameters
+        ----------
+           item : GeneralIndexItem
+               The item to draw.
+           baseline_x, baseline_y, label_height :
+               See GeneralIndexItem.draw()
+        """
+        if label_height == 0:
+            label_height = self._fheight
+
+        # A run continues only directly below the previous item
+        if self._rows:
+            (_, last_x, last_y, last_height) = self._rows[-1]
+            if (baseline_x != last_x or label_height != last_height
+                or abs(baseline_y - last_y - last_height) > 0.01):
+                self.flush()
+
+        self._rows.append((item, baseline_x, baseline_y, label_height))
+
+    def flush(self):
+        """Draw all queued index items."""
+        if not self._rows:
+            return
+
+        if not (self.ENABLED and not self._rtl and self._draw_run()):
+            for (item, baseline_x, baseline_y, label_height) in self._rows:
+                item.draw(self._rtl, self._ctx, self._pc, self._column_layout,
+                          self._fascent, self._fheight,
+                          baseline_x, baseline_y,
+                          self._label_layout, label_height,
+                          self._location_width)
+
+        self._rows = []
+
+    def _draw_run(self):
+        lines = []
+        for (item, _, _, _) in self._rows:
+            location_str = item.location_str or '???'
+            if '\t' in item.label or '\t' in location_str:
+                return False
+            lines.append((item.label, location_str))
+
+        if self._layout is None:
+            self._layout = Pango.Layout.new(self._column_layout.get_context())
+            self._layout.set_font_description(
+                self._column_layout.get_font_description())
+            self._layout.set_auto_dir(False)
+            self._layout.set_alignment(Pango.Alignment.LEFT)
+
+        # Same text positions as GeneralIndexItem.draw()
+        layout = self._layout
+        layout.set_width(self._column_layout.get_width())
+        tabs = Pango.TabArray.new(1, False)
+        tabs.set_tab(0, Pango.TabAlign.RIGHT, self._column_layout.get_width())
+        layout.set_tabs(tabs)
+        layout.set_text('\n'.join('%s\t%s' % line for line in lines), -1)
+
+        # Labels too long for a single line are drawn item by item
+        if layout.get_line_count() != len(lines):
+            return False
+
+        (_, baseline_x, first_baseline_y, _) = self._rows[0]
+        top_y = first_baseline_y - self._fascent
+
+        ctx = self._ctx
+        ctx.save()
+        ctx.set_source_rgb(0.0, 0.0, 0.0)
+        PangoCairo.update_layout(ctx, layout)
+
+        # Find the line baselines and the tab positions between the
+        # two parts of each line, which are where the dots go
+        baselines = []
+        dots = []
+        line_iter = layout.get_iter()
+        index = 0
+        for (first, second), (item, _, baseline_y, label_height) \
+                in zip(lines, self._rows):
+            # Wrapped in the narrower label layout, see MultiPageIndexRenderer
+            (_, logical) = line_iter.get_line_extents()
+            if label_height > 1.5 * logical.height / Pango.SCALE:
+                ctx.restore()
+                return False
+
+            baselines.append(line_iter.get_baseline() / Pango.SCALE)
+            tab_index = index + len(first.encode('utf-8'))
+            if item.label != '':
+                tab_pos = layout.index_to_pos(tab_index)
+                dots.append((baseline_x + tab_pos.x / Pango.SCALE, baseline_y,
+                             tab_pos.width / Pango.SCALE))
+            index = tab_index + 1 + len(second.encode('utf-8')) + 1
+            line_iter.next_line()
+
+        # The layout line spacing usually matches the row height, so
+        # the whole run can be shown at once
+        first_baseline = baselines[0]
+        if all(abs(baseline - first_baseline - (row[2] - first_baseline_y)) < 0.01
+               for baseline, row in zip(baselines, self._rows)):
+            ctx.move_to(baseline_x, top_y)
+            PangoCairo.show_layout(ctx, layout)
+        else:
+            for i, (_, _, baseline_y, _) in enumerate(self._rows):
+                ctx.move_to(baseline_x, baseline_y - self._fascent + first_baseline)
+                PangoCairo.show_layout_line(ctx, layout.get_line_readonly(i))
+
+        line_width = self._fheight/12
+        ctx.set_line_width(line_width)
+        ctx.set_dash([line_width, line_width*2])
+        for (x, y, length) in dots:
+            if length > self._fheight/2:
+                ctx.move_to(x + self._fheight/4, y)
+                ctx.rel_line_to(length - self._fheight/2, 0)
+        ctx.stroke()
+        ctx.restore()
+
+        return True
+
+
 class GeneralIndexRenderingStyle:
     """
     The GeneralIndexRenderingStyle class defines how the header and
@@ -652,7 +1154,7 @@ class GeneralIndexRenderer:
 
         # Create a PangoCairo context for drawing to Cairo
         ctx = cairo.Context(surface)
-        pc  = PangoCairo.create_context(ctx)
+        pc  = draw_utils.create_pango_context(ctx)
 
         # Iterate over the rendering_styles until we find a suitable layout
         rendering_style = None
@@ -736,7 +1238,7 @@ class GeneralIndexRenderer:
                     UTILS.convert_pt_to_dots(rendering_area.y, dpi))
 
         # Create a PangoCairo context for drawing to Cairo
-        pc = PangoCairo.create_context(ctx)
+        pc = draw_utils.create_pango_context(ctx)
 
         header_fd = Pango.FontDescription(
             rendering_area.rendering_style.header_font_spec)
@@ -781,6 +1283,10 @@ class GeneralIndexRenderer:
             offset_x = rendering_area.w - column_width + margin/2.
             delta_x  = - column_width
 
+        items = IndexItemBatch(self._i18n.isrtl(), ctx, pc, label_layout,
+                               UTILS.convert_pt_to_dots(label_fascent, dpi),
+                               UTILS.convert_pt_to_dots(label_fheight, dpi))
+
         actual_n_cols = 1
         offset_y = margin/2.
         for category in self._index_categories:
@@ -808,17 +1314,17 @@ class GeneralIndexRenderer:
                     offset_x      += delta_x
                     actual_n_cols += 1
 
-                street.draw(self._i18n.isrtl(), ctx, pc, label_layout,
-                            UTILS.convert_pt_to_dots(label_fascent, dpi),
-                            UTILS.convert_pt_to_dots(label_fheight, dpi),
-                            UTILS.convert_pt_to_dots(rendering_area.x
-                                                     + offset_x, dpi),
-                            UTILS.convert_pt_to_dots(rendering_area.y
-                                                     + offset_y
-                                                     + label_fascent, dpi))
+                items.add(street,
+                          UTILS.convert_pt_to_dots(rendering_area.x
+                                                   + offset_x, dpi),
+                          UTILS.convert_pt_to_dots(rendering_area.y
+                                                   + offset_y
+                                                   + label_fascent, dpi))
 
                 offset_y += label_fheight
 
+        items.flush()
+
         # Restore original context
         ctx.restore()
 
@@ -968,10 +1474,55 @@ class GeneralIndexRenderer:
 
         raise ValueError('Invalid freedom direction!')
 
+class MultiPageIndexPlan:
+    """
+    The pagination of a multi-page index: which category headers and
+    index items go to which column of which index page.
+
+    The plan is computed from text measurements only, so the number of
+    index pages is known before any of them is drawn, and the pages can
+    be rendered independently from each other.
+    """
+
+    def __init__(self, dpi, margin, column_width=0.0,
+                 max_location_drawing_width=0.0):
+        """
+        Parameters
+        ----------
+           dpi : float
+               Resolution the text was measured at.
+           margin : float
+               Margin around columns and index entries.
+           column_width : float
+               Width of one index column.
+           max_location_drawing_width : float
+               Width of the widest item location text.
+        """
+        self.dpi = dpi
+        self.margin = margin
+        self.column_width = column_width
+        self.max_location_drawing_width = max_location_drawing_width
+
+        # One list of placements per page. A placement is a
+        # (category, item, offset_x, offset_y, height) tuple, with item
+        # None for category headers. Items continuing a category from
+        # a previous column or page are placed without a header.
+        self.pages = []
+
+    @property
+    def page_count(self):
+        return len(self.pages)
+
+
 class MultiPageIndexRenderer:
     """
     The MultiPageIndexRenderer class encapsulates all the logic
     related to the rendering of the street index on multiple pages
+
+    Rendering happens in two phases: compute_plan() paginates the
+    index, measuring each label once, and render() draws pages of
+    that plan. A plan computed on one context can be assigned to
+    the plan attribute of renderers drawing on other surfaces.
     """
 
     # ctx: Cairo context
@@ -990,6 +1541,7 @@ class MultiPageIndexRenderer:
         self.rendering_area_h = rendering_area[3]
         self.page_offset      = page_offset
         self.index_page_num   = 0
+        self.plan             = None
 
     def _draw_page_number(self):
         self.ctx.save()
@@ -1007,9 +1559,8 @@ class MultiPageIndexRenderer:
         except:
             pass
 
-    def _new_page(self):
-        if self.index_page_num > 0:
-            self.surface.show_page()
+    def _new_page(self, index_page_num):
+        self.index_page_num = index_page_num
 
         # Set a white background (so that generated bitmaps are not transparent)
         self.ctx.save()
@@ -1019,56 +1570,73 @@ class MultiPageIndexRenderer:
         self.ctx.restore()
 
         self._draw_page_number()
-        self.index_page_num = self.index_page_num + 1
-
-    def render(self, dpi = UTILS.PT_PER_INCH):
-        self.ctx.save()
-
-        LOG.warning("render multipage index")
-
-        # Create a PangoCairo context for drawing to Cairo
-        pc = PangoCairo.create_context(self.ctx)
 
+    def _create_layouts(self, dpi):
         header_fd = Pango.FontDescription("Georgia Bold 12")
         label_column_fd  = Pango.FontDescription("DejaVu 6")
 
-        header_layout, header_fascent, header_fheight, header_em = \
+        self._header_layout, self._header_fascent, self._header_fheight, _ = \
             draw_utils.create_layout_with_font(self.ctx, header_fd)
-        label_layout, label_fascent, label_fheight, label_em = \
+        self._label_layout, self._label_fascent, self._label_fheight, self._label_em = \
             draw_utils.create_layout_with_font(self.ctx, label_column_fd)
-        column_layout, _, _, _ = \
+        self._column_layout, _, _, _ = \
             draw_utils.create_layout_with_font(self.ctx, label_column_fd)
 
-        # By OCitysmap's convention, the default resolution is 72 dpi,
+        # By OCitySMap's convention, the default resolution is 72 dpi,
         # which maps to the default pangocairo resolution (96 dpi
         # according to pangocairo docs). If we want to render with
         # another resolution (different from 72), we have to scale the
         # pangocairo resolution accordingly:
-        PangoCairo.context_set_resolution(column_layout.get_context(),
-                                          96.*dpi/UTILS.PT_PER_INCH)
-        PangoCairo.context_set_resolution(label_layout.get_context(),
-                                          96.*dpi/UTILS.PT_PER_INCH)
-        PangoCairo.context_set_resolution(header_layout.get_context(),
-                                          96.*dpi/UTILS.PT_PER_INCH)
+        for layout in (self._column_layout, self._label_layout,
+                       self._header_layout):
+            PangoCairo.context_set_resolution(layout.get_context(),
+                                              96.*dpi/UTILS.PT_PER_INCH)
+
+    def _set_layout_widths(self, plan):
+        self._column_layout.set_width(int(UTILS.convert_pt_to_dots(
+                    (plan.column_width - plan.margin) * Pango.SCALE, plan.dpi)))
+        self._label_layout.set_width(int(UTILS.convert_pt_to_dots(
+                    (plan.column_width - plan.margin
+                     - plan.max_location_drawing_width - 2 * plan.margin)
+                    * Pango.SCALE, plan.dpi)))
+        self._header_layout.set_width(int(UTILS.convert_pt_to_dots(
+                    (plan.column_width - plan.margin) * Pango.SCALE, plan.dpi)))
+
+    def compute_plan(self, dpi = UTILS.PT_PER_INCH):
+        """
+        Paginate the index.
 
-        margin = label_em
+        Parameters
+        ----------
+           dpi : float
+               Resolution to measure the text at.
+
+        Returns
+        -------
+        MultiPageIndexPlan
+            The pagination, also stored in the plan attribute.
+        """
+        self._create_layouts(dpi)
+        margin = self._label_em
 
         # find largest label and location
         max_label_drawing_width = 0.0
         max_location_drawing_width = 0.0
         for category in self.index_categories:
             for item in category.items:
-                w = item.label_drawing_width(label_layout)
+                w = item.label_drawing_width(self._label_layout)
                 if w > max_label_drawing_width:
                     max_label_drawing_width = w
 
-                w = item.location_drawing_width(label_layout)
+                w = item.location_drawing_width(self._label_layout)
                 if w > max_location_drawing_width:
                     max_location_drawing_width = w
 
-        # No street to render, bail out
+        self.plan = plan = MultiPageIndexPlan(dpi, margin)
+
+        # No street to render, no index pages
         if max_label_drawing_width == 0.0:
-            return
+            return plan
 
         # Find best number of columns
         max_drawing_width = \
@@ -1081,84 +1649,121 @@ class MultiPageIndexRenderer:
             columns_count = 1
 
         # We have now have several columns
-        column_width = self.rendering_area_w / columns_count
-
-        column_layout.set_width(int(UTILS.convert_pt_to_dots(
-                    (column_width - margin) * Pango.SCALE, dpi)))
-        label_layout.set_width(int(UTILS.convert_pt_to_dots(
-                    (column_width - margin - max_location_drawing_width
-                     - 2 * label_em)
-                    * Pango.SCALE, dpi)))
-        header_layout.set_width(int(UTILS.convert_pt_to_dots(
-                    (column_width - margin) * Pango.SCALE, dpi)))
+        plan.column_width = self.rendering_area_w / columns_count
+        plan.max_location_drawing_width = max_location_drawing_width
+        self._set_layout_widths(plan)
 
         if not self._i18n.isrtl():
             orig_offset_x = offset_x = margin/2.
-            orig_delta_x  = delta_x  = column_width
+            delta_x = plan.column_width
         else:
             orig_offset_x = offset_x = \
-                self.rendering_area_w - column_width + margin/2.
-            orig_delta_x  = delta_x  = - column_width
+                self.rendering_area_w - plan.column_width + margin/2.
+            delta_x = - plan.column_width
 
         actual_n_cols = 0
         offset_y = margin/2.
 
-        self._new_page()
+        page = []
+        plan.pages.append(page)
 
-        for category in self.index_categories:
-            if ( offset_y + header_fheight + label_fheight
-                 + margin/2. > max_drawing_height ):
-                offset_y       = margin/2.
-                offset_x      += delta_x
-                actual_n_cols += 1
+        def next_column():
+            nonlocal page, actual_n_cols, offset_x, offset_y
 
-                if actual_n_cols == columns_count:
-                    self._new_page()
-                    actual_n_cols = 0
-                    offset_y = margin / 2.
-                    offset_x = orig_offset_x
-                    delta_x  = orig_delta_x
+            offset_y       = margin/2.
+            offset_x      += delta_x
+            actual_n_cols += 1
 
-            height = category.draw(self._i18n.isrtl(), self.ctx, pc, header_layout,
-                                   UTILS.convert_pt_to_dots(header_fascent, dpi),
-                                   UTILS.convert_pt_to_dots(header_fheight, dpi),
-                                   UTILS.convert_pt_to_dots(self.rendering_area_x
-                                                            + offset_x, dpi),
-                                   UTILS.convert_pt_to_dots(self.rendering_area_y
-                                                            + offset_y
-                                                            + header_fascent, dpi))
+            if actual_n_cols == columns_count:
+                page = []
+                plan.pages.append(page)
+                actual_n_cols = 0
+                offset_x = orig_offset_x
 
+        for category in self.index_categories:
+            if ( offset_y + self._header_fheight + self._label_fheight
+                 + margin/2. > max_drawing_height ):
+                next_column()
+
+            height = category.drawing_height(self._header_layout)
+            page.append((category, None, offset_x, offset_y, height))
             offset_y += height
 
             for item in category.items:
-                label_height = item.label_drawing_height(label_layout)
-                if ( offset_y + label_height + margin/2.
+                height = item.label_drawing_height(self._label_layout)
+                if ( offset_y + height + margin/2.
                      > max_drawing_height ):
-                    offset_y       = margin/2.
-                    offset_x      += delta_x
-                    actual_n_cols += 1
+                    next_column()
+
+                page.append((category, item, offset_x, offset_y, height))
+                offset_y += height
 
-                    if actual_n_cols == columns_count:
-                        self._new_page()
-                        actual_n_cols = 0
-                        offset_y = margin / 2.
-                        offset_x = orig_offset_x
-                        delta_x  = orig_delta_x
-
-                item.draw(self._i18n.isrtl(), self.ctx, pc, column_layout,
-                            UTILS.convert_pt_to_dots(label_fascent, dpi),
-                            UTILS.convert_pt_to_dots(label_fheight, dpi),
-                            UTILS.convert_pt_to_dots(self.rendering_area_x
-                                                     + offset_x, dpi),
-                            UTILS.convert_pt_to_dots(self.rendering_area_y
-                                                     + offset_y
-                                                     + label_fascent, dpi),
-                            label_layout,
-                            UTILS.convert_pt_to_dots(label_height, dpi),
-                            UTILS.convert_pt_to_dots(max_location_drawing_width,
-                                                     dpi))
-
-                offset_y += label_height
+        return plan
 
+    def render(self, dpi = UTILS.PT_PER_INCH, pages = None):
+        """
+        Render index pages, computing the plan first if needed.
+
+        Parameters
+        ----------
+           dpi : float
+               Output resolution.
+           pages : iterable of int, optional
+               Numbers of the index pages to render, starting at 0.
+               All pages by default.
+        """
+        if self.plan is None or self.plan.dpi != dpi:
+            self.compute_plan(dpi)
+        else:
+            self._create_layouts(dpi)
+            self._set_layout_widths(self.plan)
+
+        plan = self.plan
+        if pages is None:
+            pages = range(plan.page_count)
+
+        self.ctx.save()
+
+        LOG.warning("render multipage index")
+
+        # Create a PangoCairo context for drawing to Cairo
+        pc = draw_utils.create_pango_context(self.ctx)
+        rtl = self._i18n.isrtl()
+
+        label_fascent = UTILS.convert_pt_to_dots(self._label_fascent, dpi)
+        label_fheight = UTILS.convert_pt_to_dots(self._label_fheight, dpi)
+        header_fascent = UTILS.convert_pt_to_dots(self._header_fascent, dpi)
+        header_fheight = UTILS.convert_pt_to_dots(self._header_fheight, dpi)
+
+        items = IndexItemBatch(rtl, self.ctx, pc, self._column_layout,
+                               label_fascent, label_fheight,
+                               self._label_layout,
+                               UTILS.convert_pt_to_dots(plan.max_location_drawing_width,
+                                                        dpi))
+
+        for index_page_num in pages:
+            self._new_page(index_page_num)
+
+            for category, item, offset_x, offset_y, height \
+                    in plan.pages[index_page_num]:
+                if item is None:
+                    category.draw(rtl, self.ctx, pc, self._header_layout,
+                                  header_fascent, header_fheight,
+                                  UTILS.convert_pt_to_dots(self.rendering_area_x
+                                                           + offset_x, dpi),
+                                  UTILS.convert_pt_to_dots(self.rendering_area_y
+                                                           + offset_y
+                                                           + self._header_fascent, dpi))
+                else:
+                    items.add(item,
+                              UTILS.convert_pt_to_dots(self.rendering_area_x
+                                                       + offset_x, dpi),
+                              UTILS.convert_pt_to_dots(self.rendering_area_y
+                                                       + offset_y
+                                                       + self._label_fascent, dpi),
+                              UTILS.convert_pt_to_dots(height, dpi))
+
+            items.flush()
+            self.surface.show_page()
 
         self.ctx.restore()
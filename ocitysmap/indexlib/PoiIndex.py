@@ -29,7 +29,7 @@ import gi
 gi.require_version('Rsvg', '2.0')
 gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
-from gi.repository import Rsvg, Pango, PangoCairo
+from gi.repository import Pango, PangoCairo
 import codecs
 import json
 from colour import Color
@@ -40,6 +40,7 @@ import ocitysmap
 import ocitysmap.layoutlib.commons as UTILS
 from ocitysmap.layoutlib.abstract_renderer import Renderer
 import draw_utils
+from ocitysmap import asset_cache
 
 from .commons import IndexCategory, IndexItem, IndexDoesNotFitError 
 from .renderer import IndexRenderingArea
@@ -198,17 +199,12 @@ class PoiIndexRenderer:
                 os.path.dirname(__file__), '..', '..', 'templates', 'poi_markers', 'Font-Awesome-SVG-PNG', 'white', 'svg', logo + '.svg'))
 
             if os.path.isfile(logo_path):
-                rsvg = Rsvg.Handle()
-                svg = rsvg.new_from_file(logo_path)
+                svg = asset_cache.get_svg_handle(logo_path)
 
                 scale = dpi * 0.6 / svg.props.height;
                 x += svg.props.width * scale + 10*f
 
-                ctx.save()
-                ctx.translate(5*f, 5*f)
-                ctx.scale(scale, scale)
-                svg.render_cairo(ctx)
-                ctx.restore()
+                asset_cache.paint_svg(ctx, logo_path, 5*f, 5*f, scale=scale)
             else:
                 LOG.warning("icon not found %s" % logo_path)
 
@@ -239,29 +235,15 @@ class PoiIndexRenderer:
         # find the marker icon
         marker_path = os.path.abspath(os.path.join(
             os.path.dirname(__file__), '..', '..', 'images', 'marker.svg'))
-        fp = open(marker_path,'r')
-        data = fp.read()
-        fp.close()
-
-        # replace black with the actual marker color
-        if color[0] != '#':
-            c = Color(color);
-            color = c.hex_l
-        data = data.replace('#000000', color)
-
-        # create actual SVG marker
-        rsvg = Rsvg.Handle()
-        svg = rsvg.new_from_data(data.encode())
+        # get the SVG marker with black replaced by the actual marker color
+        svg = asset_cache.get_svg_handle(marker_path, color)
 
         # scale the marker to correct size
         scale = 50.0 * f/ svg.props.height;
         x += 35*f
 
         # draw the marker
-        ctx.save()
-        ctx.scale(scale, scale)
-        svg.render_cairo(ctx)
-        ctx.restore()
+        asset_cache.paint_svg(ctx, marker_path, 0, 0, color=color, scale=scale)
 
         # put the marker number into the center of the marker circle
         ctx.save()
@@ -281,16 +263,11 @@ class PoiIndexRenderer:
                 os.path.dirname(__file__), '..', '..', 'templates', 'poi_markers', 'Font-Awesome-SVG-PNG', 'black', 'svg', logo + '.svg'))
 
             if os.path.isfile(logo_path):
-                rsvg = Rsvg.Handle()
-                svg = rsvg.new_from_file(logo_path)
+                svg = asset_cache.get_svg_handle(logo_path)
 
                 scale = min(dpi * 0.6 / svg.props.height, dpi * 0.6 / svg.props.width);
 
-                ctx.save()
-                ctx.translate(x + 5, 5*f)
-                ctx.scale(scale, scale)
-                svg.render_cairo(ctx)
-                ctx.restore()
+                asset_cache.paint_svg(ctx, logo_path, x + 5, 5*f, scale=scale)
                 
                 x += svg.props.width * scale + 10*f
             else:
@@ -66,10 +66,9 @@ class StreetIndex(GeneralIndex):
         GeneralIndex.__init__(self, db, renderer, bbox, polygon_wkt, i18n, page_number)
 
         # Build the contents of the index
-        self._categories = \
-            (self._list_streets(db)
-             + self._list_amenities(db)
-             + self._list_villages(db))
+        self._categories = self._run_concurrently(db, [self._list_streets,
+                                                       self._list_amenities,
+                                                       self._list_villages])
 
     def _get_selected_amenities(self):
         """
@@ -166,10 +165,10 @@ class StreetIndex(GeneralIndex):
                 raise
             endpoint1 = ocitysmap.coords.Point(s_endpoint1[1], s_endpoint1[0])
             endpoint2 = ocitysmap.coords.Point(s_endpoint2[1], s_endpoint2[0])
-            current_category.items.append(GeneralIndexItem(street_name,
-                                                           endpoint1,
-                                                           endpoint2,
-                                                           self._page_number))
+            item = GeneralIndexItem(street_name, endpoint1, endpoint2,
+                                    self._page_number)
+            current_category.items.append(item)
+            self._check_extent(item, linestring)
 
         return result
 
@@ -191,7 +190,7 @@ class StreetIndex(GeneralIndex):
         query = self._build_query(["line"], ["name"], "TRIM(name) != '' AND highway IS NOT NULL", True)
         self._run_query(cursor, query)
 
-        sl = cursor.fetchall()
+        sl = self._fetch_rows(cursor)
 
         LOG.debug("Got %d streets." % len(sl))
 
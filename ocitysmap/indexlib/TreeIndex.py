@@ -39,6 +39,9 @@ class TreeIndex(GeneralIndex):
     name = "Tree"
     description = gettext(u"Tree genus / species index")
 
+    # trees are single points, no need for anything more elaborate
+    EXTENT_STRATEGY = 'bbox'
+
     def __init__(self, db, renderer, bbox, polygon_wkt, i18n, page_number=None):
         GeneralIndex.__init__(self, renderer, db, bbox, polygon_wkt, i18n, page_number)
         
@@ -24,6 +24,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import threading
 import gi
 gi.require_version('Pango', '1.0')
 from gi.repository import GObject, Pango
@@ -37,6 +38,8 @@ import draw_utils
 
 from colour import Color
 
+from . import export
+
 class IndexEmptyError(Exception):
     """This exception is raised when no data is to be rendered in the index."""
     pass
@@ -46,6 +49,70 @@ class IndexDoesNotFitError(Exception):
     graphical area, even after trying smaller font sizes."""
     pass
 
+class JobIndex:
+    """
+    The index of a rendering job, shared by all its output formats.
+
+    The first renderer of a job stores the index it built on the
+    RenderingConfiguration, together with any layout data that only
+    depends on the index. Renderers of the following output formats
+    reuse both. The first call to finalize() maps the index onto the
+    grid and writes the CSV export, later calls do nothing.
+    """
+
+    def __init__(self, index=None, categories=None, layout=None):
+        """
+        Parameters
+        ----------
+        index : GeneralIndex or PoiIndex, optional
+            The index, still to be mapped onto the grid.
+        categories : list of IndexCategory, optional
+            Categories already mapped onto their grids, when there is
+            no single index object, as for multi-page layouts.
+        layout : optional
+            Renderer specific data, e.g. the precomputed index area.
+        """
+        self.index       = index
+        self.layout      = layout
+        self._categories = categories
+        self._finalized  = False
+        self._lock       = threading.Lock()
+
+    @property
+    def categories(self):
+        if self.index is not None:
+            return self.index.categories
+        return self._categories or []
+
+    def finalize(self, grid, title, csv_filename):
+        """Map the index onto the grid and write it to a CSV file, once.
+
+        Parameters
+        ----------
+        grid : ocitysmap.Grid
+            Grid of the map, None if the categories are already mapped.
+        title : str
+            Map title for the CSV file, may be None.
+        csv_filename : str
+            Path of the CSV file to write.
+
+        Returns
+        -------
+        void
+        """
+        with self._lock:
+            if self._finalized:
+                return
+
+            if self.index is not None:
+                if grid is not None:
+                    self.index.apply_grid(grid)
+                self.index.write_to_csv(title, csv_filename)
+            elif self._categories:
+                export.write_csv(self._categories, title, csv_filename)
+
+            self._finalized = True
+
 class IndexCategory:
     """
     The IndexCategory represents a set of index items that belong to the same
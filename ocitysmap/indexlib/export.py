@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Index data exports for downstream tools.
+
+The index can be exported as a CSV file, as a JSON document, and as a
+flat table with one row per index item in the Parquet or Arrow IPC file
+formats. The columnar formats
+require the pyarrow module, see get_available_formats().
+"""
+
+import csv
+import datetime
+import json
+import logging
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOG = logging.getLogger('ocitysmap')
+
+COLUMNAR_FORMATS = ['parquet', 'arrow']
+
+
+def get_available_formats():
+    """Index export formats that can be written.
+
+    Returns
+    -------
+    list of str
+    """
+    formats = ['csv', 'json']
+    if pyarrow is not None:
+        formats.extend(COLUMNAR_FORMATS)
+    return formats
+
+
+def get_copyright_notice():
+    """Copyright notice to ship with exported index data.
+
+    Returns
+    -------
+    str
+    """
+    return (u'© %(year)d MapOSMatic/ocitysmap authors. '
+            u'Map data © %(year)d OpenStreetMap.org '
+            u'and contributors (CC-BY-SA)' %
+            {'year': datetime.date.today().year})
+
+
+def write_csv(categories, title, output_filename):
+    """Write index categories to a CSV file.
+
+    Parameters
+    ----------
+    categories : list of IndexCategory
+        The index, with the grid already applied.
+    title : str
+        Map title, may be None.
+    output_filename : str
+        Path of the file to write to.
+
+    Returns
+    -------
+    void
+    """
+    try:
+        fd = open(output_filename, 'w', encoding='utf-8')
+    except Exception as ex:
+        LOG.warning('error while opening destination file %s: %s'
+                  % (output_filename, ex))
+        return
+
+    LOG.debug("Creating CSV file %s..." % output_filename)
+    writer = csv.writer(fd)
+
+    writer.writerow(['# (UTF-8)', title or '', get_copyright_notice()])
+
+    for category in categories:
+        writer.writerow(['%s' % category.name])
+        for item in category.items:
+            writer.writerow(['', item.label, item.location_str or '???'])
+
+    fd.close()
+
+
+def write_json(categories, title, output_filename):
+    """Write index categories to a JSON document.
+
+    Parameters
+    ----------
+    categories : list of IndexCategory
+        The index, with the grid already applied.
+    title : str
+        Map title, may be None.
+    output_filename : str
+        Path of the file to write to.
+
+    Returns
+    -------
+    void
+    """
+    LOG.debug("Creating JSON file %s..." % output_filename)
+    document = {
+        'title':      title,
+        'copyright':  get_copyright_notice(),
+        'categories': [{'name':  category.name,
+                        'items': [_item_dict(item) for item in category.items]}
+                       for category in categories],
+    }
+    with open(output_filename, 'w', encoding='utf-8') as fd:
+        json.dump(document, fd, ensure_ascii=False, indent=1)
+
+
+def write_table(categories, title, output_filename, output_format):
+    """Write index categories as a table with one row per index item.
+
+    Parameters
+    ----------
+    categories : list of IndexCategory
+        The index, with the grid already applied.
+    title : str
+        Map title, stored in the table metadata, may be None.
+    output_filename : str
+        Path of the file to write to.
+    output_format : str
+        One of COLUMNAR_FORMATS.
+
+    Returns
+    -------
+    void
+    """
+    if pyarrow is None:
+        LOG.warning("pyarrow module not installed, can't write %s"
+                    % output_filename)
+        return
+
+    columns = {'category': [], 'label': [], 'location': [], 'page': []}
+    for category in categories:
+        for item in category.items:
+            columns['category'].append(category.name)
+            columns['label'].append(item.label)
+            columns['location'].append(item.location_str)
+            columns['page'].append(item.page_number)
+
+    table = pyarrow.table({
+        'category': pyarrow.array(columns['category'], pyarrow.string()),
+        'label':    pyarrow.array(columns['label'], pyarrow.string()),
+        'location': pyarrow.array(columns['location'], pyarrow.string()),
+        'page':     pyarrow.array(columns['page'], pyarrow.int32()),
+    })
+    table = table.replace_schema_metadata({
+        'title':     title or '',
+        'copyright': get_copyright_notice(),
+    })
+
+    LOG.debug("Creating %s file %s..." % (output_format, output_filename))
+    if output_format == 'parquet':
+        pyarrow.parquet.write_table(table, output_filename)
+    elif output_format == 'arrow':
+        with pyarrow.OSFile(output_filename, 'wb') as sink, \
+             pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError('Unsupported index export format: %s' % output_format)
+
+
+def _item_dict(item):
+    result = {'label': item.label, 'location': item.location_str}
+    if item.page_number is not None:
+        result['page'] = item.page_number
+    return result
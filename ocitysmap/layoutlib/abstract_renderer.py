@@ -25,10 +25,9 @@
 
 import cairo
 import gi
-gi.require_version('Rsvg', '2.0')
 gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
-from gi.repository import Rsvg, Pango, PangoCairo
+from gi.repository import Pango, PangoCairo
 import logging
 import mapnik
 assert mapnik.mapnik_version() >= 300000, \
@@ -37,22 +36,38 @@ assert mapnik.mapnik_version() >= 300000, \
 import math
 import os
 import re
-import shapely.wkt
 import sys
-from colour import Color
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from babel.dates import format_date
 
 from . import commons
 from ocitysmap.maplib.map_canvas import MapCanvas
 from ocitysmap.maplib.grid import Grid
-from ocitysmap import draw_utils, maplib
+from ocitysmap.maplib.area import get_area_geometry
+from ocitysmap import draw_utils, maplib, asset_cache, coords
+from ocitysmap.indexlib import export as index_export
 
-from pluginbase import PluginBase
+from . import plugin_registry
 
 LOG = logging.getLogger('ocitysmap')
 
+# Background threads running the prepare() phase of render plugins
+MAX_PLUGIN_PREPARE_THREADS = 4
+_plugin_executor = None
+_PLUGIN_DATA_LOCK = threading.Lock()
+
+def _get_plugin_executor():
+    global _plugin_executor
+    with _PLUGIN_DATA_LOCK:
+        if _plugin_executor is None:
+            _plugin_executor = ThreadPoolExecutor(
+                max_workers=MAX_PLUGIN_PREPARE_THREADS,
+                thread_name_prefix='plugin-prepare')
+        return _plugin_executor
+
 
 class Renderer:
     """
@@ -80,6 +95,10 @@ class Renderer:
     # see entities.xml.inc file from osm style sheet
     DEFAULT_SCALE           = 7000000
 
+    # Output formats where map layers can be rasterized, see
+    # RenderingConfiguration.map_raster_dpi
+    HYBRID_OUTPUT_FORMATS = ['pdf', 'ps', 'ps.gz', 'svg', 'svgz']
+
     def __init__(self, db, rc, tmpdir, dpi):
         """
         Create the renderer.
@@ -103,9 +122,8 @@ class Renderer:
         self._title_margin_pt = 0
         self.dpi = dpi
 
-        plugin_path = os.path.abspath(os.path.join(os.path.dirname(__file__), './render_plugins'))
-        self.plugin_base = PluginBase(package='ocitysmap.layout_plugins')
-        self.plugin_source = self.plugin_base.make_plugin_source(searchpath=[plugin_path])
+        # Resolution to rasterize map layers at, see _render_maps()
+        self.map_raster_dpi = rc.map_raster_dpi
 
 
     @staticmethod
@@ -121,23 +139,16 @@ class Renderer:
         Return a tuple (cairo group object for the SVG, SVG width in
                         cairo units).
         """
-        handle = Rsvg.Handle();
         try:
-            svg   = handle.new_from_file(path)
+            svg = asset_cache.get_svg_handle(path)
         except Exception:
             LOG.warning("Cannot read SVG from '%s'." % path)
             return None, None
 
-        scale_factor = height / svg.props.height
-
-        ctx.push_group()
-        ctx.save()
-        ctx.move_to(0, 0)
         factor = height / svg.props.height
-        ctx.scale(factor, factor)
-        svg.render_cairo(ctx)
-        ctx.restore()
-        return ctx.pop_group(), svg.props.width * factor
+        (pattern, width, height) = asset_cache.get_svg_pattern(path, scale=factor)
+
+        return pattern, width
 
     @staticmethod
     def _get_logo(ctx, logo_url, height):
@@ -271,16 +282,18 @@ class Renderer:
                            width, height, dpi)
 
         if draw_contour_shade:
-            # Area to keep visible
-            interior = shapely.wkt.loads(self.rc.polygon_wkt)
+            # Area to keep visible, only as detailed as the canvas
+            # resolution allows
+            area = get_area_geometry(self.rc)
+            tolerance = area.tolerance(canvas.get_actual_bounding_box(),
+                                       canvas.get_width_dots())
 
             # Surroundings to gray-out
             bounding_box \
                 = canvas.get_actual_bounding_box().create_expanded(0.05, 0.05)
-            exterior = shapely.wkt.loads(bounding_box.as_wkt())
 
             # Determine the shade WKT
-            shade_wkt = exterior.difference(interior).wkt
+            shade_wkt = area.get_shade_wkt(bounding_box, tolerance)
 
             # Prepare the shade SHP
             shade_shape = maplib.shapes.PolyShapeFile(
@@ -320,7 +333,106 @@ class Renderer:
                               self.rc.stylesheet.grid_line_width)
 
     def get_plugin(self, plugin_name):
-        return self.plugin_source.load_plugin(plugin_name)
+        """
+        Load a render plugin, and start its prepare() phase if it has one.
+
+        Plugins may define a prepare(renderer) function next to their
+        render() entry point. It is run in the background as soon as
+        the plugin is loaded, and only once per job, as its result is
+        kept on the rendering configuration. render() is then called
+        with this result as third argument, see _render_plugin().
+
+        Args:
+           plugin_name (str): name of the plugin package.
+
+        Return the plugin module.
+        """
+        plugin = plugin_registry.get_registry().get_plugin(plugin_name)
+        if hasattr(plugin, 'prepare'):
+            executor = _get_plugin_executor()
+            with _PLUGIN_DATA_LOCK:
+                plugin_data = self.rc.plugin_data
+                if plugin_name not in plugin_data:
+                    LOG.debug("Preparing plugin %s" % plugin_name)
+                    plugin_data[plugin_name] = \
+                        executor.submit(plugin.prepare, self)
+        return plugin
+
+    def _render_plugin(self, plugin_name, plugin, ctx):
+        """
+        Run a render plugin on the current map canvas.
+
+        Args:
+           plugin_name (str): name of the plugin package.
+           plugin (module): the plugin, as returned by get_plugin().
+           ctx (cairo.Context): the context to draw on.
+
+        Exceptions raised by the plugin's prepare() phase are raised here.
+        """
+        if hasattr(plugin, 'prepare'):
+            with _PLUGIN_DATA_LOCK:
+                future = self.rc.plugin_data[plugin_name]
+            plugin.render(self, ctx, future.result())
+        else:
+            plugin.render(self, ctx)
+
+    def _finalize_index(self, grid=None):
+        """
+        Map the index of the job onto the grid and write its CSV export,
+        if not done yet for another output format of the job, see
+        indexlib.commons.JobIndex.
+
+        Args:
+           grid (Grid): the grid to map the index onto, None if the
+               renderer mapped it already.
+        """
+        if self.rc.job_index is not None:
+            self.rc.job_index.finalize(grid, self.rc.title,
+                                       '%s.csv' % self.file_prefix)
+
+    def _render_maps(self, ctx, rendered_maps, scale_factor=1.0):
+        """
+        Draw Mapnik maps, one on top of the other, with their top left
+        corner at the origin of the context.
+
+        For vector output formats the maps are rasterized at
+        map_raster_dpi and embedded as a single image when it is set,
+        everything else drawn on the page stays vector data.
+
+        Args:
+           ctx (cairo.Context): the context to draw on.
+           rendered_maps (list of mapnik.Map): the map and its overlays.
+           scale_factor (float): Mapnik scale factor for symbols, line
+               widths and labels.
+        """
+        raster_dpi = self.map_raster_dpi
+        if (not raster_dpi or not rendered_maps
+            or self.rc.output_format not in self.HYBRID_OUTPUT_FORMATS):
+            for rendered_map in rendered_maps:
+                mapnik.render(rendered_map, ctx, scale_factor, 0, 0)
+            return
+
+        zoom = raster_dpi / self.dpi
+        width  = max(m.width for m in rendered_maps)
+        height = max(m.height for m in rendered_maps)
+        LOG.debug("Rasterizing %d map layers at %ddpi (%dx%d pixels)"
+                  % (len(rendered_maps), raster_dpi,
+                     math.ceil(width * zoom), math.ceil(height * zoom)))
+
+        image = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                   int(math.ceil(width * zoom)),
+                                   int(math.ceil(height * zoom)))
+        image_ctx = cairo.Context(image)
+        image_ctx.scale(zoom, zoom)
+        for rendered_map in rendered_maps:
+            mapnik.render(rendered_map, image_ctx, scale_factor, 0, 0)
+        image.flush()
+
+        ctx.save()
+        ctx.scale(1 / zoom, 1 / zoom)
+        ctx.set_source_surface(image, 0, 0)
+        ctx.paint()
+        ctx.restore()
 
     # The next two methods are to be overloaded by the actual renderer.
     def render(self, cairo_surface, dpi):
@@ -335,7 +447,7 @@ class Renderer:
 
     @staticmethod
     def get_compatible_output_formats():
-        return [ "png", "svgz", "pdf", "csv" ]
+        return [ "png", "svgz", "pdf", "dzi" ] + index_export.get_available_formats()
 
     def _has_multipage_format(self):
         if self.rc.output_format == 'pdf':
@@ -411,44 +523,56 @@ class Renderer:
 
     # convert geo into pixel coordinates for direct rendering of geo features
     # mostly needed by rendering overlay plugins
-    def _latlon2xy(self, lat, lon, dpi = None):
+    def latlon_to_xy(self, lats, lons, dpi = None):
+        """
+        Convert geographic coordinates into page coordinates.
+
+        The coordinates are projected to spherical Mercator, just like
+        Mapnik does when drawing the map, so that points end up at the
+        same position as the map features they belong to.
+
+        Args:
+           lats (sequence of float): latitudes (WGS84).
+           lons (sequence of float): longitudes (WGS84).
+           dpi (number): output resolution, defaults to the renderer's.
+
+        Return a tuple (xs, ys) of numpy arrays with the page coordinates
+        of the points, relative to the current map canvas.
+        """
         if dpi is None:
             dpi = self.dpi
 
-        bbox = self._map_canvas.get_actual_bounding_box()
+        proj = coords.get_projection()
+        envelope = proj.project_bbox(self._map_canvas.get_actual_bounding_box())
+        (merc_xs, merc_ys) = proj.forward(lons, lats)
+
+        factor = dpi / 72.0
 
-        vert_angle_span  = abs(bbox.get_top_left()[1] - bbox.get_bottom_right()[1])
-        horiz_angle_span = abs(bbox.get_top_left()[0] - bbox.get_bottom_right()[0])
+        xs = (merc_xs - envelope.minx) / (envelope.maxx - envelope.minx)
+        xs = (xs * self._map_coords[2] + self._map_coords[0]) * factor
 
-        y = bbox.get_top_left()[0] - lat
-        y*= (dpi/72.0) * self._map_coords[3] / horiz_angle_span
-        y+= (dpi/72.0) * self._map_coords[1]
+        ys = (envelope.maxy - merc_ys) / (envelope.maxy - envelope.miny)
+        ys = (ys * self._map_coords[3] + self._map_coords[1]) * factor
 
-        x = lon - bbox.get_top_left()[1]
-        x*= (dpi/72.0) * self._map_coords[2] / vert_angle_span
-        x+= (dpi/72.0) * self._map_coords[0]
+        return xs, ys
 
-        return x,y
+    def _latlon2xy(self, lat, lon, dpi = None):
+        xs, ys = self.latlon_to_xy([lat], [lon], dpi)
+        return float(xs[0]), float(ys[0])
 
     def _marker(self, color, txt, lat, lon, ctx, dpi):
+        x,y = self._latlon2xy(lat, lon, dpi)
+        self._marker_at(color, txt, x, y, ctx, dpi)
 
+    def _marker_at(self, color, txt, x, y, ctx, dpi):
+        """
+        Draw a marker with its tip at the given page coordinates, see
+        latlon_to_xy().
+        """
         marker_path = os.path.abspath(os.path.join(
             os.path.dirname(__file__), '..', '..', 'images', 'marker.svg'))
 
-        fp = open(marker_path,'r')
-        data = fp.read()
-        fp.close()
-
-        if color[0] != '#':
-            c = Color(color);
-            color = c.hex_l
-
-        data = data.replace('#000000', color)
-
-        rsvg = Rsvg.Handle()
-        svg = rsvg.new_from_data(data.encode())
-
-        x,y = self._latlon2xy(lat, lon, dpi)
+        svg = asset_cache.get_svg_handle(marker_path, color)
 
         scale = (50.0  / svg.props.height) * (dpi / 72.0)
 
@@ -458,11 +582,11 @@ class Renderer:
         ctx.save()
         ctx.translate(x, y)
 
+        asset_cache.paint_svg(ctx, marker_path, 0, 0, color=color, scale=scale)
         ctx.scale(scale, scale)
-        svg.render_cairo(ctx)
 
-        pc = PangoCairo.create_context(ctx)
-        layout = PangoCairo.create_layout(ctx)
+        pc = draw_utils.create_pango_context(ctx)
+        layout = draw_utils.create_layout(ctx)
         fd = Pango.FontDescription('Droid Sans')
         fd.set_size(Pango.SCALE)
         layout.set_font_description(fd)
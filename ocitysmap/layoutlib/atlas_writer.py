@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Streaming writer for multi-page PDF documents.
+
+The document is split in parts that are rendered into separate PDF files,
+possibly in parallel, and then merged into the final document. Each part
+only keeps the resources of its own pages in memory while it is rendered.
+
+Merging requires the pypdf module, see is_available(). Named destinations
+(see draw_utils.anchor()) and page labels of the parts are carried over
+to the merged document, so that internal links between pages of
+different parts keep working.
+"""
+
+import cairo
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+LOG = logging.getLogger('ocitysmap')
+
+
+def is_available():
+    """Whether streaming PDF output is possible at all.
+
+    Returns
+    -------
+    bool
+        True if the pypdf module needed to merge the parts is installed.
+    """
+    return pypdf is not None
+
+
+class AtlasWriter:
+    """
+    Renders a multi-page PDF document part by part.
+
+    Parts are added with add_part() as functions drawing one or more pages
+    on a given cairo context and surface. write() renders all parts into
+    temporary PDF files and merges them, in the order they were added,
+    into the final document.
+    """
+
+    def __init__(self, tmpdir, width_pt, height_pt, threads=1):
+        """
+        Parameters
+        ----------
+           tmpdir : str
+               Directory for the temporary part files.
+           width_pt : float
+               Page width.
+           height_pt : float
+               Page height.
+           threads : int
+               Number of parts to render at the same time. Mapnik and
+               cairo release the GIL while rendering, so threads are
+               enough to make use of several cores.
+        """
+        self._tmpdir    = tmpdir
+        self._width_pt  = width_pt
+        self._height_pt = height_pt
+        self._threads   = max(1, threads)
+        self._parts     = []
+
+    def add_part(self, render_func):
+        """Add a part to the document.
+
+        Parameters
+        ----------
+           render_func : callable
+               Called as render_func(ctx, surface) to draw the pages of the
+               part, it is in charge of calling surface.show_page() for
+               each of them. Functions of different parts may run at the
+               same time in different threads.
+        """
+        filename = os.path.join(self._tmpdir,
+                                'atlas-part-%03d.pdf' % len(self._parts))
+        self._parts.append((filename, render_func))
+
+    def _render_part(self, part):
+        (filename, render_func) = part
+        surface = cairo.PDFSurface(filename, self._width_pt, self._height_pt)
+        surface.restrict_to_version(cairo.PDFVersion.VERSION_1_5)
+        ctx = cairo.Context(surface)
+        render_func(ctx, surface)
+        surface.finish()
+        LOG.debug("Wrote atlas part %s" % filename)
+        return filename
+
+    def write(self, output_filename, metadata=None):
+        """Render all parts and merge them into the final document.
+
+        Parameters
+        ----------
+           output_filename : str
+               Path of the PDF document to create.
+           metadata : dict of str => str
+               Document information, e.g. {'Title': 'Paris'}.
+        """
+        if self._threads > 1 and len(self._parts) > 1:
+            with ThreadPoolExecutor(max_workers=self._threads) as executor:
+                filenames = list(executor.map(self._render_part, self._parts))
+        else:
+            filenames = [self._render_part(part) for part in self._parts]
+
+        self._merge(filenames, output_filename, metadata)
+
+        for filename in filenames:
+            os.remove(filename)
+
+    def _merge(self, filenames, output_filename, metadata):
+        writer = pypdf.PdfWriter()
+        named_dests = []
+        page_labels = []
+
+        for filename in filenames:
+            reader = pypdf.PdfReader(filename)
+            page_offset = len(writer.pages)
+
+            for page in reader.pages:
+                writer.add_page(page)
+
+            for name, dest in reader.named_destinations.items():
+                named_dests.append(
+                    (name, page_offset + reader.get_destination_page_number(dest)))
+
+            try:
+                page_labels.extend(reader.page_labels)
+            except AttributeError:
+                page_labels.extend([None] * len(reader.pages))
+
+        # Links are written by cairo as references to named destinations,
+        # recreate all of them in the merged document
+        for name, page_number in named_dests:
+            writer.add_named_destination(name, page_number)
+
+        try:
+            for page_number, label in enumerate(page_labels):
+                if label:
+                    writer.set_page_label(page_number, page_number,
+                                          prefix=label)
+        except AttributeError:
+            LOG.warning("Installed pypdf version does not support page labels")
+
+        if metadata:
+            writer.add_metadata(dict([('/%s' % key, value)
+                                      for key, value in metadata.items()]))
+
+        with open(output_filename, 'wb') as f:
+            writer.write(f)
+
+        LOG.info("Merged %d atlas parts into %s" %
+                 (len(filenames), output_filename))
@@ -50,16 +50,20 @@ from gettext import gettext
 import ocitysmap
 import coords
 from . import commons
+from . import atlas_writer
 from ocitysmap.layoutlib.abstract_renderer import Renderer
 from ocitysmap.indexlib.GeneralIndex import GeneralIndex, GeneralIndexCategory, MultiPageIndexRenderer
 from ocitysmap.indexlib.StreetIndex import StreetIndex
 from ocitysmap.indexlib.HealthIndex import HealthIndex
 from ocitysmap.indexlib.NotesIndex import NotesIndex
 from ocitysmap.indexlib.TreeIndex import TreeIndex
+from ocitysmap.indexlib.commons import JobIndex
 from ocitysmap import draw_utils, maplib
 from ocitysmap.maplib.map_canvas import MapCanvas
 from ocitysmap.maplib.grid import Grid
+from ocitysmap.maplib.area import get_area_geometry
 from ocitysmap.maplib.overview_grid import OverviewGrid
+from ocitysmap.maplib.page_selection import compute_page_disposition, count_selected_pages, SelectionTarget
 from ocitysmap.stylelib import GpxStylesheet, UmapStylesheet
 
 LOG = logging.getLogger('ocitysmap')
@@ -81,6 +85,90 @@ def font_extents(ctx, font_face, font_size):
     ctx.set_font_size (font_size)
     return ctx.font_extents ()
 
+class PageGridLayout:
+    """
+    A grid of overlapping atlas pages covering an area, in Mercator
+    meters, at a given scale.
+    """
+
+    def __init__(self, scale_denom, usable_width_pt, usable_height_pt,
+                 nb_pages_width, nb_pages_height, off_x, off_y,
+                 width, height, grayed_margin_mm, overlap_margin_mm):
+        self.scale_denom      = scale_denom
+        self.usable_width_pt  = usable_width_pt
+        self.usable_height_pt = usable_height_pt
+        self.nb_pages_width   = nb_pages_width
+        self.nb_pages_height  = nb_pages_height
+        self.off_x  = off_x
+        self.off_y  = off_y
+        self.width  = width
+        self.height = height
+
+        # number of pages actually printed, set by the layout optimiser
+        self.nb_pages = nb_pages_width * nb_pages_height
+
+        # Convert the usable area on each sheet of paper into the
+        # amount of Mercator meters we can render in this area.
+        self.usable_area_merc_m_width  = commons.convert_pt_to_mm(usable_width_pt) * scale_denom / 1000
+        self.usable_area_merc_m_height = commons.convert_pt_to_mm(usable_height_pt) * scale_denom / 1000
+        self.grayed_margin_merc_m      = (grayed_margin_mm * scale_denom) / 1000
+        self.overlap_margin_merc_m     = (overlap_margin_mm * scale_denom) / 1000
+
+    def get_envelope(self):
+        """Return the mapnik.Box2d covered by the whole grid."""
+        return mapnik.Box2d(self.off_x, self.off_y,
+                            self.off_x + self.width, self.off_y + self.height)
+
+    def get_page_envelopes(self):
+        """
+        Return the page envelopes, one list per grid row from top to
+        bottom, each one listing (envelope, inner envelope) pairs of
+        mapnik.Box2d from left to right, the inner envelope excluding
+        the grayed margin.
+        """
+        rows = []
+        for j in reversed(range(0, self.nb_pages_height)):
+            row = []
+            for i in range(0, self.nb_pages_width):
+                cur_x = self.off_x + i * (self.usable_area_merc_m_width - self.overlap_margin_merc_m)
+                cur_y = self.off_y + j * (self.usable_area_merc_m_height - self.overlap_margin_merc_m)
+                envelope = mapnik.Box2d(cur_x, cur_y,
+                                        cur_x + self.usable_area_merc_m_width,
+                                        cur_y + self.usable_area_merc_m_height)
+
+                envelope_inner = mapnik.Box2d(cur_x + self.grayed_margin_merc_m,
+                                              cur_y + self.grayed_margin_merc_m,
+                                              cur_x + self.usable_area_merc_m_width  - self.grayed_margin_merc_m,
+                                              cur_y + self.usable_area_merc_m_height - self.grayed_margin_merc_m)
+                row.append((envelope, envelope_inner))
+            rows.append(row)
+        return rows
+
+class MapPage:
+    """
+    Lightweight description of an atlas map page. The Mapnik canvases
+    needed to render it are only created at rendering time.
+    """
+
+    def __init__(self, number, bbox, bbox_inner, grid):
+        """
+        Parameters
+        ----------
+           number : int
+               Map page number, counted from 0.
+           bbox : coords.BoundingBox
+               Area rendered on the page, including the grayed margin.
+           bbox_inner : coords.BoundingBox
+               Area rendered on the page without the grayed margin.
+           grid : Grid
+               The grid of the page.
+        """
+        self.number     = number
+        self.bbox       = bbox
+        self.bbox_inner = bbox_inner
+        self.grid       = grid
+
+
 class MultiPageRenderer(Renderer):
     """
     This Renderer creates a multi-pages map, with all the classic overlayed
@@ -101,6 +189,32 @@ class MultiPageRenderer(Renderer):
     DEFAULT_MULTIPAGE_SCALE = 4200
     MAX_MULTIPAGE_MAPPAGES  = 50
 
+    GRAYED_MARGIN_MM  = 10
+    OVERLAP_MARGIN_MM = 20
+
+    # Streaming PDF output, see render_pdf_file()
+    ATLAS_CHUNK_PAGES    = 10
+    ATLAS_RENDER_THREADS = min(4, os.cpu_count() or 1)
+
+    # Page layout optimisation: the scale is searched by bisection until
+    # it is within SCALE_SEARCH_PRECISION of the smallest scale that
+    # needs less than MAX_MULTIPAGE_MAPPAGES printed pages. For each
+    # candidate scale the grid can be shifted around the area to save
+    # pages, and the map pages can be rotated by 90 degrees if that
+    # allows for a more detailed scale or fewer pages.
+    SCALE_SEARCH_PRECISION  = 0.02
+    OPTIMIZE_GRID_OFFSETS   = True
+    TRY_BOTH_ORIENTATIONS   = False
+    GRID_OFFSETS = (0.5, 0.0, 0.25, 0.75, 1.0)
+    # grids with more cells than this many times MAX_MULTIPAGE_MAPPAGES
+    # are not shifted around, they won't fit anyway
+    OFFSET_SEARCH_MAX_CELLS_RATIO = 2
+    # printed pages are not even counted for grids with more cells than
+    # this many times MAX_MULTIPAGE_MAPPAGES, if the area covers at
+    # least COUNT_SKIP_MIN_COVERAGE of its bounding box
+    COUNT_SKIP_CELLS_RATIO  = 4
+    COUNT_SKIP_MIN_COVERAGE = 0.5
+
     def __init__(self, db, rc, tmpdir, dpi, file_prefix):
         """
         Create the renderer.
@@ -121,6 +235,8 @@ class MultiPageRenderer(Renderer):
 
         Renderer.__init__(self, db, rc, tmpdir, dpi)
 
+        self.file_prefix = file_prefix
+
         self._grid_legend_margin_pt = \
             min(Renderer.GRID_LEGEND_MARGIN_RATIO * self.paper_width_pt,
                 Renderer.GRID_LEGEND_MARGIN_RATIO * self.paper_height_pt)
@@ -136,8 +252,6 @@ class MultiPageRenderer(Renderer):
                              self._usable_area_width_pt,
                              self._usable_area_height_pt )
 
-        scale_denom = self.DEFAULT_MULTIPAGE_SCALE
-
         # offset to the first map page number
         # there are currently three header pages
         # making the first actual map detail page number 1
@@ -148,99 +262,12 @@ class MultiPageRenderer(Renderer):
         # mercator_meters) so we don't need to take into account
         # latitude in following computations
 
-        # by convention, mapnik uses 90 ppi whereas cairo uses 72 ppi
-        scale_denom *= float(72) / 90
-
-        GRAYED_MARGIN_MM  = 10
-        OVERLAP_MARGIN_MM = 20
+        self.grayed_margin_pt = commons.convert_mm_to_pt(self.GRAYED_MARGIN_MM)
 
         # Convert the original Bounding box into Mercator meters
-        self._proj = mapnik.Projection(coords._MAPNIK_PROJECTION)
+        self._proj = coords.get_projection()
         orig_envelope = self._project_envelope(self.rc.bounding_box)
 
-
-        while True:
-            # Extend the bounding box to take into account the lost outer
-            # margin
-            off_x  = orig_envelope.minx - GRAYED_MARGIN_MM * 9.6
-            off_y  = orig_envelope.miny - GRAYED_MARGIN_MM * 9.6
-            width  = orig_envelope.width() + (2 * GRAYED_MARGIN_MM) * 9.6
-            height = orig_envelope.height() + (2 * GRAYED_MARGIN_MM) * 9.6
-
-            # Calculate the total width and height of paper needed to
-            # render the geographical area at the current scale.
-            total_width_pt   = commons.convert_mm_to_pt(float(width) * 1000 / scale_denom)
-            total_height_pt  = commons.convert_mm_to_pt(float(height) * 1000 / scale_denom)
-            self.grayed_margin_pt = commons.convert_mm_to_pt(GRAYED_MARGIN_MM)
-            overlap_margin_pt = commons.convert_mm_to_pt(OVERLAP_MARGIN_MM)
-
-            # Calculate the number of pages needed in both directions
-            if total_width_pt < self._usable_area_width_pt:
-                nb_pages_width = 1
-            else:
-                nb_pages_width = \
-                    (float(total_width_pt - self._usable_area_width_pt) / \
-                         (self._usable_area_width_pt - overlap_margin_pt)) + 1
-
-            if total_height_pt < self._usable_area_height_pt:
-                nb_pages_height = 1
-            else:
-                nb_pages_height = \
-                    (float(total_height_pt - self._usable_area_height_pt) / \
-                         (self._usable_area_height_pt - overlap_margin_pt)) + 1
-
-            # Round up the number of pages needed so that we have integer
-            # number of pages
-            self.nb_pages_width = int(math.ceil(nb_pages_width))
-            self.nb_pages_height = int(math.ceil(nb_pages_height))
-
-            total_pages = self.nb_pages_width * self.nb_pages_height
-
-            if self.MAX_MULTIPAGE_MAPPAGES and \
-               total_pages < self.MAX_MULTIPAGE_MAPPAGES:
-                break
-
-            new_scale_denom = scale_denom * 1.41
-
-            if new_scale_denom > Renderer.DEFAULT_SCALE:
-                break
-
-            scale_denom = new_scale_denom
-
-
-        # Calculate the entire paper area available
-        total_width_pt_after_extension = self._usable_area_width_pt + \
-            (self._usable_area_width_pt - overlap_margin_pt) * (self.nb_pages_width - 1)
-        total_height_pt_after_extension = self._usable_area_height_pt + \
-            (self._usable_area_height_pt - overlap_margin_pt) * (self.nb_pages_height - 1)
-
-        # Convert this paper area available in the number of Mercator
-        # meters that can be rendered on the map
-        total_width_merc = \
-            commons.convert_pt_to_mm(total_width_pt_after_extension) * scale_denom / 1000
-        total_height_merc = \
-            commons.convert_pt_to_mm(total_height_pt_after_extension) * scale_denom / 1000
-
-        # Extend the geographical boundaries so that we completely
-        # fill the available paper size. We are careful to extend the
-        # boundaries evenly on all directions (so the center of the
-        # previous boundaries remain the same as the new one)
-        off_x -= (total_width_merc - width) / 2
-        width = total_width_merc
-        off_y -= (total_height_merc - height) / 2
-        height = total_height_merc
-
-        # Calculate what is the final global bounding box that we will render
-        envelope = mapnik.Box2d(off_x, off_y, off_x + width, off_y + height)
-        self._geo_bbox = self._inverse_envelope(envelope)
-
-        # Convert the usable area on each sheet of paper into the
-        # amount of Mercator meters we can render in this area.
-        usable_area_merc_m_width  = commons.convert_pt_to_mm(self._usable_area_width_pt) * scale_denom / 1000
-        usable_area_merc_m_height = commons.convert_pt_to_mm(self._usable_area_height_pt) * scale_denom / 1000
-        grayed_margin_merc_m      = (GRAYED_MARGIN_MM * scale_denom) / 1000
-        overlap_margin_merc_m     = (OVERLAP_MARGIN_MM * scale_denom) / 1000
-
         # Prepare overlays for all additional import files
         self._overlays = copy(self.rc.overlays)
         gpx_colors = ['red', 'blue', 'green', 'violet', 'orange']
@@ -275,46 +302,49 @@ class MultiPageRenderer(Renderer):
                 else:
                     LOG.warning("Unsupported file type '%s' for file '%s" % (file_type, import_file))
 
+        # Find the most detailed scale, grid position and page orientation
+        # that gets along with the maximum number of printed pages
+        self._area = get_area_geometry(self.rc)
+        area_polygon = self._area.polygon
+        layout = self._optimize_page_layout(orig_envelope, area_polygon,
+                                            track_linestrings)
+
+        if layout.usable_width_pt != self._usable_area_width_pt:
+            LOG.info("Rotating map pages for a better page layout")
+            self.paper_width_pt, self.paper_height_pt = \
+                self.paper_height_pt, self.paper_width_pt
+            self._usable_area_width_pt, self._usable_area_height_pt = \
+                self._usable_area_height_pt, self._usable_area_width_pt
+            self._map_coords = ( Renderer.PRINT_SAFE_MARGIN_PT,
+                                 Renderer.PRINT_SAFE_MARGIN_PT,
+                                 self._usable_area_width_pt,
+                                 self._usable_area_height_pt )
+
+        LOG.info("Multi-page layout: scale 1/%d, %dx%d grid" %
+                 (layout.scale_denom * 90 / 72, layout.nb_pages_width,
+                  layout.nb_pages_height))
+
+        self.nb_pages_width  = layout.nb_pages_width
+        self.nb_pages_height = layout.nb_pages_height
+
+        # Calculate what is the final global bounding box that we will render
+        self._geo_bbox = self._inverse_envelope(layout.get_envelope())
 
         # Calculate all the bounding boxes that correspond to the
         # geographical area that will be rendered on each sheet of
         # paper.
-        area_polygon = shapely.wkt.loads(self.rc.polygon_wkt)
+        pages_bboxes = self._inverse_page_envelopes(layout)
+
+        self.page_disposition = compute_page_disposition(
+            [[bb_inner for bb, bb_inner in row] for row in pages_bboxes],
+            area_polygon, track_linestrings)
+
         bboxes = []
-        self.page_disposition = {}
-        map_number = 0
-        for j in reversed(range(0, self.nb_pages_height)):
-            col = self.nb_pages_height - j - 1
-            self.page_disposition[col] = []
-            for i in range(0, self.nb_pages_width):
-                cur_x = off_x + i * (usable_area_merc_m_width - overlap_margin_merc_m)
-                cur_y = off_y + j * (usable_area_merc_m_height - overlap_margin_merc_m)
-                envelope = mapnik.Box2d(cur_x, cur_y,
-                                        cur_x+usable_area_merc_m_width,
-                                        cur_y+usable_area_merc_m_height)
-
-                envelope_inner = mapnik.Box2d(cur_x + grayed_margin_merc_m,
-                                              cur_y + grayed_margin_merc_m,
-                                              cur_x + usable_area_merc_m_width  - grayed_margin_merc_m,
-                                              cur_y + usable_area_merc_m_height - grayed_margin_merc_m)
-                inner_bb = self._inverse_envelope(envelope_inner)
-                inner_bb_shp = shapely.wkt.loads(inner_bb.as_wkt())
-                show_page = False
-                if len(track_linestrings) > 0:
-                    for l in track_linestrings:
-                        if l.intersects(inner_bb_shp):
-                            show_page = True
-                            break
-                elif not area_polygon.disjoint(inner_bb_shp):
-                    show_page = True
-
-                if show_page:
-                    self.page_disposition[col].append(map_number)
-                    map_number += 1
-                    bboxes.append((self._inverse_envelope(envelope),
-                                   inner_bb))
-                else:
-                    self.page_disposition[col].append(None)
+        for row, row_bboxes in enumerate(pages_bboxes):
+            for col, page_bboxes in enumerate(row_bboxes):
+                if self.page_disposition[row][col] is not None:
+                    bboxes.append(page_bboxes)
+        LOG.info("Multi-page layout: %d pages" % len(bboxes))
 
         self.pages = []
 
@@ -335,10 +365,11 @@ class MultiPageRenderer(Renderer):
                                extend_bbox_to_ratio=True)
 
         # Create the gray shape around the overview map
-        exterior = shapely.wkt.loads(self.overview_canvas.get_actual_bounding_box()\
-                                                                .as_wkt())
-        interior = shapely.wkt.loads(self.rc.polygon_wkt)
-        shade_wkt = exterior.difference(interior).wkt
+        overview_bb = self.overview_canvas.get_actual_bounding_box()
+        shade_wkt = self._area.get_shade_wkt(
+            overview_bb,
+            self._area.tolerance(overview_bb,
+                                 self.overview_canvas.get_width_dots()))
         shade = maplib.shapes.PolyShapeFile(self.rc.bounding_box,
                 os.path.join(self.tmpdir, 'shape_overview.shp'),
                              'shade-overview')
@@ -376,78 +407,40 @@ class MultiPageRenderer(Renderer):
                 ov_canvas.render()
                 self.overview_overlay_canvases.append(ov_canvas)
 
-        # Create the map canvas for each page
+        # Plugin effects to apply on each map page
+        self._page_overlay_effects = {}
+        for overlay in self._overlays:
+            path = overlay.path.strip()
+            if path.startswith('internal:'):
+                plugin_name = path.lstrip('internal:')
+                if plugin_name != 'qrcode':
+                    # ignore QRcode plugin
+                    self._page_overlay_effects[plugin_name] = self.get_plugin(plugin_name)
+
+        # Describe each map page, the Mapnik canvases are only created
+        # when actually rendering the page, see _create_page_canvases()
+        # The merged index of all pages is shared by all output formats
+        # of the job, see JobIndex
+        job_index = self.rc.job_index
         indexes = []
         for i, (bb, bb_inner) in enumerate(bboxes):
-
-            # Create the gray shape around the map
-            exterior = shapely.wkt.loads(bb.as_wkt())
-            interior = shapely.wkt.loads(bb_inner.as_wkt())
-            shade_wkt = exterior.difference(interior).wkt
-            shade = maplib.shapes.PolyShapeFile(
-                bb, os.path.join(self.tmpdir, 'shade%d.shp' % i),
-                'shade%d' % i)
-            shade.add_shade_from_wkt(shade_wkt)
-
-            # Create the contour shade
-
-            # Area to keep visible
-            interior_contour = shapely.wkt.loads(self.rc.polygon_wkt)
-            # Determine the shade WKT
-            shade_contour_wkt = interior.difference(interior_contour).wkt
-            # Prepare the shade SHP
-            shade_contour = maplib.shapes.PolyShapeFile(bb,
-                os.path.join(self.tmpdir, 'shade_contour%d.shp' % i),
-                'shade_contour%d' % i)
-            shade_contour.add_shade_from_wkt(shade_contour_wkt)
-
-
-            # Create one canvas for the current page
-            map_canvas = MapCanvas(self.rc.stylesheet,
-                                   bb, self._usable_area_width_pt,
-                                   self._usable_area_height_pt, dpi,
-                                   extend_bbox_to_ratio=False)
-
-            # Create canvas for overlay on current page
-            overlay_canvases = []
-            overlay_effects  = {}
-            for overlay in self._overlays:
-                path = overlay.path.strip()
-                if path.startswith('internal:'):
-                    if plugin_name != 'qrcode':
-                        # ignore QRcode plugin
-                        plugin_name = path.lstrip('internal:')
-                        overlay_effects[plugin_name] = self.get_plugin(plugin_name)
-                else:
-                    overlay_canvases.append(MapCanvas(overlay,
-                                               bb, self._usable_area_width_pt,
-                                               self._usable_area_height_pt, dpi,
-                                               extend_bbox_to_ratio=False))
-
-            # Create the grid
-            map_grid = Grid(bb_inner, map_canvas.get_actual_scale(), self.rc.i18n.isrtl())
-            grid_shape = map_grid.generate_shape_file(
-                os.path.join(self.tmpdir, 'grid%d.shp' % i))
-
-            map_canvas.add_shape_file(shade)
-            if self.rc.osmid != None:
-                map_canvas.add_shape_file(shade_contour,
-                                          self.rc.stylesheet.shade_color_2,
-                                          self.rc.stylesheet.shade_alpha_2)
-            map_canvas.add_shape_file(grid_shape,
-                                      self.rc.stylesheet.grid_line_color,
-                                      self.rc.stylesheet.grid_line_alpha,
-                                      self.rc.stylesheet.grid_line_width)
-
-            map_canvas.render()
-
-            for overlay_canvas in overlay_canvases:
-                overlay_canvas.render()
-
-            self.pages.append((map_canvas, map_grid, overlay_canvases, overlay_effects))
+            # Create the grid, using a lightweight canvas without any
+            # stylesheet loaded to get the actual scale of the page
+            scale_canvas = MapCanvas(self.rc.stylesheet,
+                                     bb, self._usable_area_width_pt,
+                                     self._usable_area_height_pt, dpi,
+                                     extend_bbox_to_ratio=False,
+                                     load_stylesheet=False)
+            map_grid = Grid(bb_inner, scale_canvas.get_actual_scale(), self.rc.i18n.isrtl())
+            del scale_canvas
+
+            self.pages.append(MapPage(i, bb, bb_inner, map_grid))
+
+            if job_index is not None:
+                continue
 
             # Create the index for the current page
-            inside_contour_wkt = interior_contour.intersection(interior).wkt
+            inside_contour = self._area.get_page_geometry(bb_inner)
             # TODO: other index types
             try:
                 indexer_class = globals()[self.rc.indexer+"Index"]
@@ -458,18 +451,340 @@ class MultiPageRenderer(Renderer):
                 index = indexer_class(self.db,
                                       self,
                                       bb_inner,
-                                      inside_contour_wkt,
+                                      inside_contour,
                                       self.rc.i18n, page_number=(i + self._first_map_page_number))
 
                 index.apply_grid(map_grid)
                 indexes.append(index)
 
         # Merge all indexes
-        self.index_categories = self._merge_page_indexes(indexes)
+        if job_index is None:
+            job_index = self.rc.job_index \
+                = JobIndex(categories=self._merge_page_indexes(indexes))
+        self.index_categories = job_index.categories
+        self._index_plan = None
 
         # Prepare the small map for the front page
         self._prepare_front_page_map(dpi)
 
+    def _compute_page_layout(self, orig_envelope, scale_denom,
+                             usable_width_pt, usable_height_pt,
+                             offset_x=0.5, offset_y=0.5):
+        """
+        Lay out a grid of pages covering an area at a given scale.
+
+        Parameters
+        ----------
+           orig_envelope : mapnik.Box2d
+               Area to cover, in Mercator meters.
+           scale_denom : float
+               Scale denominator, in cairo (72 ppi) units.
+           usable_width_pt : float
+               Width of the map area on a single page.
+           usable_height_pt : float
+               Height of the map area on a single page.
+           offset_x : float
+               Share of the extra width coming from rounding up the number
+               of pages that is added on the left side of the area.
+               Defaults to 0.5, centering the area on the grid.
+           offset_y : float
+               Same as offset_x for the extra height added below the area.
+
+        Returns
+        -------
+        PageGridLayout
+        """
+        # Extend the bounding box to take into account the lost outer
+        # margin
+        off_x  = orig_envelope.minx - self.GRAYED_MARGIN_MM * 9.6
+        off_y  = orig_envelope.miny - self.GRAYED_MARGIN_MM * 9.6
+        width  = orig_envelope.width() + (2 * self.GRAYED_MARGIN_MM) * 9.6
+        height = orig_envelope.height() + (2 * self.GRAYED_MARGIN_MM) * 9.6
+
+        # Calculate the total width and height of paper needed to
+        # render the geographical area at the current scale.
+        total_width_pt   = commons.convert_mm_to_pt(float(width) * 1000 / scale_denom)
+        total_height_pt  = commons.convert_mm_to_pt(float(height) * 1000 / scale_denom)
+        overlap_margin_pt = commons.convert_mm_to_pt(self.OVERLAP_MARGIN_MM)
+
+        # Calculate the number of pages needed in both directions
+        if total_width_pt < usable_width_pt:
+            nb_pages_width = 1
+        else:
+            nb_pages_width = \
+                (float(total_width_pt - usable_width_pt) / \
+                     (usable_width_pt - overlap_margin_pt)) + 1
+
+        if total_height_pt < usable_height_pt:
+            nb_pages_height = 1
+        else:
+            nb_pages_height = \
+                (float(total_height_pt - usable_height_pt) / \
+                     (usable_height_pt - overlap_margin_pt)) + 1
+
+        # Round up the number of pages needed so that we have integer
+        # number of pages
+        nb_pages_width = int(math.ceil(nb_pages_width))
+        nb_pages_height = int(math.ceil(nb_pages_height))
+
+        # Calculate the entire paper area available
+        total_width_pt_after_extension = usable_width_pt + \
+            (usable_width_pt - overlap_margin_pt) * (nb_pages_width - 1)
+        total_height_pt_after_extension = usable_height_pt + \
+            (usable_height_pt - overlap_margin_pt) * (nb_pages_height - 1)
+
+        # Convert this paper area available in the number of Mercator
+        # meters that can be rendered on the map
+        total_width_merc = \
+            commons.convert_pt_to_mm(total_width_pt_after_extension) * scale_denom / 1000
+        total_height_merc = \
+            commons.convert_pt_to_mm(total_height_pt_after_extension) * scale_denom / 1000
+
+        # Extend the geographical boundaries so that we completely
+        # fill the available paper size. By default the boundaries are
+        # extended evenly on all directions (so the center of the
+        # previous boundaries remain the same as the new one)
+        off_x -= (total_width_merc - width) * offset_x
+        off_y -= (total_height_merc - height) * offset_y
+
+        return PageGridLayout(scale_denom, usable_width_pt, usable_height_pt,
+                              nb_pages_width, nb_pages_height,
+                              off_x, off_y, total_width_merc, total_height_merc,
+                              self.GRAYED_MARGIN_MM, self.OVERLAP_MARGIN_MM)
+
+    def _count_layout_pages(self, layout, target):
+        """
+        Count the pages of a layout that will actually be printed.
+
+        Counting stops at MAX_MULTIPAGE_MAPPAGES, as layouts needing
+        more pages don't fit anyway, so the count is capped there.
+        """
+        limit = self.MAX_MULTIPAGE_MAPPAGES or None
+        if limit is not None \
+           and layout.nb_pages_width * layout.nb_pages_height \
+               > self.COUNT_SKIP_CELLS_RATIO * limit \
+           and target.coverage >= self.COUNT_SKIP_MIN_COVERAGE:
+            return limit
+
+        pages_bboxes = [[bb_inner for bb, bb_inner in row]
+                        for row in self._inverse_page_envelopes(layout)]
+        return count_selected_pages(pages_bboxes, None, target=target,
+                                    limit=limit)
+
+    def _best_layout_for_scale(self, orig_envelope, scale_denom,
+                               usable_width_pt, usable_height_pt, target):
+        """
+        Lay out the page grid at the given scale.
+
+        When OPTIMIZE_GRID_OFFSETS is set, the grid is shifted around
+        the area until a position needing less than
+        MAX_MULTIPAGE_MAPPAGES pages is found, or the one needing the
+        fewest pages otherwise. Grids far too large to fit are not
+        shifted at all.
+        """
+        # centered first, so that it is kept unless shifting helps
+        centered = self._compute_page_layout(orig_envelope, scale_denom,
+                                             usable_width_pt, usable_height_pt)
+        centered.nb_pages = self._count_layout_pages(centered, target)
+
+        max_pages = self.MAX_MULTIPAGE_MAPPAGES
+        if not self.OPTIMIZE_GRID_OFFSETS or not max_pages \
+           or centered.nb_pages < max_pages \
+           or centered.nb_pages_width * centered.nb_pages_height \
+              > self.OFFSET_SEARCH_MAX_CELLS_RATIO * max_pages:
+            return centered
+
+        best = centered
+        for offset_x in self.GRID_OFFSETS:
+            for offset_y in self.GRID_OFFSETS:
+                if (offset_x, offset_y) == (0.5, 0.5):
+                    continue
+                layout = self._compute_page_layout(orig_envelope, scale_denom,
+                                                   usable_width_pt,
+                                                   usable_height_pt,
+                                                   offset_x, offset_y)
+                layout.nb_pages = self._count_layout_pages(layout, target)
+                if layout.nb_pages < best.nb_pages:
+                    best = layout
+                    if best.nb_pages < max_pages:
+                        return best
+        return best
+
+    def _search_layout_scale(self, orig_envelope, usable_width_pt,
+                             usable_height_pt, target):
+        """
+        Find the most detailed scale at which the area can be printed
+        on less than MAX_MULTIPAGE_MAPPAGES pages.
+
+        Only pages that will actually be printed are counted, and
+        the scale is searched by bisection between the default
+        multi-page scale and the default single page scale.
+        """
+        # by convention, mapnik uses 90 ppi whereas cairo uses 72 ppi
+        min_scale = self.DEFAULT_MULTIPAGE_SCALE * float(72) / 90
+        max_scale = max(min_scale, Renderer.DEFAULT_SCALE)
+
+        def fits(layout):
+            return layout.nb_pages < self.MAX_MULTIPAGE_MAPPAGES
+
+        layout = self._best_layout_for_scale(orig_envelope, min_scale,
+                                             usable_width_pt, usable_height_pt,
+                                             target)
+        if not self.MAX_MULTIPAGE_MAPPAGES or fits(layout):
+            return layout
+
+        upper = self._best_layout_for_scale(orig_envelope, max_scale,
+                                            usable_width_pt, usable_height_pt,
+                                            target)
+        if not fits(upper):
+            LOG.warning("Area needs at least %d pages even at the largest scale"
+                        % upper.nb_pages)
+            return upper
+
+        # Bisect on a logarithmic scale, keeping the smallest scale
+        # known to fit in 'upper'
+        lower_scale = min_scale
+        while upper.scale_denom / lower_scale > 1 + self.SCALE_SEARCH_PRECISION:
+            scale_denom = math.sqrt(lower_scale * upper.scale_denom)
+            layout = self._best_layout_for_scale(orig_envelope, scale_denom,
+                                                 usable_width_pt,
+                                                 usable_height_pt,
+                                                 target)
+            if fits(layout):
+                upper = layout
+            else:
+                lower_scale = scale_denom
+
+        return upper
+
+    def _optimize_page_layout(self, orig_envelope, area_polygon,
+                              track_linestrings):
+        """
+        Find the page layout to use for the atlas.
+
+        Parameters
+        ----------
+           orig_envelope : mapnik.Box2d
+               Area to cover, in Mercator meters.
+           area_polygon : shapely.geometry
+               Area polygon, pages not touching it are not printed.
+           track_linestrings : list of shapely.geometry.LineString
+               GPX tracks, if any only pages touching them are printed.
+
+        Returns
+        -------
+        PageGridLayout
+            Layout of the page grid, its usable_width_pt and
+            usable_height_pt are swapped compared to the renderer
+            ones if rotating the pages gave a better result.
+        """
+        orientations = [(self._usable_area_width_pt,
+                         self._usable_area_height_pt)]
+        if self.TRY_BOTH_ORIENTATIONS \
+           and self._usable_area_width_pt != self._usable_area_height_pt:
+            orientations.append((self._usable_area_height_pt,
+                                 self._usable_area_width_pt))
+
+        # prepared once for all the layouts tried
+        target = SelectionTarget(area_polygon, track_linestrings)
+
+        best = None
+        for (usable_width_pt, usable_height_pt) in orientations:
+            layout = self._search_layout_scale(orig_envelope,
+                                               usable_width_pt,
+                                               usable_height_pt,
+                                               target)
+            if best is None:
+                best = layout
+            elif layout.scale_denom * (1 + self.SCALE_SEARCH_PRECISION) \
+                 < best.scale_denom:
+                # noticeably more detailed
+                best = layout
+            elif layout.scale_denom < best.scale_denom * (1 + self.SCALE_SEARCH_PRECISION) \
+                 and layout.nb_pages < best.nb_pages:
+                # about the same scale, but fewer pages
+                best = layout
+
+        return best
+
+    def _create_page_canvases(self, page):
+        """
+        Create the Mapnik canvases of a map page, ready for rendering.
+
+        These hold the loaded stylesheets, so they should only be created
+        right before rendering the page and released right after.
+
+        Parameters
+        ----------
+           page : MapPage
+               The page to create the canvases for.
+
+        Returns
+        -------
+        tuple of (MapCanvas, list of MapCanvas)
+            The map canvas and the overlay canvases of the page.
+        """
+        i = page.number
+        bb, bb_inner = page.bbox, page.bbox_inner
+
+        # Create the gray shape around the map
+        exterior = shapely.wkt.loads(bb.as_wkt())
+        interior = shapely.wkt.loads(bb_inner.as_wkt())
+        shade_wkt = exterior.difference(interior).wkt
+        shade = maplib.shapes.PolyShapeFile(
+            bb, os.path.join(self.tmpdir, 'shade%d.shp' % i),
+            'shade%d' % i)
+        shade.add_shade_from_wkt(shade_wkt)
+
+        # Create the contour shade
+
+        # Determine the shade WKT, keeping the area visible with no more
+        # detail than the page resolution allows
+        tolerance = self._area.tolerance(
+            bb, commons.convert_pt_to_dots(self._usable_area_width_pt, self.dpi))
+        shade_contour_wkt = self._area.get_shade_wkt(bb_inner, tolerance)
+        # Prepare the shade SHP
+        shade_contour = maplib.shapes.PolyShapeFile(bb,
+            os.path.join(self.tmpdir, 'shade_contour%d.shp' % i),
+            'shade_contour%d' % i)
+        shade_contour.add_shade_from_wkt(shade_contour_wkt)
+
+        # Create one canvas for the current page
+        map_canvas = MapCanvas(self.rc.stylesheet,
+                               bb, self._usable_area_width_pt,
+                               self._usable_area_height_pt, self.dpi,
+                               extend_bbox_to_ratio=False)
+
+        # Create canvas for overlay on current page
+        overlay_canvases = []
+        for overlay in self._overlays:
+            path = overlay.path.strip()
+            if not path.startswith('internal:'):
+                overlay_canvases.append(MapCanvas(overlay,
+                                           bb, self._usable_area_width_pt,
+                                           self._usable_area_height_pt, self.dpi,
+                                           extend_bbox_to_ratio=False))
+
+        grid_shape = page.grid.generate_shape_file(
+            os.path.join(self.tmpdir, 'grid%d.shp' % i))
+
+        map_canvas.add_shape_file(shade)
+        if self.rc.osmid != None:
+            map_canvas.add_shape_file(shade_contour,
+                                      self.rc.stylesheet.shade_color_2,
+                                      self.rc.stylesheet.shade_alpha_2)
+        map_canvas.add_shape_file(grid_shape,
+                                  self.rc.stylesheet.grid_line_color,
+                                  self.rc.stylesheet.grid_line_alpha,
+                                  self.rc.stylesheet.grid_line_width)
+
+        map_canvas.render()
+
+        for overlay_canvas in overlay_canvases:
+            overlay_canvas.render()
+
+        return map_canvas, overlay_canvases
+
     def _merge_page_indexes(self, indexes):
         # First, we split street categories and "other" categories,
         # because we sort them and we don't want to have the "other"
@@ -563,22 +878,29 @@ class MultiPageRenderer(Renderer):
         """
         Project the given bounding box into the rendering projection.
         """
-        envelope = mapnik.Box2d(bbox.get_top_left()[1],
-                                bbox.get_top_left()[0],
-                                bbox.get_bottom_right()[1],
-                                bbox.get_bottom_right()[0])
-        c0 = self._proj.forward(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.forward(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return mapnik.Box2d(c0.x, c0.y, c1.x, c1.y)
+        return self._proj.project_bbox(bbox)
 
     def _inverse_envelope(self, envelope):
         """
         Inverse the given cartesian envelope (in 3587) back to a 4326
         bounding box.
         """
-        c0 = self._proj.inverse(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.inverse(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return coords.BoundingBox(c0.y, c0.x, c1.y, c1.x)
+        return self._proj.inverse_envelope(envelope)
+
+    def _inverse_page_envelopes(self, layout):
+        """
+        Convert all page envelopes of a layout back to 4326 bounding
+        boxes, in a single projection call.
+
+        Returns the rows of the grid from top to bottom, each one a list
+        of (bbox, bbox_inner) tuples from left to right.
+        """
+        rows = layout.get_page_envelopes()
+        envelopes = [envelope for row in rows
+                     for page in row for envelope in page]
+        bboxes = iter(self._proj.inverse_envelopes(envelopes))
+        return [[(next(bboxes), next(bboxes)) for page in row]
+                for row in rows]
 
     def _prepare_page(self, ctx):
         # make whole page un-transparent white
@@ -610,9 +932,11 @@ class MultiPageRenderer(Renderer):
 
         # Add the shape that greys out everything that is outside of
         # the administrative boundary.
-        exterior = shapely.wkt.loads(front_page_map.get_actual_bounding_box().as_wkt())
-        interior = shapely.wkt.loads(self.rc.polygon_wkt)
-        shade_wkt = exterior.difference(interior).wkt
+        front_page_bb = front_page_map.get_actual_bounding_box()
+        shade_wkt = self._area.get_shade_wkt(
+            front_page_bb,
+            self._area.tolerance(front_page_bb,
+                                 front_page_map.get_width_dots()))
         shade = maplib.shapes.PolyShapeFile(self.rc.bounding_box,
                 os.path.join(self.tmpdir, 'shape_overview_cover.shp'),
                              'shade-overview-cover')
@@ -662,11 +986,10 @@ class MultiPageRenderer(Renderer):
         ctx.clip()
 
         # Render the map !
-        mapnik.render(self._front_page_map.get_rendered_map(), ctx)
-
-        for ov_canvas in self._frontpage_overlay_canvases:
-            rendered_map = ov_canvas.get_rendered_map()
-            mapnik.render(rendered_map, ctx)
+        self._render_maps(ctx,
+                          [self._front_page_map.get_rendered_map()]
+                          + [ov_canvas.get_rendered_map()
+                             for ov_canvas in self._frontpage_overlay_canvases])
 
         # apply effect overlays
         ctx.save()
@@ -675,7 +998,7 @@ class MultiPageRenderer(Renderer):
         self._map_canvas = self._front_page_map;
         for plugin_name, effect in self._frontpage_overlay_effects.items():
             try:
-                effect.render(self, ctx)
+                self._render_plugin(plugin_name, effect, ctx)
             except Exception as e:
                 # TODO better logging
                 LOG.warning("Error while rendering overlay: %s\n%s" % (plugin_name, e))
@@ -837,7 +1160,8 @@ class MultiPageRenderer(Renderer):
             overlays   = overlay_names,
             indexer    = self.rc.indexer,
             locale     = self.rc.i18n.language_desc(),
-            first_index_page = len(self.pages) + 1,
+            first_index_page = (self._first_index_page_number
+                                if self._plan_index().page_count else '-'),
             imports    = import_names,
             # TODO use current locale for date fromatting below
             render_date= datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -869,12 +1193,10 @@ class MultiPageRenderer(Renderer):
         ctx.save()
         self._prepare_page(ctx)
 
-        rendered_map = self.overview_canvas.get_rendered_map()
-        mapnik.render(rendered_map, ctx)
-
-        for ov_canvas in self.overview_overlay_canvases:
-            rendered_map = ov_canvas.get_rendered_map()
-            mapnik.render(rendered_map, ctx)
+        self._render_maps(ctx,
+                          [self.overview_canvas.get_rendered_map()]
+                          + [ov_canvas.get_rendered_map()
+                             for ov_canvas in self.overview_overlay_canvases])
 
         # apply effect overlays
         ctx.save()
@@ -885,7 +1207,7 @@ class MultiPageRenderer(Renderer):
         self._map_canvas = self.overview_canvas;
         for plugin_name, effect in self.overview_overlay_effects.items():
             try:
-                effect.render(self, ctx)
+                self._render_plugin(plugin_name, effect, ctx)
             except Exception as e:
                 # TODO better logging
                 LOG.warning("Error while rendering overlay: %s\n%s" % (plugin_name, e))
@@ -1089,13 +1411,96 @@ class MultiPageRenderer(Renderer):
 
 
     def render(self, cairo_surface, dpi, osm_date):
+        self._finalize_index()
+
         ctx = cairo.Context(cairo_surface)
 
         self._render_front_page(ctx, cairo_surface, dpi, osm_date)
         self._render_contents_page(ctx, cairo_surface, dpi, osm_date)
         self._render_overview_page(ctx, cairo_surface, dpi)
+        self._render_map_pages(ctx, cairo_surface, self.pages)
+        self._render_index_pages(ctx, cairo_surface)
+
+        cairo_surface.flush()
+
+    def render_pdf_file(self, output_filename, dpi, osm_date, metadata=None,
+                        threads=None):
+        """
+        Render the atlas into a PDF file using the streaming AtlasWriter.
+
+        The header pages, and chunks of ATLAS_CHUNK_PAGES map or index
+        pages are rendered as separate document parts, up to threads
+        of them at the same time.
+
+        Parameters
+        ----------
+           output_filename : str
+               Path of the PDF file to create.
+           dpi : int
+               Output resolution.
+           osm_date : datetime
+               Date of the OSM data.
+           metadata : dict of str => str
+               PDF document information entries, e.g. {'Title': 'Paris'}.
+           threads : int, optional
+               Number of parts rendered at the same time, defaults to
+               ATLAS_RENDER_THREADS.
+        """
+        self._finalize_index()
+        # Paginate the index before the parts share this renderer
+        self._plan_index()
+
+        writer = atlas_writer.AtlasWriter(self.tmpdir,
+                                          self.paper_width_pt,
+                                          self.paper_height_pt,
+                                          threads or self.ATLAS_RENDER_THREADS)
+
+        # Parts may be rendered concurrently, so each one draws through
+        # its own shallow copy of the renderer, as rendering a page
+        # updates per-page renderer state used by the plugins
+        def header_pages(ctx, surface):
+            renderer = copy(self)
+            renderer._render_front_page(ctx, surface, dpi, osm_date)
+            renderer._render_contents_page(ctx, surface, dpi, osm_date)
+            renderer._render_overview_page(ctx, surface, dpi)
+        writer.add_part(header_pages)
+
+        def map_pages(pages):
+            return lambda ctx, surface: \
+                copy(self)._render_map_pages(ctx, surface, pages)
+        for first in range(0, len(self.pages), self.ATLAS_CHUNK_PAGES):
+            writer.add_part(map_pages(self.pages[first:first + self.ATLAS_CHUNK_PAGES]))
+
+        def index_pages(pages):
+            return lambda ctx, surface: \
+                self._render_index_pages(ctx, surface, pages)
+        index_page_count = self._plan_index().page_count
+        for first in range(0, index_page_count, self.ATLAS_CHUNK_PAGES):
+            writer.add_part(index_pages(range(first, min(index_page_count,
+                                                         first + self.ATLAS_CHUNK_PAGES))))
+
+        writer.write(output_filename, metadata)
+
+    def _render_map_pages(self, ctx, cairo_surface, pages):
+        """
+        Render the given map pages.
+
+        Parameters
+        ----------
+           ctx : cairo.Context
+               The context to draw on.
+           cairo_surface : cairo.Surface
+               The surface the context draws on.
+           pages : list of MapPage
+               The pages to render.
+        """
+        for page in pages:
+            map_number = page.number
+
+            # Heavy Mapnik objects only live while their page is rendered
+            canvas, overlay_canvases = self._create_page_canvases(page)
+            grid = page.grid
 
-        for map_number, (canvas, grid, overlay_canvases, overlay_effects) in enumerate(self.pages):
             ctx.save()
             self._prepare_page(ctx)
 
@@ -1109,11 +1514,10 @@ class MultiPageRenderer(Renderer):
             dest_tag = "mypage%d" % (map_number + self._first_map_page_number)
             draw_utils.anchor(ctx, dest_tag)
 
-            mapnik.render(rendered_map, ctx)
-
-            for overlay_canvas in overlay_canvases:
-                rendered_overlay = overlay_canvas.get_rendered_map()
-                mapnik.render(rendered_overlay, ctx)
+            self._render_maps(ctx,
+                              [rendered_map]
+                              + [overlay_canvas.get_rendered_map()
+                                 for overlay_canvas in overlay_canvases])
 
             # Place the vertical and horizontal square labels
             ctx.save()
@@ -1134,14 +1538,14 @@ class MultiPageRenderer(Renderer):
             ctx.translate(-commons.convert_pt_to_dots(self.grayed_margin_pt)/2,
                       -commons.convert_pt_to_dots(self.grayed_margin_pt)/2)
             self._map_canvas = canvas;
-            for plugin_name, effect in overlay_effects.items():
+            for plugin_name, effect in self._page_overlay_effects.items():
                 self.grid = grid
                 try:
-                    effect.render(self, ctx)
+                    self._render_plugin(plugin_name, effect, ctx)
                 except Exception as e:
                     # TODO better logging
                     LOG.warning("Error while rendering overlay: %s\n%s" % (plugin_name, e))
-                    effect.render(self, ctx)
+                    self._render_plugin(plugin_name, effect, ctx)
             ctx.restore()
 
 
@@ -1161,19 +1565,58 @@ class MultiPageRenderer(Renderer):
             cairo_surface.show_page()
             ctx.restore()
 
-        mpsir = MultiPageIndexRenderer(self.rc.i18n,
-                                       ctx, cairo_surface,
-                                       self.index_categories,
-                                       (self.paper_width_pt, self.paper_height_pt),
-                                       (Renderer.PRINT_SAFE_MARGIN_PT,
-                                        Renderer.PRINT_SAFE_MARGIN_PT,
-                                        self._usable_area_width_pt,
-                                        self._usable_area_height_pt),
-                                       map_number + 2) # TODO: actually calc. the page offset here
+            self._map_canvas = None
+            del canvas, overlay_canvases
+
+    @property
+    def _first_index_page_number(self):
+        return len(self.pages) + self._first_map_page_number
+
+    def _create_index_renderer(self, ctx, cairo_surface):
+        return MultiPageIndexRenderer(self.rc.i18n,
+                                      ctx, cairo_surface,
+                                      self.index_categories,
+                                      (self.paper_width_pt, self.paper_height_pt),
+                                      (Renderer.PRINT_SAFE_MARGIN_PT,
+                                       Renderer.PRINT_SAFE_MARGIN_PT,
+                                       self._usable_area_width_pt,
+                                       self._usable_area_height_pt),
+                                      self._first_index_page_number)
+
+    def _plan_index(self):
+        """
+        Paginate the index pages, unless already done.
 
-        mpsir.render()
+        Returns
+        -------
+        MultiPageIndexPlan
+        """
+        if self._index_plan is None:
+            # Text is measured with font metrics hinting disabled, so the
+            # measurements do not depend on the surface they are made on
+            surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            self._index_plan = \
+                self._create_index_renderer(cairo.Context(surface), surface).compute_plan()
+            surface.finish()
+        return self._index_plan
+
+    def _render_index_pages(self, ctx, cairo_surface, pages=None):
+        """
+        Render the index pages following the map pages.
 
-        cairo_surface.flush()
+        Parameters
+        ----------
+           ctx : cairo.Context
+               The context to draw on.
+           cairo_surface : cairo.Surface
+               The surface the context draws on.
+           pages : iterable of int, optional
+               Numbers of the index pages to render, starting at 0.
+               All pages by default.
+        """
+        mpsir = self._create_index_renderer(ctx, cairo_surface)
+        mpsir.plan = self._plan_index()
+        mpsir.render(pages=pages)
 
     # In multi-page mode, we only render pdf format
     @staticmethod
@@ -1222,28 +1665,33 @@ class MultiPageRenderer(Renderer):
         ctx.save()
         ctx.set_font_size(14)
 
-        bbox = map_canvas.get_actual_bounding_box()
-        bottom_right, bottom_left, top_left, top_right = bbox.to_mercator()
-        bottom, left = bottom_right.y, top_left.x
-        coord_delta_y = top_left.y - bottom_right.y
-        coord_delta_x = bottom_right.x - top_left.x
-        w, h = None, None
-        for idx, page_bb in enumerate(overview_grid._pages_bbox):
-            p_bottom_right, p_bottom_left, p_top_left, p_top_right = \
-                                                        page_bb.to_mercator()
-            center_x = p_top_left.x+(p_top_right.x-p_top_left.x)/2
-            center_y = p_bottom_left.y+(p_top_right.y-p_bottom_right.y)/2
-            y_percent = 100 - 100.0*(center_y - bottom)/coord_delta_y
-            y = int(area_height_dots*y_percent/100)
+        envelope = self._proj.project_bbox(map_canvas.get_actual_bounding_box())
+        bottom, left = envelope.miny, envelope.minx
+        coord_delta_y = envelope.maxy - envelope.miny
+        coord_delta_x = envelope.maxx - envelope.minx
+
+        # project the corners of all pages at once
+        pages_bbox = overview_grid._pages_bbox
+        (p_lefts, p_bottoms) = self._proj.forward(
+            [bb.get_left() for bb in pages_bbox],
+            [bb.get_bottom() for bb in pages_bbox])
+        (p_rights, p_tops) = self._proj.forward(
+            [bb.get_right() for bb in pages_bbox],
+            [bb.get_top() for bb in pages_bbox])
+
+        center_xs = (p_lefts + p_rights) / 2
+        center_ys = (p_bottoms + p_tops) / 2
+        xs = area_width_dots * (center_xs - left) / coord_delta_x
+        ys = area_height_dots * (1 - (center_ys - bottom) / coord_delta_y)
 
-            x_percent = 100.0*(center_x - left)/coord_delta_x
-            x = int(area_width_dots*x_percent/100)
+        w, h = None, None
+        for idx in range(len(pages_bbox)):
+            x = int(xs[idx])
+            y = int(ys[idx])
 
             if not w or not h:
-                w = area_width_dots*(p_bottom_right.x - p_bottom_left.x
-                                                         )/coord_delta_x
-                h = area_height_dots*(p_top_right.y - p_bottom_right.y
-                                                         )/coord_delta_y
+                w = area_width_dots*(p_rights[idx] - p_lefts[idx])/coord_delta_x
+                h = area_height_dots*(p_tops[idx] - p_bottoms[idx])/coord_delta_y
 
             draw_utils.draw_text_adjusted(ctx, str(idx + self._first_map_page_number),
                                           x, y, w, h,
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Process wide registry of the render plugins in layoutlib/render_plugins.
+
+Plugins are discovered once, and each of them is only imported the first
+time it is asked for, all renderers then share the loaded module.
+
+Besides their render(renderer, ctx) entry point, and the optional
+prepare(renderer) hook (see Renderer.get_plugin()), plugin modules may
+describe themselves with these module level constants:
+
+   NEEDS_DB (bool): the plugin queries the GIS database (default: False)
+   NEEDS_NETWORK (bool): the plugin fetches data from the internet
+                         (default: False)
+   PER_PAGE (bool): the plugin draws on every map page of a job, and not
+                    only once per job (default: True)
+"""
+
+import logging
+import os
+import threading
+
+from pluginbase import PluginBase
+
+LOG = logging.getLogger('ocitysmap')
+
+PLUGIN_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           'render_plugins'))
+
+
+class PluginInfo:
+    """
+    Description of a render plugin.
+    """
+
+    __slots__ = ['name', 'needs_db', 'needs_network', 'per_page',
+                 'has_prepare']
+
+    def __init__(self, name, plugin):
+        self.name          = name
+        self.needs_db      = bool(getattr(plugin, 'NEEDS_DB', False))
+        self.needs_network = bool(getattr(plugin, 'NEEDS_NETWORK', False))
+        self.per_page      = bool(getattr(plugin, 'PER_PAGE', True))
+        self.has_prepare   = hasattr(plugin, 'prepare')
+
+    def __repr__(self):
+        return ('PluginInfo(%s, needs_db=%s, needs_network=%s, per_page=%s)'
+                % (self.name, self.needs_db, self.needs_network,
+                   self.per_page))
+
+
+class PluginRegistry:
+    """
+    Discovers render plugins and hands out their loaded modules.
+    """
+
+    def __init__(self, search_path=PLUGIN_PATH):
+        """
+        Parameters
+        ----------
+           search_path : str
+               Directory containing the plugin packages.
+        """
+        self._search_path = search_path
+        self._source      = None
+        self._plugins     = {}
+        self._lock        = threading.RLock()
+
+    def _get_source(self):
+        with self._lock:
+            if self._source is None:
+                # the plugin source has to be kept alive, its plugins
+                # are unloaded when it is garbage collected
+                base = PluginBase(package='ocitysmap.layout_plugins')
+                self._source = base.make_plugin_source(
+                    searchpath=[self._search_path])
+                LOG.debug("Found render plugins: %s"
+                          % ", ".join(sorted(self._source.list_plugins())))
+            return self._source
+
+    def list_plugins(self):
+        """Names of all available plugins.
+
+        Returns
+        -------
+        list of str
+        """
+        return sorted(self._get_source().list_plugins())
+
+    def get_plugin(self, plugin_name):
+        """Get a plugin module, importing it on first use.
+
+        Parameters
+        ----------
+           plugin_name : str
+               Name of the plugin package.
+
+        Returns
+        -------
+        module
+        """
+        with self._lock:
+            if plugin_name not in self._plugins:
+                self._plugins[plugin_name] = \
+                    self._get_source().load_plugin(plugin_name)
+                LOG.debug("Loaded render plugin %s" % plugin_name)
+            return self._plugins[plugin_name]
+
+    def get_info(self, plugin_name):
+        """Get the description of a plugin.
+
+        Parameters
+        ----------
+           plugin_name : str
+               Name of the plugin package.
+
+        Returns
+        -------
+        PluginInfo
+        """
+        return PluginInfo(plugin_name, self.get_plugin(plugin_name))
+
+    def get_all_info(self):
+        """Get the descriptions of all available plugins.
+
+        Returns
+        -------
+        list of PluginInfo
+        """
+        return [self.get_info(name) for name in self.list_plugins()]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """Get the process wide PluginRegistry.
+
+    Returns
+    -------
+    PluginRegistry
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PluginRegistry()
+        return _registry
@@ -21,13 +21,16 @@ import json
 import logging
 LOG = logging.getLogger('ocitysmap')
 
-def render(renderer, ctx):
-    if not hasattr(renderer, 'street_index'):
-        return
+NEEDS_NETWORK = True
 
-    bbox = renderer._map_canvas.get_actual_bounding_box()
-    url  = ("https://api.openstreetmap.org/api/0.6/notes.json?closed=0&bbox=%f,%f,%f,%f"
-            % (bbox.get_left(), bbox.get_bottom(), bbox.get_right(), bbox.get_top()))
+# The notes API rejects bounding boxes of 25 square degrees and more,
+# and returns at most 10000 notes per request
+MAX_TILE_DEGREES = 4
+MAX_NOTES = 10000
+
+def _fetch_notes(left, bottom, right, top):
+    url  = ("https://api.openstreetmap.org/api/0.6/notes.json?closed=0&limit=%d&bbox=%f,%f,%f,%f"
+            % (MAX_NOTES, left, bottom, right, top))
     LOG.info("OSM Notes URL: %s" % url)
 
     req = Request(url)
@@ -36,27 +39,79 @@ def render(renderer, ctx):
     except HTTPError as e:
         LOG.error('The server couldn\'t fulfill the request.')
         LOG.error('Error code: %s' % e.code)
-        return
+        return None
     except URLError as e:
         LOG.error('We failed to reach a server.')
         LOG.error('Reason: %s' % e.reason)
-        return
+        return None
 
     notes_json = response.read()
 
     try:
         notes = json.loads(notes_json)
     except Exception as e:
-        LOG.error("JSON decode exception %s / %s." % (e.code, e.reason))
+        LOG.error("JSON decode exception %s." % e)
+        return None
+
+    if len(notes['features']) >= MAX_NOTES:
+        LOG.warning("More than %d open notes in %s, some are missing"
+                    % (MAX_NOTES, url))
+
+    return notes
+
+def prepare(renderer):
+    """Fetch the open notes covering all maps of the job."""
+    # nothing to render the notes into, see render()
+    if not hasattr(renderer, 'street_index'):
+        return None
+
+    if hasattr(renderer, '_geo_bbox'):
+        # multi page renderer, area covered by all pages
+        bbox = renderer._geo_bbox
+    else:
+        bbox = renderer._map_canvas.get_actual_bounding_box()
+
+    # large areas are fetched tile by tile, notes on tile borders
+    # are returned twice and only kept once
+    features = {}
+    left = bbox.get_left()
+    while left < bbox.get_right():
+        right = min(left + MAX_TILE_DEGREES, bbox.get_right())
+        bottom = bbox.get_bottom()
+        while bottom < bbox.get_top():
+            top = min(bottom + MAX_TILE_DEGREES, bbox.get_top())
+            notes = _fetch_notes(left, bottom, right, top)
+            if notes is None:
+                return None
+            for note in notes['features']:
+                features[note['properties']['id']] = note
+            bottom = top
+        left = right
+
+    return {'type': 'FeatureCollection', 'features': list(features.values())}
+
+def render(renderer, ctx, notes):
+    if not hasattr(renderer, 'street_index'):
+        return
+
+    if notes is None:
         return
 
+    # only keep the notes on the current map
+    bbox = renderer._map_canvas.get_actual_bounding_box()
+    features = [note for note in notes['features']
+                if bbox.get_left() <= note['geometry']['coordinates'][0] <= bbox.get_right()
+                and bbox.get_bottom() <= note['geometry']['coordinates'][1] <= bbox.get_top()]
+
     index_items = []
 
+    lats = [note['geometry']['coordinates'][1] for note in features]
+    lons = [note['geometry']['coordinates'][0] for note in features]
+    xs, ys = renderer.latlon_to_xy(lats, lons)
+
     n = 0
-    for note in notes['features']:
+    for note, lat, lon, x, y in zip(features, lats, lons, xs, ys):
         n = n + 1
-        lat = note['geometry']['coordinates'][1]
-        lon = note['geometry']['coordinates'][0]
 
         point = Point(lat, lon)
 
@@ -64,6 +119,6 @@ def render(renderer, ctx):
 
         index_items.append(GeneralIndexItem(index_text[0:50], point, point, None))
 
-        renderer._marker('red', str(n), lat, lon, ctx, renderer.dpi)
+        renderer._marker_at('red', str(n), x, y, ctx, renderer.dpi)
 
 #    renderer.street_index.add_category("OSM Notes", index_items)
@@ -20,12 +20,16 @@ def render(renderer, ctx):
     if renderer.rc.poi_file:
 
         # place POI markers on map canvas
-        n = 0
+        pois = []
         for category in renderer.street_index.categories:
             for poi in category.items:
-                n = n + 1
-                lat, lon = poi.endpoint1.get_latlong()
-                renderer._marker(category.color, str(n), lat, lon, ctx, renderer.dpi)
+                pois.append((category.color, poi.endpoint1.get_latlong()))
+
+        xs, ys = renderer.latlon_to_xy([latlon[0] for color, latlon in pois],
+                                       [latlon[1] for color, latlon in pois])
+
+        for n, ((color, latlon), x, y) in enumerate(zip(pois, xs, ys)):
+            renderer._marker_at(color, str(n + 1), x, y, ctx, renderer.dpi)
 
         # place "you are here" circle if coordinates are given
         if renderer.street_index.lat != False:
@@ -15,6 +15,9 @@ from ocitysmap.layoutlib.abstract_renderer import Renderer
 import logging
 LOG = logging.getLogger('ocitysmap')
 
+# only drawn once, not on the individual atlas pages
+PER_PAGE = False
+
 def render(renderer, ctx):
     if renderer.rc.qrcode_text:
         qrcode_text = renderer.rc.qrcode_text
@@ -1,5 +1,5 @@
 import cairo
-from gi.repository import Rsvg
+from ocitysmap import asset_cache, statements
 import math
 import os
 import psycopg2
@@ -7,7 +7,9 @@ import logging
 
 LOG = logging.getLogger('ocitysmap')
 
-def _camera_view(renderer, ctx, map_scale, surveillance, lat, lon, camera_type, direction, angle, height):
+NEEDS_DB = True
+
+def _camera_view(renderer, ctx, map_scale, surveillance, x, y, camera_type, direction, angle, height):
     if camera_type == 'dome':
         symbol = 'dome-camera'
         direction = '0'
@@ -50,8 +52,6 @@ def _camera_view(renderer, ctx, map_scale, surveillance, lat, lon, camera_type,
 
     ctx.save()
 
-    x,y = renderer._latlon2xy(lat, lon, renderer.dpi)
-
     if type(direction) == float and surveillance != 'indoor':
         if height and height.isdigit():
            height = float(height)
@@ -101,35 +101,26 @@ def _camera_view(renderer, ctx, map_scale, surveillance, lat, lon, camera_type,
 
 
 
-def _show_symbol(renderer, ctx, lat, lon, surveillance, symbol):
+def _show_symbol(renderer, ctx, x, y, surveillance, symbol):
     if surveillance != 'public' and surveillance != 'outdoor' and surveillance != 'indoor':
         surveillance = 'public'
 
     symbol_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'images', surveillance, (symbol+'.svg')))
 
-    fp = open(symbol_path,'rb')
-    data = fp.read()
-    fp.close()
-
-    rsvg = Rsvg.Handle()
-    svg  = rsvg.new_from_data(data)
-    x,y = renderer._latlon2xy(lat, lon, renderer.dpi)
+    svg = asset_cache.get_svg_handle(symbol_path)
 
     svg_scale = renderer.dpi / (4 * svg.props.height);
     sx = x - svg.props.width  * svg_scale/2
     sy = y - svg.props.height * svg_scale/2
 
-    ctx.save()
-    ctx.translate(sx, sy)
-    ctx.scale(svg_scale, svg_scale)
-    svg.render_cairo(ctx)
-    ctx.restore()
+    asset_cache.paint_svg(ctx, symbol_path, sx, sy, scale=svg_scale)
 
 
 
 
 
-def render(renderer, ctx):
+def prepare(renderer):
+    """Fetch all surveillance devices in the area of interest."""
     query = """SELECT ST_Y(ST_TRANSFORM(way, 4326)) AS lat
                     , ST_X(ST_TRANSFORM(way, 4326)) AS lon
                     , tags->'surveillance'      AS surveillance
@@ -140,7 +131,7 @@ def render(renderer, ctx):
                     , tags->'height'            AS camera_height
                  FROM planet_osm_point
                 WHERE tags->'man_made' = 'surveillance'
-                  AND ST_CONTAINS(ST_TRANSFORM(ST_GeomFromText('%s', 4326), 3857), way)
+                  AND ST_CONTAINS(ST_TRANSFORM(ST_GeomFromText($1, 4326), 3857), way)
          UNION SELECT ST_Y(ST_TRANSFORM(way, 4326)) AS lat
                     , ST_X(ST_TRANSFORM(way, 4326)) AS lon
                     , tags->'surveillance'      AS surveillance
@@ -151,17 +142,34 @@ def render(renderer, ctx):
                     , tags->'height'            AS camera_height
                  FROM planet_osm_point
                 WHERE tags->'surveillance' IS NOT NULL
-                  AND ST_CONTAINS(ST_TRANSFORM(ST_GeomFromText('%s', 4326), 3857), way)
-             """ % ( renderer.rc.polygon_wkt, renderer.rc.polygon_wkt)
-
-    cursor = renderer.db.cursor()
-    cursor.execute(query)
-
+                  AND ST_CONTAINS(ST_TRANSFORM(ST_GeomFromText($1, 4326), 3857), way)
+             """
+
+    # use a connection of our own if possible, as this runs
+    # while the renderer keeps using its main connection
+    db = renderer.db
+    if hasattr(db, 'connection'):
+        with db.connection() as connection:
+            cursor = connection.cursor()
+            statements.execute(cursor, 'surveillance', query,
+                               [renderer.rc.polygon_wkt], ['text'])
+            return cursor.fetchall()
+
+    cursor = db.cursor()
+    statements.execute(cursor, 'surveillance', query,
+                       [renderer.rc.polygon_wkt], ['text'])
+    return cursor.fetchall()
+
+def render(renderer, ctx, rows):
     map_scale = renderer._map_canvas.get_actual_scale() * 72.0 / renderer.dpi
 
-    for lat, lon, surveillance, surveillance_type, direction, angle, camera_type, height in cursor.fetchall():
+    xs, ys = renderer.latlon_to_xy([row[0] for row in rows],
+                                   [row[1] for row in rows],
+                                   renderer.dpi)
+
+    for (lat, lon, surveillance, surveillance_type, direction, angle, camera_type, height), x, y in zip(rows, xs, ys):
         if surveillance_type == 'camera':
-            symbol = _camera_view(renderer, ctx, map_scale, surveillance, lat, lon, camera_type, direction, angle, height)
+            symbol = _camera_view(renderer, ctx, map_scale, surveillance, x, y, camera_type, direction, angle, height)
         elif surveillance_type == 'guard':
             symbol = 'guard-shield'
         elif surveillance_type == 'ALPR':
@@ -169,5 +177,5 @@ def render(renderer, ctx):
         else:
             continue
 
-        _show_symbol(renderer, ctx, lat, lon, surveillance, symbol) 
+        _show_symbol(renderer, ctx, x, y, surveillance, symbol)
 
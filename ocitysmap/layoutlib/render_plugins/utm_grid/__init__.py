@@ -102,11 +102,8 @@ def render(renderer, ctx):
 
         return '+proj=utm +zone=%d %s +ellps=WGS84 +datum=WGS84 +units=m +no_defs' % (number, south)
 
-    def grid_line(lat1, lon1, lat2, lon2):
-        # draw a blue grid line between two coordinates
-        (x1, y1) = renderer._latlon2xy(lat1, lon1)
-        (x2, y2) = renderer._latlon2xy(lat2, lon2)
-
+    def grid_line(x1, y1, x2, y2):
+        # draw a blue grid line between two page positions
         ctx.save()
         ctx.set_source_rgba(0, 0, 1.0, 0.5)
         ctx.set_line_width(pt2px(1))
@@ -160,30 +157,41 @@ def render(renderer, ctx):
         n_km = math.ceil(north/1000)
         s_km = math.floor(south/1000)
 
-        # draw the vertical grid lines
-        for v in range(w_km, e_km):
-            # calc line endings and draw line
+        # calc all grid line endings first, so that they can be
+        # converted to page coordinates in one go
+        v_range = range(w_km, e_km)
+        h_range = range(s_km, n_km)
+        line_ends = []
+        for v in v_range:
             # TODO: the vertical lines are not really straight
-            (lat1, lon1) = utm.to_latlon(v * 1000, n_km * 1000, zone1_number, zone1_letter)
-            (lat2, lon2) = utm.to_latlon(v * 1000, s_km * 1000, zone1_number, zone1_letter)
-            grid_line(lat1, lon1, lat2, lon2)
+            line_ends.append(utm.to_latlon(v * 1000, n_km * 1000, zone1_number, zone1_letter))
+            line_ends.append(utm.to_latlon(v * 1000, s_km * 1000, zone1_number, zone1_letter))
+        for h in h_range:
+            line_ends.append(utm.to_latlon(w_km * 1000, h * 1000, zone1_number, zone1_letter))
+            line_ends.append(utm.to_latlon(e_km * 1000, h * 1000, zone1_number, zone1_letter))
+
+        xs, ys = renderer.latlon_to_xy([lat for lat, lon in line_ends],
+                                       [lon for lat, lon in line_ends])
+
+        # draw the vertical grid lines
+        for i, v in enumerate(v_range):
+            (x1, y1, x2, y2) = (xs[2*i], ys[2*i], xs[2*i+1], ys[2*i+1])
+            grid_line(x1, y1, x2, y2)
 
             # draw easting value right next to upper visible end of the grid line
-            (x1, y1) = renderer._latlon2xy(lat1, lon1)
             ctx.save()
             ctx.set_source_rgba(0, 0, 0.5, 0.5)
             draw_simpletext_center(ctx, beautify_km(v), x1 + 12, 62.5)
             ctx.restore()
 
         # draw the horizontal grid lines
-        for h in range(s_km, n_km):
-            # calc line endings and draw line
-            (lat1, lon1) = utm.to_latlon(w_km * 1000, h * 1000, zone1_number, zone1_letter)
-            (lat2, lon2) = utm.to_latlon(e_km * 1000, h * 1000, zone1_number, zone1_letter)
-            grid_line(lat1, lon1, lat2, lon2)
+        offset = 2 * len(v_range)
+        for i, h in enumerate(h_range):
+            (x1, y1, x2, y2) = (xs[offset+2*i], ys[offset+2*i],
+                                xs[offset+2*i+1], ys[offset+2*i+1])
+            grid_line(x1, y1, x2, y2)
 
             # draw northing value right below left visible end of the line
-            (x1, y1) = renderer._latlon2xy(lat1, lon1)
             ctx.save()
             ctx.set_source_rgba(0, 0, 0.5, 0.5)
             draw_simpletext_center(ctx, beautify_km(h), 27, y1 + 5)
@@ -12,7 +12,7 @@ class SinglePageRendererIndexBottom(SinglePageRenderer):
     name = 'single_page_index_bottom'
     description = gettext(u'Full-page layout with the index at the bottom.')
 
-    def __init__(self, db, rc, tmpdir, dpi, file_prefix):
+    def __init__(self, db, rc, tmpdir, dpi, file_prefix, index_only=False):
         """
         Create the renderer.
 
@@ -28,8 +28,11 @@ class SinglePageRendererIndexBottom(SinglePageRenderer):
                Output resolution for bitmap formats
            file_prefix : str
                File name refix for all output file formats to be generated
+           index_only : bool, optional
+               See SinglePageRenderer
         """
-        SinglePageRenderer.__init__(self, db, rc, tmpdir, dpi, file_prefix, 'bottom')
+        SinglePageRenderer.__init__(self, db, rc, tmpdir, dpi, file_prefix, 'bottom',
+                                    index_only)
 
     @staticmethod
     def get_compatible_paper_sizes(bounding_box, render_context,
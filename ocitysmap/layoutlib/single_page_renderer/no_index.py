@@ -11,7 +11,7 @@ class SinglePageRendererNoIndex(SinglePageRenderer):
     name = 'plain'
     description = gettext(u'Full-page layout without index.')
 
-    def __init__(self, db, rc, tmpdir, dpi, file_prefix):
+    def __init__(self, db, rc, tmpdir, dpi, file_prefix, index_only=False):
         """
         Create the renderer.
 
@@ -27,8 +27,11 @@ class SinglePageRendererNoIndex(SinglePageRenderer):
                Output resolution for bitmap formats
            file_prefix : str
                File name refix for all output file formats to be generated
+           index_only : bool, optional
+               See SinglePageRenderer
         """
-        SinglePageRenderer.__init__(self, db, rc, tmpdir, dpi, file_prefix, None)
+        SinglePageRenderer.__init__(self, db, rc, tmpdir, dpi, file_prefix, None,
+                                    index_only)
 
 
     @staticmethod
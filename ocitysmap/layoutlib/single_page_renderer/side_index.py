@@ -11,7 +11,7 @@ class SinglePageRendererIndexOnSide(SinglePageRenderer):
     name = 'single_page_index_side'
     description = gettext(u'Full-page layout with the index on the side.')
 
-    def __init__(self, db, rc, tmpdir, dpi, file_prefix):
+    def __init__(self, db, rc, tmpdir, dpi, file_prefix, index_only=False):
         """
         Create the renderer.
 
@@ -27,8 +27,11 @@ class SinglePageRendererIndexOnSide(SinglePageRenderer):
                Output resolution for bitmap formats
            file_prefix : str
                File name refix for all output file formats to be generated
+           index_only : bool, optional
+               See SinglePageRenderer
         """
-        SinglePageRenderer.__init__(self, db, rc, tmpdir, dpi, file_prefix, 'side')
+        SinglePageRenderer.__init__(self, db, rc, tmpdir, dpi, file_prefix, 'side',
+                                    index_only)
 
     @staticmethod
     def get_compatible_paper_sizes(bounding_box, render_context,
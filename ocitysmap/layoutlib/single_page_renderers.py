@@ -39,6 +39,7 @@ assert mapnik.mapnik_version() >= 300000, \
     "for more details." % mapnik.mapnik_version_string()
 import math
 from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 from gettext import gettext, ngettext
 
 from ocitysmap.layoutlib import commons
@@ -50,7 +51,7 @@ from ocitysmap.indexlib.HealthIndex import HealthIndex
 from ocitysmap.indexlib.NotesIndex import NotesIndex
 from ocitysmap.indexlib.TreeIndex import TreeIndex
 from ocitysmap.indexlib.PoiIndex import PoiIndexRenderer, PoiIndex
-from ocitysmap.indexlib.commons import IndexDoesNotFitError, IndexEmptyError
+from ocitysmap.indexlib.commons import IndexDoesNotFitError, IndexEmptyError, JobIndex
 import draw_utils
 from ocitysmap.maplib.map_canvas import MapCanvas
 from ocitysmap.stylelib import GpxStylesheet, UmapStylesheet
@@ -75,8 +76,13 @@ class SinglePageRenderer(Renderer):
     # TODO make configurable
     MAX_INDEX_OCCUPATION_RATIO = 1/3.
 
+    # Draw the map and the index at the same time in separate threads,
+    # Mapnik and cairo release the GIL while drawing
+    # TODO make configurable
+    PARALLEL_RENDERING = True
+
     def __init__(self, db, rc, tmpdir, dpi, file_prefix,
-                 index_position = 'side'):
+                 index_position = 'side', index_only = False):
         """
         Create the renderer.
 
@@ -95,15 +101,25 @@ class SinglePageRenderer(Renderer):
            index_position : str, optional
                None or 'side' (index on side), 'bottom' (index at bottom),
                or 'extra_page' (index on 2nd page for PDF output only).
+           index_only : bool, optional
+               Only prepare what export_index() needs: the index and
+               the grid locating its items, but no Mapnik map, overlays
+               or plugins. The renderer can't render() then.
         """
 
         Renderer.__init__(self, db, rc, tmpdir, dpi)
 
         self.file_prefix = file_prefix
 
-        # Prepare the index
+        # Prepare the index, only once per job as all output formats
+        # share it, see JobIndex
+        job_index = rc.job_index
         self.index_position = index_position
-        if index_position is None:
+        if job_index is not None:
+            self.street_index = job_index.index
+            (self.index_position, self._index_renderer, self._index_area) \
+                = job_index.layout
+        elif index_position is None:
             self.street_index = None
         else:
             try:
@@ -162,18 +178,35 @@ class SinglePageRenderer(Renderer):
                                        self._copyright_margin_pt)
 
         # Prepare the Index (may raise a IndexDoesNotFitError)
-        try:
-            if ( index_position and self.street_index
-                 and self.street_index.categories ):
-                self._index_renderer, self._index_area \
-                    = self._create_index_rendering(index_position)
-            else:
-                self._index_renderer, self._index_area = None, None
-        except IndexDoesNotFitError as e:
-                self._index_renderer, self._index_area = None, None
+        if job_index is None:
+            try:
+                if ( index_position and self.street_index
+                     and self.street_index.categories ):
+                    self._index_renderer, self._index_area \
+                        = self._create_index_rendering(index_position)
+                else:
+                    self._index_renderer, self._index_area = None, None
+            except IndexDoesNotFitError as e:
+                    self._index_renderer, self._index_area = None, None
+
+            rc.job_index = JobIndex(self.street_index,
+                                    layout=(self.index_position,
+                                            self._index_renderer,
+                                            self._index_area))
 
         self._map_coords = self._get_map_coords(index_position if self._index_area else None)
 
+        if index_only:
+            # the grid only depends on the map extent and scale, which
+            # a canvas without stylesheet is good enough for
+            self._map_canvas = MapCanvas(self.rc.stylesheet,
+                                         self.rc.bounding_box,
+                                         float(self._map_coords[2]),  # W
+                                         float(self._map_coords[3]),  # H
+                                         dpi, load_stylesheet=False)
+            self.grid = self._create_grid(self._map_canvas, dpi)
+            return
+
         # Prepare the map
         self._map_canvas = self._create_map_canvas(
             float(self._map_coords[2]),  # W
@@ -413,8 +446,8 @@ class SinglePageRenderer(Renderer):
             ctx.restore()
 
         # Prepare the title
-        pc = PangoCairo.create_context(ctx)
-        layout = PangoCairo.create_layout(ctx)
+        pc = draw_utils.create_pango_context(ctx)
+        layout = draw_utils.create_layout(ctx)
         layout.set_width(int((w_dots - 0.1*w_dots - logo_width - logo_width2) * Pango.SCALE))
         if not self.rc.i18n.isrtl():
             layout.set_alignment(Pango.Alignment.LEFT)
@@ -483,10 +516,10 @@ class SinglePageRenderer(Renderer):
 
         # do the actual output drawing
         ctx.save()
-        pc = PangoCairo.create_context(ctx)
+        pc = draw_utils.create_pango_context(ctx)
         fd = Pango.FontDescription('DejaVu')
         fd.set_size(Pango.SCALE)
-        layout = PangoCairo.create_layout(ctx)
+        layout = draw_utils.create_layout(ctx)
         layout.set_font_description(fd)
         layout.set_text(notice, -1)
         draw_utils.adjust_font_size(layout, fd, w_dots, h_dots)
@@ -494,6 +527,122 @@ class SinglePageRenderer(Renderer):
         PangoCairo.show_layout(ctx, layout)
         ctx.restore()
 
+    @staticmethod
+    def _record(width, height, draw_func, *args):
+        """ Draw into a new recording surface
+
+        Parameters
+        ----------
+        width : float
+            Width of the recorded area
+        height : float
+            Height of the recorded area
+        draw_func : callable
+            Called as draw_func(ctx, *args) to draw onto the surface
+
+        Returns
+        -------
+        cairo.RecordingSurface
+        """
+        surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                                         cairo.Rectangle(0, 0, width, height))
+        draw_func(cairo.Context(surface), *args)
+        return surface
+
+    def _draw_map_layers(self, ctx, dpi):
+        """ Draw the Mapnik map and its overlays
+
+        Parameters
+        ----------
+        ctx : cairo.Context
+            Context to draw on, with the origin at the top left map corner
+        dpi : int
+            Dots per inch of the destination surface
+
+        Returns
+        -------
+        void
+        """
+        # Draw the rescaled Map
+        ctx.save()
+        scale_factor = int(dpi / 72)
+        rendered_map = self._map_canvas.get_rendered_map()
+        LOG.info('Map:')
+        LOG.info('Mapnik scale: 1/%f' % rendered_map.scale_denominator())
+        LOG.info('Actual scale: 1/%f' % self._map_canvas.get_actual_scale())
+        LOG.info('Zoom factor: %d' % self.scaleDenominator2zoom(rendered_map.scale_denominator()))
+
+        # Draw the rescaled Overlays on top of the map one by one
+        rendered_maps = [rendered_map]
+        for overlay_canvas in self._overlay_canvases:
+            LOG.info('Overlay: %s' % overlay_canvas.get_style_name())
+            rendered_maps.append(overlay_canvas.get_rendered_map())
+
+        # now perform the actual map drawing
+        self._render_maps(ctx, rendered_maps, scale_factor)
+        ctx.restore()
+
+    def _draw_index(self, ctx, dpi):
+        """ Draw the index into its precomputed page area
+
+        Parameters
+        ----------
+        ctx : cairo.Context
+            Context to draw on, with the origin at the top left page corner
+        dpi : int
+            Dots per inch of the destination surface
+
+        Returns
+        -------
+        void
+        """
+        ctx.save()
+
+        # NEVER use ctx.scale() here because otherwise pango will
+        # choose different font metrics which may be incompatible
+        # with what has been computed by __init__(), which may
+        # require more columns than expected !  Instead, we have
+        # to trick pangocairo into believing it is rendering to a
+        # device with the same default resolution, but with a
+        # cairo resolution matching the 'dpi' specified
+        # resolution. See
+        # index::render::StreetIndexRenederer::render() and
+        # comments within.
+
+        self._index_renderer.render(ctx, self._index_area, dpi)
+
+        ctx.restore()
+
+    def export_index(self, output_format, output_filename):
+        """ Write the index data to a file
+
+        Parameters
+        ----------
+        output_format : str
+            One of export.get_available_formats()
+        output_filename : str
+            Path of the file to write to
+
+        Returns
+        -------
+        void
+        """
+        if not (self.grid and self.street_index
+                and self.index_position is not None):
+            LOG.warning("No index to export to %s" % output_filename)
+            return
+
+        write = getattr(self.street_index, 'write_to_%s' % output_format, None)
+        if write is None:
+            LOG.warning("%s index can't be exported to %s"
+                        % (self.rc.indexer, output_format.upper()))
+            return
+
+        self._finalize_index(self.grid)
+        if output_format != 'csv':
+            # the CSV file is written by the job index finalization
+            write(self.rc.title, output_filename)
+
     def render(self, cairo_surface, dpi, osm_date):
         """ Render the complete map page, including all components
 
@@ -547,6 +696,30 @@ class SinglePageRenderer(Renderer):
         ctx.fill()
         ctx.restore()
 
+        # Update the street_index to reflect the grid's actual position
+        if self.grid and self.street_index and self.index_position is not None:
+            self._finalize_index(self.grid)
+
+        has_index = self._index_renderer and self._index_area
+
+        # The map and the index cover disjoint parts of the page, so
+        # they can be drawn at the same time, each into a recording
+        # surface of its own that is then painted onto the page
+        map_surface   = None
+        index_surface = None
+        if self.PARALLEL_RENDERING and has_index:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                map_future = executor.submit(
+                    self._record, map_coords_dots[2], map_coords_dots[3],
+                    self._draw_map_layers, dpi)
+                index_future = executor.submit(
+                    self._record,
+                    commons.convert_pt_to_dots(self.paper_width_pt, dpi),
+                    commons.convert_pt_to_dots(self.paper_height_pt, dpi),
+                    self._draw_index, dpi)
+                map_surface   = map_future.result()
+                index_surface = index_future.result()
+
         ##
         ## Draw the map, scaled to fit the designated area
         ##
@@ -559,26 +732,12 @@ class SinglePageRenderer(Renderer):
         # Prepare to draw the map at the right location
         ctx.translate(map_coords_dots[0], map_coords_dots[1])
 
-        # Draw the rescaled Map
-        ctx.save()
-        scale_factor = int(dpi / 72)
-        rendered_map = self._map_canvas.get_rendered_map()
-        LOG.info('Map:')
-        LOG.info('Mapnik scale: 1/%f' % rendered_map.scale_denominator())
-        LOG.info('Actual scale: 1/%f' % self._map_canvas.get_actual_scale())
-        LOG.info('Zoom factor: %d' % self.scaleDenominator2zoom(rendered_map.scale_denominator()))
-
-        # now perform the actual map drawing
-        mapnik.render(rendered_map, ctx, scale_factor, 0, 0)
-        ctx.restore()
-
-        # Draw the rescaled Overlays on top of the map one by one
-        for overlay_canvas in self._overlay_canvases:
-            ctx.save()
-            rendered_overlay = overlay_canvas.get_rendered_map()
-            LOG.info('Overlay: %s' % overlay_canvas.get_style_name())
-            mapnik.render(rendered_overlay, ctx, scale_factor, 0, 0)
-            ctx.restore()
+        # Draw the rescaled Map and Overlays
+        if map_surface:
+            ctx.set_source_surface(map_surface, 0, 0)
+            ctx.paint()
+        else:
+            self._draw_map_layers(ctx, dpi)
 
         # Place the vertical and horizontal square labels
         if self.grid and self.index_position:
@@ -604,7 +763,7 @@ class SinglePageRenderer(Renderer):
         # apply effect plugin overlays
         for plugin_name, effect in self._overlay_effects.items():
             try:
-                effect.render(self, ctx)
+                self._render_plugin(plugin_name, effect, ctx)
             except Exception as e:
                 # TODO better logging
                 LOG.warning("Error while rendering overlay: %s\n%s" % (plugin_name, e))
@@ -623,31 +782,14 @@ class SinglePageRenderer(Renderer):
         ##
         ## Draw the index, when applicable
         ##
-
-        # Update the street_index to reflect the grid's actual position
-        if self.grid and self.street_index and self.index_position is not None:
-            self.street_index.apply_grid(self.grid)
-
-            # Dump the CSV street index
-            self.street_index.write_to_csv(self.rc.title, '%s.csv' % self.file_prefix)
-
-        if self._index_renderer and self._index_area:
-            ctx.save()
-
-            # NEVER use ctx.scale() here because otherwise pango will
-            # choose different font metrics which may be incompatible
-            # with what has been computed by __init__(), which may
-            # require more columns than expected !  Instead, we have
-            # to trick pangocairo into believing it is rendering to a
-            # device with the same default resolution, but with a
-            # cairo resolution matching the 'dpi' specified
-            # resolution. See
-            # index::render::StreetIndexRenederer::render() and
-            # comments within.
-
-            self._index_renderer.render(ctx, self._index_area, dpi)
-
-            ctx.restore()
+        if has_index:
+            if index_surface:
+                ctx.save()
+                ctx.set_source_surface(index_surface, 0, 0)
+                ctx.paint()
+                ctx.restore()
+            else:
+                self._draw_index(ctx, dpi)
 
             # Also draw a rectangle frame around the index
             ctx.save()
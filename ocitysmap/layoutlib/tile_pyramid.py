@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Writer for DeepZoom tile pyramids.
+
+Huge pages are recorded once into a cairo RecordingSurface, then every
+tile of every zoom level is rasterized on its own from that recording.
+Only the tiles currently being drawn are held in memory as pixels, so
+the size of the page is not limited by the memory needed for a single
+image of it.
+
+The result is a DeepZoom image, as understood e.g. by OpenSeadragon: an
+XML descriptor <name>.dzi next to a <name>_files directory holding one
+sub-directory per zoom level, with the tiles named <column>_<row>.png.
+"""
+
+import cairo
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import os
+
+LOG = logging.getLogger('ocitysmap')
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+       Format="png" Overlap="%(overlap)d" TileSize="%(tile_size)d">
+  <Size Width="%(width)d" Height="%(height)d"/>
+</Image>
+"""
+
+
+class TilePyramid:
+    """
+    Rasterizes a recorded page into a DeepZoom tile pyramid.
+    """
+
+    TILE_SIZE = 254
+    TILE_OVERLAP = 1
+
+    def __init__(self, recording, width_px, height_px, threads=1):
+        """
+        Parameters
+        ----------
+           recording : cairo.RecordingSurface
+               The page, drawn at full resolution. It is only read from.
+           width_px : int
+               Width of the page at full resolution.
+           height_px : int
+               Height of the page at full resolution.
+           threads : int
+               Number of tiles to draw at the same time.
+        """
+        self._recording = recording
+        self._width     = int(width_px)
+        self._height    = int(height_px)
+        self._threads   = max(1, threads)
+
+        # level 0 is a single pixel, the last one is the full resolution
+        self.max_level = int(math.ceil(math.log2(max(self._width,
+                                                     self._height, 1))))
+
+    def get_level_size(self, level):
+        """Dimensions of the image at a zoom level.
+
+        Parameters
+        ----------
+           level : int
+               Zoom level, from 0 to max_level.
+
+        Returns
+        -------
+        tuple of int
+            (width, height) in pixels.
+        """
+        factor = 2 ** (self.max_level - level)
+        return (max(1, int(math.ceil(self._width / factor))),
+                max(1, int(math.ceil(self._height / factor))))
+
+    def _get_tiles(self, level):
+        (width, height) = self.get_level_size(level)
+        for col in range(int(math.ceil(width / self.TILE_SIZE))):
+            for row in range(int(math.ceil(height / self.TILE_SIZE))):
+                x0 = max(0, col * self.TILE_SIZE - self.TILE_OVERLAP)
+                y0 = max(0, row * self.TILE_SIZE - self.TILE_OVERLAP)
+                x1 = min(width, (col + 1) * self.TILE_SIZE + self.TILE_OVERLAP)
+                y1 = min(height, (row + 1) * self.TILE_SIZE + self.TILE_OVERLAP)
+                yield (level, col, row, x0, y0, x1 - x0, y1 - y0)
+
+    def _render_tile(self, directory, tile):
+        (level, col, row, x, y, width, height) = tile
+        scale = 0.5 ** (self.max_level - level)
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        ctx.translate(-x, -y)
+        ctx.scale(scale, scale)
+        ctx.set_source_surface(self._recording, 0, 0)
+        ctx.get_source().set_filter(cairo.FILTER_GOOD)
+        ctx.paint()
+
+        surface.write_to_png(os.path.join(directory, '%d_%d.png' % (col, row)))
+        surface.finish()
+
+    def write(self, output_filename):
+        """Render all tiles and write the DeepZoom descriptor.
+
+        Parameters
+        ----------
+           output_filename : str
+               Path of the .dzi descriptor to create, the tiles go to a
+               directory of the same name with '_files' instead of the
+               file extension.
+        """
+        tiles_dir = os.path.splitext(output_filename)[0] + '_files'
+
+        # one level after the other, so that there are never more than
+        # the tiles of a single level waiting to be drawn
+        with ThreadPoolExecutor(max_workers=self._threads) as executor:
+            for level in range(self.max_level, -1, -1):
+                directory = os.path.join(tiles_dir, str(level))
+                os.makedirs(directory, exist_ok=True)
+                list(executor.map(lambda tile: self._render_tile(directory, tile),
+                                  self._get_tiles(level)))
+                LOG.debug("Wrote zoom level %d of %s (%dx%d)"
+                          % ((level, output_filename)
+                             + self.get_level_size(level)))
+
+        with open(output_filename, 'w') as f:
+            f.write(DZI_TEMPLATE % {'overlap':   self.TILE_OVERLAP,
+                                    'tile_size': self.TILE_SIZE,
+                                    'width':     self._width,
+                                    'height':    self._height})
+
+        LOG.info("Wrote %d level tile pyramid %s"
+                 % (self.max_level + 1, output_filename))
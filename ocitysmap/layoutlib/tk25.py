@@ -122,7 +122,7 @@ class TK25Renderer(Renderer):
 
     def render(self, cairo_surface, dpi, osm_date):
         ctx = cairo.Context(cairo_surface)
-        pc = PangoCairo.create_context(ctx)
+        pc = draw_utils.create_pango_context(ctx)
 
         normal_fd = Pango.FontDescription("DejaVu 7")
         normal_layout, normal_fascent, normal_fheight, normal_em = \
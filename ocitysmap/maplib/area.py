@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Geometry of the area of interest of a rendering job.
+
+Administrative boundaries can have hundreds of thousands of vertices,
+far more than can be told apart at the resolution of any of the canvases
+they are drawn on. The AreaGeometry class parses the area polygon only
+once per job and hands out copies simplified and clipped to the needs of
+each canvas.
+"""
+
+import logging
+import math
+import threading
+
+import shapely.geometry
+import shapely.prepared
+import shapely.wkt
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class AreaGeometry:
+    """
+    The area of interest of a rendering job, parsed once from its WKT.
+    """
+
+    # Maximum deviation of simplified outlines, in output pixels.
+    SIMPLIFY_TOLERANCE_PX = 0.5
+
+    def __init__(self, wkt):
+        """
+        Parameters
+        ----------
+           wkt : str
+               Area polygon in WKT format, WGS84 lon/lat coordinates.
+        """
+        self.wkt = wkt
+        self._polygon = None
+        self._prepared = None
+        self._simplified = {}
+        self._lock = threading.Lock()
+
+    @property
+    def polygon(self):
+        """The full resolution area polygon, as a shapely geometry."""
+        with self._lock:
+            if self._polygon is None:
+                self._polygon = shapely.wkt.loads(self.wkt)
+                LOG.debug("Parsed area polygon with %d bytes of WKT"
+                          % len(self.wkt))
+            return self._polygon
+
+    @property
+    def prepared(self):
+        """The area polygon prepared for repeated predicate tests."""
+        polygon = self.polygon
+        with self._lock:
+            if self._prepared is None:
+                self._prepared = shapely.prepared.prep(polygon)
+            return self._prepared
+
+    def tolerance(self, bbox, width_dots):
+        """Simplification tolerance for a canvas.
+
+        Parameters
+        ----------
+           bbox : coords.BoundingBox
+               Geographic area covered by the canvas.
+           width_dots : int
+               Width of the canvas, in output pixels.
+
+        Returns
+        -------
+        float
+            Tolerance in degrees, small enough to stay below
+            SIMPLIFY_TOLERANCE_PX in both directions.
+        """
+        if width_dots <= 0:
+            return 0.0
+        deg_per_dot = (bbox.get_right() - bbox.get_left()) / width_dots
+        # mercator maps stretch latitudes by 1/cos(lat), so a
+        # degree of latitude covers more pixels than one of longitude
+        center_lat = (bbox.get_top() + bbox.get_bottom()) / 2
+        return deg_per_dot * math.cos(math.radians(center_lat)) \
+            * self.SIMPLIFY_TOLERANCE_PX
+
+    def simplified(self, tolerance):
+        """Get the area polygon simplified to the given tolerance.
+
+        Copies are kept per tolerance, so that pages of the same scale
+        share them.
+
+        Parameters
+        ----------
+           tolerance : float
+               Maximum deviation, in degrees.
+
+        Returns
+        -------
+        shapely.geometry
+        """
+        polygon = self.polygon
+        if tolerance <= 0:
+            return polygon
+
+        # atlas pages only differ by rounding errors in their scale
+        key = float('%.3g' % tolerance)
+        with self._lock:
+            if key not in self._simplified:
+                self._simplified[key] = polygon.simplify(
+                    key, preserve_topology=True)
+            return self._simplified[key]
+
+    def clipped(self, bbox, tolerance=0.0):
+        """Get the part of the area polygon within a bounding box.
+
+        Parameters
+        ----------
+           bbox : coords.BoundingBox
+               Bounding box to clip to.
+           tolerance : float
+               Simplification tolerance in degrees, see tolerance().
+
+        Returns
+        -------
+        shapely.geometry
+            A valid geometry, unlike the faster clip_by_rect() would
+            return, so that it can be used in further operations.
+        """
+        box = shapely.geometry.box(bbox.get_left(), bbox.get_bottom(),
+                                   bbox.get_right(), bbox.get_top())
+        return self.simplified(tolerance).intersection(box)
+
+    def get_page_geometry(self, bbox):
+        """Get the full resolution part of the area within a page.
+
+        Pages lying completely inside or outside of the area are
+        detected with the prepared polygon, without computing any
+        intersection.
+
+        Parameters
+        ----------
+           bbox : coords.BoundingBox
+               Bounding box of the page.
+
+        Returns
+        -------
+        shapely.geometry
+            The page part of the area, possibly empty.
+        """
+        page = shapely.geometry.box(bbox.get_left(), bbox.get_bottom(),
+                                    bbox.get_right(), bbox.get_top())
+        if self.prepared.contains(page):
+            return page
+        if not self.prepared.intersects(page):
+            return shapely.geometry.Polygon()
+        # passed on to the database as is, so it has to be valid
+        return self.polygon.intersection(page)
+
+    def get_shade_wkt(self, bbox, tolerance=0.0):
+        """Get the part of a bounding box that lies outside of the area.
+
+        Parameters
+        ----------
+           bbox : coords.BoundingBox
+               Part of the canvas to shade outside of the area.
+           tolerance : float
+               Simplification tolerance in degrees, see tolerance().
+
+        Returns
+        -------
+        str
+            WKT of the shade to draw.
+        """
+        exterior = shapely.geometry.box(bbox.get_left(), bbox.get_bottom(),
+                                        bbox.get_right(), bbox.get_top())
+        interior = self.clipped(bbox, tolerance)
+        return exterior.difference(interior).wkt
+
+
+def get_area_geometry(rc):
+    """Get the AreaGeometry of a rendering configuration.
+
+    It is created on first use and then kept on the configuration for
+    the rest of the job.
+
+    Parameters
+    ----------
+       rc : ocitysmap.RenderingConfiguration
+           The rendering configuration, with its polygon_wkt set.
+
+    Returns
+    -------
+    AreaGeometry
+    """
+    area = getattr(rc, 'area_geometry', None)
+    if area is None or area.wkt != rc.polygon_wkt:
+        area = AreaGeometry(rc.polygon_wkt)
+        rc.area_geometry = area
+    return area
@@ -51,7 +51,7 @@ class MapCanvas:
     """
 
     def __init__(self, stylesheet, bounding_box, _width, _height, dpi=72.0,
-                 extend_bbox_to_ratio=True):
+                 extend_bbox_to_ratio=True, load_stylesheet=True):
         """Initialize the map canvas for rendering.
 
         Args:
@@ -62,10 +62,13 @@ class MapCanvas:
             extend_bbox_to_ratio (boolean): allow MapCanvas to extend
             the bounding box to make it match the ratio of the
             provided rendering area. Needed by SinglePageRenderer.
+            load_stylesheet (boolean): load the Mapnik stylesheet. A canvas
+            created without it is cheap and only good for querying the
+            actual bounding box and scale, it can't be rendered.
         """
 
         self._style_name = stylesheet.name
-        self._proj = mapnik.Projection(_MAPNIK_PROJECTION)
+        self._proj = ocitysmap.coords.get_projection()
         self._dpi  = dpi
 
         # This is where the magic of the map canvas happens. Given an original
@@ -95,7 +98,8 @@ class MapCanvas:
         # Create the Mapnik map with the corrected width and height and zoom to
         # the corrected bounding box ('envelope' in the Mapnik jargon)
         self._map = mapnik.Map(g_width, g_height, _MAPNIK_PROJECTION)
-        mapnik.load_map(self._map, stylesheet.path)
+        if load_stylesheet:
+            mapnik.load_map(self._map, stylesheet.path)
         self._map.zoom_to_box(envelope)
 
         # exclude layers based on configuration setting "exclude_layers"
@@ -165,6 +169,10 @@ class MapCanvas:
         Mapnik."""
         return self._geo_bbox
 
+    def get_width_dots(self):
+        """Return the width of the rendered map, in output pixels."""
+        return self._map.width
+
     def get_actual_scale(self):
         # get the scale denominator computed by mapnik
         scale = self._map.scale_denominator()
@@ -200,20 +208,12 @@ class MapCanvas:
 
     def _project_envelope(self, bbox):
         """Project the given bounding box into the rendering projection."""
-        envelope = mapnik.Box2d(bbox.get_top_left()[1],
-                                bbox.get_top_left()[0],
-                                bbox.get_bottom_right()[1],
-                                bbox.get_bottom_right()[0])
-        c0 = self._proj.forward(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.forward(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return mapnik.Box2d(c0.x, c0.y, c1.x, c1.y)
+        return self._proj.project_bbox(bbox)
 
     def _inverse_envelope(self, envelope):
         """Inverse the given cartesian envelope (in 3587) back to a 4326
         bounding box."""
-        c0 = self._proj.inverse(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.inverse(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return ocitysmap.coords.BoundingBox(c0.y, c0.x, c1.y, c1.x)
+        return self._proj.inverse_envelope(envelope)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import shapely.geometry
+import shapely.prepared
+
+LOG = logging.getLogger('ocitysmap')
+
+
+def bbox_to_shape(bbox):
+    """Convert a bounding box into a shapely box polygon.
+
+    Parameters
+    ----------
+    bbox : coords.BoundingBox
+        Bounding box to convert, in WGS84 lat/lon coordinates.
+
+    Returns
+    -------
+    shapely.geometry.Polygon
+        Rectangle polygon with lon/lat coordinates.
+    """
+    (top, left) = bbox.get_top_left()
+    (bottom, right) = bbox.get_bottom_right()
+    return shapely.geometry.box(left, bottom, right, top)
+
+
+class SelectionTarget:
+    """
+    The geometry that decides whether a page is shown, prepared for
+    testing many pages against it.
+
+    When GPX tracks are given only pages touched by a track are shown,
+    otherwise all pages touching the area polygon are.
+    """
+
+    def __init__(self, area_polygon, track_linestrings=None):
+        """
+        Parameters
+        ----------
+        area_polygon : shapely.geometry
+            The area the atlas has been requested for.
+        track_linestrings : list of shapely.geometry.LineString, optional
+            GPX tracks, if given only the pages the tracks pass through
+            are selected.
+        """
+        if track_linestrings:
+            target = shapely.geometry.MultiLineString(list(track_linestrings))
+        else:
+            target = area_polygon
+        self._bounds = target.bounds
+        self._prepared = shapely.prepared.prep(target)
+
+        # share of its bounding box covered by the target, 0 for tracks
+        (minx, miny, maxx, maxy) = self._bounds
+        bbox_area = (maxx - minx) * (maxy - miny)
+        self.coverage = target.area / bbox_area if bbox_area > 0 else 0.0
+
+    def intersects(self, bbox):
+        """Whether a page is shown.
+
+        Parameters
+        ----------
+        bbox : coords.BoundingBox
+            Inner bounding box of the page.
+
+        Returns
+        -------
+        bool
+        """
+        (t_minx, t_miny, t_maxx, t_maxy) = self._bounds
+        (top, left) = bbox.get_top_left()
+        (bottom, right) = bbox.get_bottom_right()
+
+        # cheap rejection of cells that can't possibly intersect
+        if left > t_maxx or right < t_minx \
+           or bottom > t_maxy or top < t_miny:
+            return False
+
+        return self._prepared.intersects(bbox_to_shape(bbox))
+
+
+def compute_page_disposition(pages_bounding_boxes, area_polygon,
+                             track_linestrings=None, target=None):
+    """Decide which pages of a multi-page grid are to be rendered.
+
+    The selection geometry (the GPX tracks if any, the area polygon
+    otherwise) is prepared only once, so that each grid cell is tested
+    with a single cheap prepared predicate instead of a full geometry
+    intersection per track and per page.
+
+    Parameters
+    ----------
+    pages_bounding_boxes : list of list of coords.BoundingBox
+        Inner bounding boxes of all grid cells, one list per grid row
+        from top to bottom, each row going from left to right.
+    area_polygon : shapely.geometry
+        The area the atlas has been requested for.
+    track_linestrings : list of shapely.geometry.LineString, optional
+        GPX tracks, if given only the pages the tracks pass through
+        are selected.
+    target : SelectionTarget, optional
+        Already prepared selection geometry, to reuse for several
+        grids. area_polygon and track_linestrings are ignored if given.
+
+    Returns
+    -------
+    dict of int => list
+        Page disposition matrix, indexed by grid row from top to bottom.
+        Each row lists, from left to right, either the map number of
+        the page (counted from 0 in reading order), or None for cells
+        that are not rendered.
+    """
+    if target is None:
+        target = SelectionTarget(area_polygon, track_linestrings)
+
+    page_disposition = {}
+    map_number = 0
+    for row, row_bboxes in enumerate(pages_bounding_boxes):
+        page_disposition[row] = []
+        for bbox in row_bboxes:
+            if target.intersects(bbox):
+                page_disposition[row].append(map_number)
+                map_number += 1
+            else:
+                page_disposition[row].append(None)
+
+    return page_disposition
+
+
+
+def count_selected_pages(pages_bounding_boxes, area_polygon,
+                         track_linestrings=None, target=None, limit=None):
+    """Count the pages compute_page_disposition() would select.
+
+    Parameters
+    ----------
+    See compute_page_disposition(), and:
+
+    limit : int, optional
+        Stop counting once this many pages are selected.
+
+    Returns
+    -------
+    int
+        Number of grid cells that would actually be rendered, at most
+        limit.
+    """
+    if target is None:
+        target = SelectionTarget(area_polygon, track_linestrings)
+
+    count = 0
+    for row_bboxes in pages_bounding_boxes:
+        for bbox in row_bboxes:
+            if target.intersects(bbox):
+                count += 1
+                if limit is not None and count >= limit:
+                    return count
+    return count
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Background encoding and compression of output files.
+
+Renderers draw into plain files or image surfaces, and an OutputWriter
+does the PNG encoding and gzip compression in a background thread, so
+that the next output format can already be rendered meanwhile.
+
+With more than one compression thread, files are cut into blocks that
+are compressed at the same time and written as consecutive gzip members.
+Such files are valid gzip files, but some readers only decompress their
+first member, so this is not the default.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import logging
+import os
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class OutputWriter:
+    """
+    Finishes output files in the background.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, compression_level=6, compression_threads=1):
+        """
+        Parameters
+        ----------
+           compression_level : int
+               gzip compression level, from 1 (fastest) to 9 (smallest).
+           compression_threads : int
+               Number of blocks compressed at the same time.
+        """
+        self._level    = min(9, max(1, compression_level))
+        self._threads  = max(1, compression_threads)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures  = []
+
+    def write_png(self, surface, output_filename):
+        """Encode a rendered surface into a PNG file, and finish it.
+
+        Parameters
+        ----------
+           surface : cairo.Surface
+               The surface, no longer drawn on by the caller.
+           output_filename : str
+               Path of the PNG file to create.
+        """
+        def write():
+            surface.write_to_png(output_filename)
+            surface.finish()
+            LOG.debug("Wrote %s" % output_filename)
+
+        self._futures.append(self._executor.submit(write))
+
+    def compress(self, filename, output_filename):
+        """Compress a file with gzip, and remove it.
+
+        Parameters
+        ----------
+           filename : str
+               Path of the finished uncompressed file.
+           output_filename : str
+               Path of the compressed file to create.
+        """
+        def write():
+            if self._threads > 1:
+                self._compress_blocks(filename, output_filename)
+            else:
+                with open(filename, 'rb') as src, \
+                     gzip.open(output_filename, 'wb', self._level) as dst:
+                    while True:
+                        data = src.read(self.BLOCK_SIZE)
+                        if not data:
+                            break
+                        dst.write(data)
+            os.remove(filename)
+            LOG.debug("Wrote %s (compression level %d)"
+                      % (output_filename, self._level))
+
+        self._futures.append(self._executor.submit(write))
+
+    def _compress_blocks(self, filename, output_filename):
+        def blocks(src):
+            while True:
+                data = src.read(self.BLOCK_SIZE)
+                if not data:
+                    return
+                yield data
+
+        # zlib releases the GIL while compressing. Only a few blocks are
+        # read ahead, to keep memory use independent of the file size
+        with open(filename, 'rb') as src, \
+             open(output_filename, 'wb') as dst, \
+             ThreadPoolExecutor(max_workers=self._threads) as executor:
+            pending = deque()
+            for data in blocks(src):
+                pending.append(executor.submit(gzip.compress, data,
+                                               self._level))
+                if len(pending) > 2 * self._threads:
+                    dst.write(pending.popleft().result())
+            while pending:
+                dst.write(pending.popleft().result())
+
+    def wait(self):
+        """Wait for all pending output files.
+
+        Exceptions raised while writing them are raised here.
+        """
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        """Wait for all pending output files, ignoring errors, and stop
+        the background thread."""
+        self._executor.shutdown(wait=True)
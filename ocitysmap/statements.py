@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Catalog of server side prepared statements.
+
+Index and plugin queries are large, and only differ between jobs by the
+area of interest. They are written with $1, $2, ... parameters instead,
+and each distinct statement is sent to PostgreSQL with PREPARE only once
+per database connection, so that the server doesn't have to parse and
+plan it again for every job.
+
+The catalog also counts the executions of each statement and how long
+they took, see get_statistics() and log_statistics().
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+import weakref
+
+import psycopg2
+
+LOG = logging.getLogger('ocitysmap')
+
+# PostgreSQL error codes
+_UNDEFINED_PREPARED_STATEMENT = '26000'
+_DUPLICATE_PREPARED_STATEMENT = '42P05'
+
+
+class _Statement:
+    __slots__ = ['name', 'label', 'sql', 'param_types',
+                 'count', 'total_time', 'max_time']
+
+    def __init__(self, name, label, sql, param_types):
+        self.name        = name
+        self.label       = label
+        self.sql         = sql
+        self.param_types = param_types
+        self.count       = 0
+        self.total_time  = 0.0
+        self.max_time    = 0.0
+
+
+class StatementCatalog:
+    """
+    Keeps track of the statements known to the process and of the
+    connections they have already been prepared on.
+    """
+
+    def __init__(self):
+        self._statements = {}
+        self._prepared   = weakref.WeakKeyDictionary()
+        self._lock       = threading.Lock()
+
+    def _get_statement(self, label, sql, param_types):
+        digest = hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12]
+        name = "ocm_%s_%s" % (re.sub(r'\W', '_', label.lower()), digest)
+        with self._lock:
+            if name not in self._statements:
+                self._statements[name] = _Statement(name, label, sql,
+                                                    tuple(param_types))
+            return self._statements[name]
+
+    def _prepare(self, cursor, statement):
+        connection = cursor.connection
+        with self._lock:
+            prepared = self._prepared.setdefault(connection, set())
+            if statement.name in prepared:
+                return
+
+        types = ""
+        if statement.param_types:
+            types = " (%s)" % ", ".join(statement.param_types)
+        try:
+            cursor.execute("PREPARE %s%s AS %s"
+                           % (statement.name, types, statement.sql))
+        except psycopg2.Error as e:
+            if e.pgcode != _DUPLICATE_PREPARED_STATEMENT:
+                raise
+            connection.rollback()
+        LOG.debug("Prepared statement %s (%s)"
+                  % (statement.name, statement.label))
+
+        with self._lock:
+            prepared.add(statement.name)
+
+    def _forget(self, connection, statement):
+        with self._lock:
+            self._prepared.get(connection, set()).discard(statement.name)
+
+    def execute(self, cursor, label, sql, params=(), param_types=()):
+        """Execute a statement, preparing it first if needed.
+
+        Parameters
+        ----------
+        cursor : psycopg2 cursor
+            Cursor to execute the statement with, results can be
+            fetched from it afterwards as usual.
+        label : str
+            Short description of the statement for the statistics,
+            e.g. 'StreetIndex'.
+        sql : str
+            The statement, using $1, $2, ... for its parameters.
+        params : sequence, optional
+            Parameter values, passed to psycopg2 for quoting.
+        param_types : sequence of str, optional
+            SQL types of the parameters, e.g. ('bytea', 'text[]').
+
+        Returns
+        -------
+        void
+        """
+        statement = self._get_statement(label, sql, param_types)
+        self._prepare(cursor, statement)
+
+        execute_sql = "EXECUTE %s" % statement.name
+        if params:
+            execute_sql += " (%s)" % ", ".join(["%s"] * len(params))
+
+        start = time.monotonic()
+        try:
+            cursor.execute(execute_sql, tuple(params))
+        except psycopg2.Error as e:
+            if e.pgcode != _UNDEFINED_PREPARED_STATEMENT:
+                raise
+            # the session has been reset behind our back, prepare again
+            LOG.debug("Statement %s is gone, preparing it again"
+                      % statement.name)
+            cursor.connection.rollback()
+            self._forget(cursor.connection, statement)
+            self._prepare(cursor, statement)
+            start = time.monotonic()
+            cursor.execute(execute_sql, tuple(params))
+        elapsed = time.monotonic() - start
+
+        with self._lock:
+            statement.count += 1
+            statement.total_time += elapsed
+            statement.max_time = max(statement.max_time, elapsed)
+
+    def get_statistics(self):
+        """Execution statistics of all statements.
+
+        Returns
+        -------
+        list of dict
+            One entry per statement, with the keys 'name', 'label',
+            'count', 'total_time' and 'max_time' (in seconds), ordered
+            by decreasing total time.
+        """
+        with self._lock:
+            stats = [{'name':       s.name,
+                      'label':      s.label,
+                      'count':      s.count,
+                      'total_time': s.total_time,
+                      'max_time':   s.max_time}
+                     for s in self._statements.values()]
+        return sorted(stats, key=lambda s: s['total_time'], reverse=True)
+
+    def log_statistics(self, level=logging.DEBUG):
+        """Log the execution statistics of all statements."""
+        for s in self.get_statistics():
+            LOG.log(level, "Statement %s (%s): %d executions, %.3fs total, %.3fs max"
+                    % (s['name'], s['label'], s['count'],
+                       s['total_time'], s['max_time']))
+
+    def reset_statistics(self):
+        """Reset execution counts and timings of all statements."""
+        with self._lock:
+            for s in self._statements.values():
+                s.count = 0
+                s.total_time = 0.0
+                s.max_time = 0.0
+
+
+_catalog = StatementCatalog()
+
+def execute(cursor, label, sql, params=(), param_types=()):
+    """Execute a statement with the shared catalog, see
+    StatementCatalog.execute()."""
+    _catalog.execute(cursor, label, sql, params, param_types)
+
+def get_statistics():
+    """See StatementCatalog.get_statistics()."""
+    return _catalog.get_statistics()
+
+def log_statistics(level=logging.DEBUG):
+    """See StatementCatalog.log_statistics()."""
+    _catalog.log_statistics(level)
+
+def reset_statistics():
+    """See StatementCatalog.reset_statistics()."""
+    _catalog.reset_statistics()